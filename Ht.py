@@ -11,7 +11,6 @@ import plotly.express as px
 import plotly.graph_objects as go
 import io
 import requests
-import json
 from datetime import datetime
 import smtplib
 from email.mime.multipart import MIMEMultipart
@@ -24,9 +23,33 @@ import platform
 import base64
 import numpy as np
 from collections import Counter
+from functools import partial
+from itertools import islice
 import time
 import pickle
+import hashlib
 from pathlib import Path
+from concurrent.futures import CancelledError
+from integrity_engine import (
+    propose_orphan_pairs, build_column_catalog, enable_copy_on_write, optimize_dtypes, values_match,
+    fetch_records, side_by_side_record,
+    JOIN_STRATEGIES, STRATEGY_ALL_PAIRS, STRATEGY_BY_OCCURRENCE, MERGE_ROW_BUDGET,
+    key_labels, filter_mask, parse_date_columns, rollup,
+    filter_mismatches, count_record_mismatches, mismatch_cooccurrence,
+    field_mismatches, transformation_patterns, lookup_key, record_field_status, field_comparison, record_page, RECORD_PAGE_ROWS, PATTERN_EXACT_LIMIT,
+    field_mismatch_totals, fix_frame, sql_fix_statements, pattern_fix_statements, api_fix_payloads, generate_fixes, compress_stream,
+    FIX_BATCH_ROWS, API_BATCH_ROWS, new_result_cache, cache_get, cache_put, set_cache_ceiling, cache_stats,
+    RESULT_CACHE_MAX_BYTES, run_partitioned_comparison, reconcile_group_totals, group_rows_mask,
+    estimate_comparison, ESTIMATE_SAMPLE_RATE, run_comparison, record_stage_timings, explain_comparison,
+    PLAN_OUT_OF_CORE, PLAN_SAMPLED, PLAN_AGGREGATE, set_memory_tracing, new_run_profile, profile_stage, operation_timeline, slowest_operations,
+    new_job_pool, submit_job, cancel_job, finish_job, TABLE_EXPORT_FORMATS, export_table, reconciliation_workbook, EXCEL_MAX_ROWS
+)
+
+enable_copy_on_write()
+
+ROW_LEVEL_RECONCILIATION = "🔬 Row-level diff"
+QUICK_RECONCILIATION = "⚡ Quick totals (account × month)"
+SAMPLED_ESTIMATE = "🎯 Quick estimate (key sample)"
 
 # -------------------------
 # Comparison History Management
@@ -60,47 +83,171 @@ def load_comparison_history():
     return []
 
 # -------------------------
-# Quick Fix Generator Functions
+# File Ingest Functions
 # -------------------------
-def generate_sql_fixes(mismatches_df, field_name, source='netsuite', target='salesforce'):
-    """Generate SQL UPDATE statements to fix mismatches."""
-    sql_statements = []
-    
-    for idx, row in mismatches_df.head(10).iterrows():  # Show first 10
-        if source == 'netsuite':
-            old_value = row.get('NetSuite', '')
-            new_value = row.get('Salesforce', '')
-        else:
-            old_value = row.get('Salesforce', '')
-            new_value = row.get('NetSuite', '')
-        
-        # Escape single quotes in SQL
-        new_value_escaped = str(new_value).replace("'", "''")
-        old_value_escaped = str(old_value).replace("'", "''")
-        
-        sql = f"UPDATE records SET {field_name} = '{new_value_escaped}' WHERE {field_name} = '{old_value_escaped}';"
-        sql_statements.append(sql)
-    
-    return '\n'.join(sql_statements)
-
-def generate_api_fixes(mismatches_df, field_name):
-    """Generate API call templates for bulk updates."""
-    api_template = {
-        "endpoint": "/api/v1/records/bulk-update",
-        "method": "POST",
-        "payload": []
-    }
-    
-    for idx, row in mismatches_df.head(10).iterrows():
-        record_update = {
-            "record_id": row.get('Record #', idx),
-            "field": field_name,
-            "old_value": str(row.get('NetSuite', '')),
-            "new_value": str(row.get('Salesforce', ''))
-        }
-        api_template["payload"].append(record_update)
-    
-    return json.dumps(api_template, indent=2)
+def file_fingerprint(uploaded_file):
+    """Content hash of an uploaded file, computed once per upload."""
+    cache_key = f"fingerprint_{uploaded_file.file_id}"
+    if cache_key not in st.session_state:
+        st.session_state[cache_key] = hashlib.sha1(uploaded_file.getvalue()).hexdigest()
+    return st.session_state[cache_key]
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def _read_excel_optimized(fingerprint, _uploaded_file):
+    """Read a workbook once per distinct file content: date columns parsed, dtypes optimized."""
+    _uploaded_file.seek(0)
+    df = pd.read_excel(_uploaded_file, engine="openpyxl")
+    df = parse_date_columns(df, [col for col in df.columns if "date" in col.lower()])
+    return optimize_dtypes(df)
+
+def load_uploaded_excel(uploaded_file):
+    """Return the ingested frame for an upload.
+
+    The cached frame is shared, so callers get a shallow copy: with copy-on-write,
+    column edits on it never touch the cached data and no values are duplicated.
+    """
+    return _read_excel_optimized(file_fingerprint(uploaded_file), uploaded_file).copy(deep=False)
+
+@st.cache_resource(show_spinner=False)
+def comparison_result_cache():
+    """Comparison-result cache shared by every session of this server process (see new_result_cache)."""
+    return new_result_cache(RESULT_CACHE_MAX_BYTES)
+
+@st.cache_resource(show_spinner=False)
+def comparison_jobs():
+    """Background worker pool shared by every session, so identical comparisons run once."""
+    return new_job_pool()
+
+@st.fragment(run_every=0.5)
+def show_job_progress(signature, title):
+    """Live progress of a background job with a cancel button; reruns the page when the job ends."""
+    job = comparison_jobs()["jobs"].get(signature)
+    if job is None or job["future"].done():
+        st.rerun(scope="app")
+    st.progress(job["progress"], text=f"⏳ {title}: {job['stage']} ({time.time() - job['started']:.0f}s)")
+    if st.button("⏹️ Cancel", key="cancel_comparison_job"):
+        cancel_job(comparison_jobs(), signature)
+        st.session_state['cancelled_job'] = signature
+        st.session_state.pop('compare_pending', None)
+        st.rerun(scope="app")
+    if job["partial"] is not None:
+        show_partial_results(job["partial"])
+
+def show_partial_results(partial):
+    """Running KPIs of a comparison still in progress, so a wrong key or mapping shows within seconds."""
+    field_mismatches = partial["Field Mismatches"]
+    records_done = partial["NetSuite Records"] + partial["Salesforce Records"]
+    compared_values = partial["Matched"] * len(field_mismatches)
+    match_percentage = (1 - sum(field_mismatches.values()) / compared_values) * 100 if compared_values > 0 else 0
+    st.caption(f"📡 Live results from {records_done:,} of {partial['Records Total']:,} records - they update until the comparison finishes")
+    live_cols = st.columns(4)
+    with live_cols[0]:
+        st.metric("✅ Matched Records", f"{partial['Matched']:,}")
+    with live_cols[1]:
+        st.metric("🟦 NS Only", f"{partial['NS Only']:,}")
+    with live_cols[2]:
+        st.metric("🟧 SF Only", f"{partial['SF Only']:,}")
+    with live_cols[3]:
+        st.metric("Match Rate", f"{match_percentage:.1f}%")
+    if records_done > 0 and partial["Matched"] == 0:
+        st.warning("⚠️ No records have matched so far - check the match key and the column mapping, and cancel if they are wrong")
+    if compared_values > 0:
+        field_rates = pd.DataFrame({
+            "Field": list(field_mismatches),
+            "Match Rate (%)": [(1 - n / partial["Matched"]) * 100 for n in field_mismatches.values()]
+        })
+        fig_live = px.bar(field_rates, x="Field", y="Match Rate (%)", title="Match Rate by Field (so far)", range_y=[0, 100])
+        st.plotly_chart(fig_live, use_container_width=True, key="plotly_chart_live_field_rates")
+        mismatch_counts = sorted(((f, n) for f, n in field_mismatches.items() if n > 0), key=lambda x: x[1], reverse=True)
+        for insight in generate_ai_insights(mismatch_counts, compared_values, match_percentage)[:2]:
+            st.info(f"**{insight['icon']} {insight['title']}:** {insight['description']}")
+
+def background_result(signature, title, fn, *args):
+    """Result of fn(*args) from the shared result cache, or computed by a background job.
+
+    While the job runs the page shows its progress and stops here, so the app stays
+    responsive; the job is shared with any session asking for the same signature.
+    The session also keeps the result it is showing (one per kind of result), so
+    widget reruns never recompute it when the shared cache dropped or refused it
+    (larger than the ceiling, or caching turned off).
+    """
+    current = st.session_state.setdefault('current_results', {})
+    if signature[0] in current and current[signature[0]][0] == signature:
+        return current[signature[0]][1]
+    result = cache_get(comparison_result_cache(), signature)
+    if result is not None:
+        current[signature[0]] = (signature, result)
+        return result
+    if st.session_state.get('cancelled_job') == signature:
+        st.warning("⏹️ Comparison cancelled. Change the settings or click '🔍 Compare Data' to run it again.")
+        st.stop()
+    pool = comparison_jobs()
+    job = submit_job(pool, signature, fn, *args)
+    if not job["future"].done():
+        show_job_progress(signature, title)
+        st.stop()
+    try:
+        result = finish_job(pool, signature, job)
+    except (ValueError, CancelledError) as e:
+        st.error(f"❌ {title} failed: {str(e) or 'cancelled'}")
+        st.stop()
+    cache_put(comparison_result_cache(), signature, result)
+    current[signature[0]] = (signature, result)
+    return result
+
+def run_recorded_comparison(*args, progress=None):
+    """run_comparison, then add its stage timings to the benchmark history that calibrates Explain."""
+    comparison = run_comparison(*args, progress=progress)
+    try:
+        record_stage_timings(comparison["stage_seconds"], comparison["stage_work"])
+    except OSError:
+        pass  # the history only improves estimates; a read-only disk must not fail the comparison
+    return comparison
+
+def apply_comparison_plan(plan, sample_rate):
+    """Leave the Explain step and switch the sidebar to the recommended reconciliation mode."""
+    st.session_state.pop('explain_only', None)
+    if plan == PLAN_SAMPLED:
+        st.session_state['reconciliation_mode'] = SAMPLED_ESTIMATE
+        st.session_state['estimate_sample_pct'] = max(1, int(round(sample_rate * 100)))
+    elif plan == PLAN_AGGREGATE:
+        st.session_state['reconciliation_mode'] = QUICK_RECONCILIATION
+    else:
+        st.session_state['reconciliation_mode'] = ROW_LEVEL_RECONCILIATION
+
+# -------------------------
+# Record Paging Functions
+# -------------------------
+def show_record_page(df, positions, key):
+    """Show one page of the records at `positions`, with a page selector when they don't fit on one."""
+    page_count = max(1, -(-len(positions) // RECORD_PAGE_ROWS))
+    page = 1
+    if page_count > 1:
+        page = st.number_input(f"Page (of {page_count:,})", min_value=1, max_value=page_count, value=1, step=1, key=key)
+        first_row = (page - 1) * RECORD_PAGE_ROWS
+        st.caption(f"Showing records {first_row + 1:,}-{min(first_row + RECORD_PAGE_ROWS, len(positions)):,} of {len(positions):,}")
+    st.dataframe(record_page(df, positions, page - 1), use_container_width=True)
+
+# -------------------------
+# Export Functions
+# -------------------------
+def export_download_button(label, build_frame, file_stem, key):
+    """Download button for a table in the sidebar's export format.
+
+    The table is built and encoded only when the button is clicked (nothing is
+    serialized on reruns).
+    """
+    export_format = st.session_state.get("export_format", "CSV")
+    extension, mime = TABLE_EXPORT_FORMATS[export_format]
+    st.download_button(
+        label,
+        data=lambda: export_table(build_frame(), export_format)[0],
+        file_name=f"{file_stem}.{extension}",
+        mime=mime,
+        key=key,
+        on_click="ignore",
+        use_container_width=True
+    )
 
 # -------------------------
 # PDF Export Function
@@ -552,6 +699,9 @@ view_mode = st.sidebar.radio(
 
 is_admin_mode = (view_mode == "🔧 Admin Mode")
 
+# Cost of this rerun, stage by stage (shown in Admin Mode's Run Performance panel)
+run_profile = new_run_profile()
+
 # -------------------------
 # Sidebar: Upload Controls
 # -------------------------
@@ -567,7 +717,21 @@ salesforce_file = st.sidebar.file_uploader("Upload Salesforce XLSX", type=["xlsx
 
 # Action Buttons
 compare_button = st.sidebar.button("🔍 Compare Data", type="primary", use_container_width=True)
+explain_button = st.sidebar.button(
+    "🧮 Explain", use_container_width=True,
+    help="Predict merged rows, memory and runtime from the files' metadata and recommend how to run the comparison - nothing is compared"
+)
 reset_button = st.sidebar.button("🔄 Reset", use_container_width=True)
+st.sidebar.selectbox(
+    "Export format",
+    list(TABLE_EXPORT_FORMATS),
+    index=0,
+    help="Format of the table downloads. Compressed CSV and Parquet are much smaller for large comparisons",
+    key="export_format"
+)
+missing_formats = [name for name in ("CSV (zstd)", "Parquet") if name not in TABLE_EXPORT_FORMATS]
+if missing_formats:
+    st.sidebar.caption(f"ℹ️ {' and '.join(missing_formats)} export needs pyarrow (pip install pyarrow)")
 
 # Handle reset
 if reset_button:
@@ -583,7 +747,14 @@ if compare_button:
         st.toast("⚠️ Please upload both files before comparing", icon="⚠️")
     else:
         st.session_state['comparison_triggered'] = True
+        st.session_state.pop('explain_only', None)
         st.toast("🔍 Starting comparison...", icon="⏳")
+if explain_button:
+    if not netsuite_file or not salesforce_file:
+        st.toast("⚠️ Please upload both files before comparing", icon="⚠️")
+    else:
+        st.session_state['comparison_triggered'] = True
+        st.session_state['explain_only'] = True
 
 st.sidebar.markdown("---")
 
@@ -604,7 +775,9 @@ df_netsuite = None
 all_cols = []
 if netsuite_file:
     try:
-        df_netsuite = pd.read_excel(netsuite_file, engine="openpyxl")
+        with profile_stage(run_profile, "Ingest NetSuite") as ingest:
+            df_netsuite = load_uploaded_excel(netsuite_file)
+            ingest["rows"] = len(df_netsuite)
         uniqueness_scores = {col: df_netsuite[col].nunique(dropna=True)/len(df_netsuite[col]) if len(df_netsuite[col]) > 0 else 0 for col in df_netsuite.columns}
         sorted_cols = sorted(uniqueness_scores.items(), key=lambda x: x[1], reverse=True)
         sorted_column_names = [col for col, score in sorted_cols]
@@ -634,6 +807,68 @@ if netsuite_file:
         help="Records with the same value in this field will be compared",
         key="match_key_selector"
     )
+    match_key_extra = st.sidebar.multiselect(
+        "Also match by:",
+        options=[col for col in all_cols if col != match_key],
+        default=[],
+        help="Build a composite key, e.g. Document Number + Line Number. The fields are normalized and "
+             "hashed into one 64-bit join key (checked for collisions)",
+        key="match_key_extra"
+    )
+    duplicate_key_strategy = st.sidebar.selectbox(
+        "When a key repeats:",
+        JOIN_STRATEGIES,
+        index=0,
+        help="All pairs compares every NetSuite row with every Salesforce row of the same key. "
+             "First match keeps one row per key, pair by occurrence pairs the 1st with the 1st, 2nd with the 2nd..., "
+             "aggregate sums numbers per key before comparing",
+        key="duplicate_key_strategy"
+    )
+    reconciliation_mode = st.sidebar.radio(
+        "Reconciliation mode:",
+        [ROW_LEVEL_RECONCILIATION, QUICK_RECONCILIATION, SAMPLED_ESTIMATE],
+        index=0,
+        help="Quick totals compares counts, sums and a content hash per account and month without matching records - "
+             "then diffs rows only for the groups that disagree. Quick estimate compares a sample of keys and shows "
+             "the KPIs with 95% confidence intervals",
+        key="reconciliation_mode"
+    )
+    if reconciliation_mode == SAMPLED_ESTIMATE:
+        # Default set through session state, which Explain's recommendation also writes
+        st.session_state.setdefault("estimate_sample_pct", int(ESTIMATE_SAMPLE_RATE * 100))
+        estimate_sample_pct = st.sidebar.slider(
+            "Sample of keys (%)",
+            min_value=1,
+            max_value=25,
+            help="Both systems sample the same keys (chosen by a hash of the key). Larger samples give narrower intervals",
+            key="estimate_sample_pct"
+        )
+    if is_admin_mode:
+        merge_row_budget = st.sidebar.number_input(
+            "Max merged rows",
+            min_value=10_000,
+            value=MERGE_ROW_BUDGET,
+            step=500_000,
+            help=f"All-pairs merges predicted above this size switch to '{STRATEGY_BY_OCCURRENCE}', with a warning",
+            key="merge_row_budget"
+        )
+        result_cache_mb = st.sidebar.number_input(
+            "Result cache (MB)",
+            min_value=0,
+            value=comparison_result_cache()["max_bytes"] // 1_000_000,
+            step=250,
+            help="Memory ceiling of the comparison results kept for instant re-selection, shared by all users. "
+                 "Least recently used results are dropped first; 0 disables the cache",
+            key="result_cache_mb"
+        )
+        set_cache_ceiling(comparison_result_cache(), result_cache_mb * 1_000_000)
+        result_cache_stats = cache_stats(comparison_result_cache())
+        st.sidebar.caption(
+            f"Cache: {result_cache_stats['entries']} results, {result_cache_stats['bytes'] / 1_000_000:.0f} MB used · "
+            f"{result_cache_stats['hits']} hits, {result_cache_stats['misses']} misses, {result_cache_stats['evictions']} evicted"
+        )
+    else:
+        merge_row_budget = MERGE_ROW_BUDGET
     
     st.sidebar.markdown("---")
     selected_primary = st.sidebar.multiselect("Primary Fields", all_cols, default=primary_cols, key="primary_multiselect")
@@ -641,21 +876,25 @@ if netsuite_file:
     selected_tertiary = st.sidebar.multiselect("Tertiary Fields", all_cols, default=tertiary_cols, key="tertiary_multiselect")
 else:
     match_key = None
+    match_key_extra = []
+    duplicate_key_strategy = STRATEGY_ALL_PAIRS
+    reconciliation_mode = ROW_LEVEL_RECONCILIATION
+    merge_row_budget = MERGE_ROW_BUDGET
     selected_primary = []
     selected_secondary = []
     selected_tertiary = []
 
 date_range = None
+full_date_range = None
 date_col = None
 if date_cols and netsuite_file:
     date_col = st.sidebar.selectbox("Select Date Column", date_cols, key="sidebar_date_col")
     if df_netsuite is not None and date_col:
-        # Convert to datetime and handle errors
-        df_netsuite[date_col] = pd.to_datetime(df_netsuite[date_col], errors="coerce")
-        # Remove any NaT values before finding min/max
+        # Date columns are parsed at ingest - remove any NaT values before finding min/max
         valid_dates = df_netsuite[date_col].dropna()
         if len(valid_dates) > 0:
             min_date, max_date = valid_dates.min(), valid_dates.max()
+            full_date_range = (min_date.date(), max_date.date())
             date_range = st.sidebar.date_input("Date Range", [min_date, max_date], key="sidebar_date_range")
         else:
             st.sidebar.warning(f"No valid dates found in {date_col}")
@@ -704,14 +943,18 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
         time.sleep(0.3)
     
     if df_netsuite is None:
-        df_netsuite = pd.read_excel(netsuite_file, engine="openpyxl")
+        with profile_stage(run_profile, "Ingest NetSuite") as ingest:
+            df_netsuite = load_uploaded_excel(netsuite_file)
+            ingest["rows"] = len(df_netsuite)
     
     if compare_button:
         status_text.text("⏳ Step 2/5: Loading Salesforce data...")
         progress_bar.progress(25)
         time.sleep(0.3)
     
-    df_salesforce = pd.read_excel(salesforce_file, engine="openpyxl")
+    with profile_stage(run_profile, "Ingest Salesforce") as ingest:
+        df_salesforce = load_uploaded_excel(salesforce_file)
+        ingest["rows"] = len(df_salesforce)
     
     if compare_button:
         status_text.text("⏳ Step 3/5: Mapping columns...")
@@ -722,53 +965,53 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
     st.sidebar.markdown("---")
     st.sidebar.subheader("Column Mapping")
     
-    # Choose mapping method
-    mapping_method = st.sidebar.radio(
-        "Mapping Method",
-        ["By Position (Sequential)", "By Name (Manual)"],
-        index=0,  # Default to sequential
-        help="Sequential: Columns compared in order (1→1, 2→2, etc.)"
-    )
+    with profile_stage(run_profile, "Column mapping", rows=len(df_salesforce)):
+        # Choose mapping method
+        mapping_method = st.sidebar.radio(
+            "Mapping Method",
+            ["By Position (Sequential)", "By Name (Manual)"],
+            index=0,  # Default to sequential
+            help="Sequential: Columns compared in order (1→1, 2→2, etc.)"
+        )
     
-    ns_columns = list(df_netsuite.columns)
-    sf_columns = list(df_salesforce.columns)
+        ns_columns = list(df_netsuite.columns)
+        sf_columns = list(df_salesforce.columns)
     
-    if mapping_method == "By Position (Sequential)":
-        # Automatically map columns by position
-        min_cols = min(len(ns_columns), len(sf_columns))
-        st.sidebar.success(f"✅ Sequential: {min_cols} columns mapped")
-        st.sidebar.caption("NS Col 1 ↔ SF Col 1, Col 2 ↔ Col 2...")
-        # Rename Salesforce columns to match NetSuite column names by position
-        df_salesforce_renamed = df_salesforce.copy()
-        rename_dict = {sf_columns[i]: ns_columns[i] for i in range(min_cols)}
-        df_salesforce_renamed = df_salesforce_renamed.rename(columns=rename_dict)
-        df_salesforce = df_salesforce_renamed
-    else:
-        # Manual column mapping
-        st.sidebar.info("Map Salesforce columns to NetSuite columns manually")
-        column_mapping = {}
-        
-        with st.sidebar.expander("Configure Column Mappings", expanded=False):
-            st.write("**Map Salesforce → NetSuite**")
-            for sf_col in sf_columns:
-                # Try to find a matching column name automatically
-                default_match = sf_col if sf_col in ns_columns else (ns_columns[0] if ns_columns else None)
-                mapped_col = st.selectbox(
-                    f"SFDC: {sf_col}",
-                    options=["(Skip)"] + ns_columns,
-                    index=ns_columns.index(default_match) + 1 if default_match and default_match in ns_columns else 0,
-                    key=f"map_{sf_col}"
-                )
-                if mapped_col != "(Skip)":
-                    column_mapping[mapped_col] = sf_col
-        
-        # Rename Salesforce columns to match NetSuite columns based on mapping
-        if column_mapping:
-            df_salesforce_renamed = df_salesforce.copy()
-            reverse_mapping = {v: k for k, v in column_mapping.items()}
-            df_salesforce_renamed = df_salesforce_renamed.rename(columns=reverse_mapping)
-            df_salesforce = df_salesforce_renamed
-            st.sidebar.success(f"✓ {len(column_mapping)} columns mapped manually")
+        if mapping_method == "By Position (Sequential)":
+            # Automatically map columns by position
+            min_cols = min(len(ns_columns), len(sf_columns))
+            st.sidebar.success(f"✅ Sequential: {min_cols} columns mapped")
+            st.sidebar.caption("NS Col 1 ↔ SF Col 1, Col 2 ↔ Col 2...")
+            # Rename Salesforce columns to match NetSuite column names by position
+            # (rename returns a new frame that shares the data under copy-on-write)
+            rename_dict = {sf_columns[i]: ns_columns[i] for i in range(min_cols)}
+            df_salesforce = df_salesforce.rename(columns=rename_dict)
+            column_mapping_signature = tuple(rename_dict.items())
+        else:
+            # Manual column mapping
+            st.sidebar.info("Map Salesforce columns to NetSuite columns manually")
+            column_mapping = {}
+        
+            with st.sidebar.expander("Configure Column Mappings", expanded=False):
+                st.write("**Map Salesforce → NetSuite**")
+                for sf_col in sf_columns:
+                    # Try to find a matching column name automatically
+                    default_match = sf_col if sf_col in ns_columns else (ns_columns[0] if ns_columns else None)
+                    mapped_col = st.selectbox(
+                        f"SFDC: {sf_col}",
+                        options=["(Skip)"] + ns_columns,
+                        index=ns_columns.index(default_match) + 1 if default_match and default_match in ns_columns else 0,
+                        key=f"map_{sf_col}"
+                    )
+                    if mapped_col != "(Skip)":
+                        column_mapping[mapped_col] = sf_col
+        
+            # Rename Salesforce columns to match NetSuite columns based on mapping
+            if column_mapping:
+                reverse_mapping = {v: k for k, v in column_mapping.items()}
+                df_salesforce = df_salesforce.rename(columns=reverse_mapping)
+                st.sidebar.success(f"✓ {len(column_mapping)} columns mapped manually")
+            column_mapping_signature = tuple(sorted(column_mapping.items()))
 
     if compare_button:
         status_text.text("⏳ Step 4/5: Analyzing data quality...")
@@ -778,38 +1021,38 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
     # Define tabs after files are uploaded
     tab1, tab2, tab3, tab4 = st.tabs(["🌍 Overview", "🔍 Drill Down", "📈 Trend", "✅ Advanced Check"])
 
-    # Convert date columns to datetime
-    for col in df_netsuite.columns:
-        if "date" in col.lower():
-            df_netsuite[col] = pd.to_datetime(df_netsuite[col], errors="coerce")
-    for col in df_salesforce.columns:
-        if "date" in col.lower():
-            df_salesforce[col] = pd.to_datetime(df_salesforce[col], errors="coerce")
-
-    # Apply filters to both NetSuite and Salesforce
-    # IMPORTANT: Don't filter - include ALL records from both sheets
-    filtered_ns = df_netsuite.copy()
-    filtered_sf = df_salesforce.copy()
-    # Commenting out filters to ensure ALL records are included
-    # if date_range and len(date_range) == 2 and date_col:
-    #     start_date = pd.to_datetime(date_range[0]).tz_localize(None)
-    #     end_date = pd.to_datetime(date_range[1]).tz_localize(None)
-    #     filtered_ns = filtered_ns[(filtered_ns[date_col].dt.tz_localize(None) >= start_date) & (filtered_ns[date_col].dt.tz_localize(None) <= end_date)]
-    #     if date_col in filtered_sf.columns:
-    #         filtered_sf = filtered_sf[(filtered_sf[date_col].dt.tz_localize(None) >= start_date) & (filtered_sf[date_col].dt.tz_localize(None) <= end_date)]
-    # if account_filter and account_col:
-    #     filtered_ns = filtered_ns[filtered_ns[account_col].isin(account_filter)]
-    #     if account_col in filtered_sf.columns:
-    #         filtered_sf = filtered_sf[filtered_sf[account_col].isin(account_filter)]
-
-    # Use the user-selected match key for merging
-    merge_key = match_key if match_key else (primary_cols[0] if primary_cols else None)
+    # Date columns are parsed at ingest; this only converts Salesforce columns that got a
+    # "date" name through the column mapping (already-parsed columns are skipped)
+    with profile_stage(run_profile, "Date coercion", rows=len(df_netsuite) + len(df_salesforce)):
+        df_netsuite = parse_date_columns(df_netsuite, [col for col in df_netsuite.columns if "date" in col.lower()])
+        df_salesforce = parse_date_columns(df_salesforce, [col for col in df_salesforce.columns if "date" in col.lower()])
+
+    # Apply filters to both NetSuite and Salesforce before the merge (predicate pushdown):
+    # the join, KPIs, catalog and every tab only see the selected date range and accounts
+    # The default range spans all NetSuite dates - only a narrowed range filters (undated rows stay in otherwise)
+    date_filter = date_range if date_range and len(date_range) == 2 and date_col and tuple(date_range) != full_date_range else None
+    accounts_filter = list(account_filter) if account_filter and account_col else None
+    if date_filter or accounts_filter:
+        filtered_ns = df_netsuite[filter_mask(df_netsuite, date_col, date_filter, account_col, accounts_filter)]
+        filtered_sf = df_salesforce[filter_mask(df_salesforce, date_col, date_filter, account_col, accounts_filter)]
+        st.info(f"🔎 Filters applied before matching: {len(filtered_ns):,} of {len(df_netsuite):,} NetSuite and {len(filtered_sf):,} of {len(df_salesforce):,} Salesforce records in scope")
+    else:
+        # Shallow copies: copy-on-write only duplicates a column if it is modified
+        filtered_ns = df_netsuite.copy(deep=False)
+        filtered_sf = df_salesforce.copy(deep=False)
+
+    # Use the user-selected match key for merging; several key fields are joined on one hashed key
+    key_columns = [match_key] + match_key_extra if match_key else primary_cols[:1]
+    composite_key = len(key_columns) > 1
+    merge_key = " + ".join(key_columns) if key_columns else None
+    key_missing = [col for col in key_columns if col not in filtered_ns.columns or col not in filtered_sf.columns]
     
     # Always include merge key, date, and account columns in filtered data
     selected_fields = list(set(selected_primary + selected_secondary + selected_tertiary))
     extra_cols = []
-    if merge_key and merge_key not in selected_fields:
-        extra_cols.append(merge_key)
+    for col in key_columns:
+        if col not in selected_fields:
+            extra_cols.append(col)
     if date_col and date_col not in selected_fields:
         extra_cols.append(date_col)
     if account_col and account_col not in selected_fields:
@@ -822,20 +1065,217 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
             filtered_ns[col] = pd.NA
         if col not in filtered_sf.columns:
             filtered_sf[col] = pd.NA
-    # Keep ALL columns from original data, don't filter to only selected fields
-    # This ensures we don't lose records during merge
-    # filtered_ns = filtered_ns.reindex(columns=all_fields, fill_value=pd.NA)
-    # filtered_sf = filtered_sf.reindex(columns=all_fields, fill_value=pd.NA)
-    if not merge_key or merge_key not in filtered_ns.columns or merge_key not in filtered_sf.columns:
-        st.warning(f"⚠️ Cannot calculate KPIs: Match key '{merge_key}' is missing. Please select a valid match key in the sidebar.")
+
+    # Explain: predict the comparison's cost from metadata (row counts, key multiplicities, column
+    # sizes, stage rates calibrated from past runs) and recommend how to run it, without comparing
+    if st.session_state.get('explain_only') and key_columns and not key_missing:
+        plan = explain_comparison(
+            filtered_ns, filtered_sf, key_columns, all_fields, selected_fields,
+            duplicate_key_strategy, merge_row_budget, date_col
+        )
+        with tab1:
+            st.subheader("🧮 Comparison Plan")
+            calibration = (f"stage rates calibrated from past runs for {plan['calibrated_stages']} of {len(plan['stages'])} stages"
+                           if plan["calibrated_stages"] else "default stage rates (no past runs recorded yet)")
+            st.caption(f"Predicted in {plan['explain_seconds']:.2f}s from row counts, key multiplicities and column sizes, using {calibration}. Nothing has been compared yet")
+            plan_cols = st.columns(4)
+            with plan_cols[0]:
+                st.metric("Input Records", f"{plan['input_rows']:,}")
+            with plan_cols[1]:
+                st.metric("Predicted Merged Rows", f"{plan['predicted_rows']:,}")
+            with plan_cols[2]:
+                st.metric("Predicted Runtime", f"{plan['seconds']:,.1f}s")
+            with plan_cols[3]:
+                st.metric("Peak Memory", f"{plan['memory_bytes'] / 1e6:,.1f} MB", help=f"Budget: {plan['memory_budget'] / 1e6:,.0f} MB")
+            if plan["join_strategy"] != duplicate_key_strategy:
+                st.warning(f"⚠️ Repeated {merge_key} values would exceed the merge budget: the comparison will use '{plan['join_strategy']}'")
+            elif plan["many_to_many_keys"] > 0:
+                st.warning(f"⚠️ {plan['many_to_many_keys']:,} {merge_key} values repeat in both systems and multiply the merged rows")
+            st.dataframe(
+                plan["stages"].assign(Seconds=plan["stages"]["Seconds"].round(2)),
+                use_container_width=True,
+                hide_index=True
+            )
+            st.info(f"💡 Recommended: **{plan['plan']}** - {plan['reason']}")
+            if plan["plan"] == PLAN_OUT_OF_CORE:
+                # Each month is compared in its own worker process, so the full merge is never in memory
+                if st.button(f"▶️ Run {plan['plan']}", type="primary", key="run_planned_partitions"):
+                    st.session_state['planned_partitions'] = True
+                if st.session_state.get('planned_partitions'):
+                    planned_signature = (
+                        "partitioned", file_fingerprint(netsuite_file), file_fingerprint(salesforce_file), column_mapping_signature,
+                        tuple(date_filter) if date_filter else None, tuple(accounts_filter) if accounts_filter else None,
+                        tuple(key_columns), tuple(sorted(all_fields)), tuple(sorted(selected_fields)), plan["join_strategy"], date_col
+                    )
+                    partitioned = background_result(
+                        planned_signature, "Comparing partitions", run_partitioned_comparison,
+                        filtered_ns, filtered_sf, key_columns, all_fields, selected_fields, date_col, "month", plan["join_strategy"],
+                        (netsuite_file.name, salesforce_file.name)
+                    )
+                    partition_totals = partitioned["totals"]
+                    if partition_totals:
+                        st.success(f"✅ {len(partitioned['partitions']):,} months compared in {partitioned['seconds']:.1f}s: {partition_totals['Matched']:,} matched, {partition_totals['NS Only']:,} NS only, {partition_totals['SF Only']:,} SF only, {partition_totals['Mismatched Values']:,} mismatched values")
+                    st.dataframe(partitioned["partitions"], use_container_width=True, hide_index=True)
+            else:
+                st.button(
+                    f"▶️ Run {plan['plan']}", type="primary", key="run_comparison_plan",
+                    on_click=apply_comparison_plan, args=(plan["plan"], plan["sample_rate"])
+                )
+            st.caption("Or click '🔍 Compare Data' in the sidebar for the row-level diff")
+        for plan_tab in (tab2, tab3, tab4):
+            with plan_tab:
+                st.info("🧮 Explain step: see the predicted cost on the Overview tab, then run the recommended plan from there")
+        st.stop()
+
+    # Quick reconciliation: compare record counts, sums and content hashes per (account, month) group
+    # instead of diffing rows; only groups whose summaries disagree are passed on to the row-level diff
+    row_scope = None
+    if reconciliation_mode == QUICK_RECONCILIATION and key_columns and not key_missing:
+        group_dimensions = {"Account": (account_col, None), "Month": (date_col, "month")}
+        sum_fields = [f for f in selected_fields if f not in key_columns and f != date_col and pd.api.types.is_numeric_dtype(filtered_ns[f])]
+        hash_fields = list(dict.fromkeys(key_columns + selected_fields))
+        group_signature = (
+            "groups", file_fingerprint(netsuite_file), file_fingerprint(salesforce_file), column_mapping_signature,
+            tuple(date_filter) if date_filter else None, tuple(accounts_filter) if accounts_filter else None,
+            tuple(group_dimensions.items()), tuple(sum_fields), tuple(hash_fields)
+        )
+        quick_drill = st.session_state.get('quick_drill')
+        if quick_drill and quick_drill[0] == group_signature:
+            # Row-level diff of the chosen groups only
+            row_scope = tuple(quick_drill[1])
+            filtered_ns = filtered_ns[group_rows_mask(filtered_ns, group_dimensions, row_scope)]
+            filtered_sf = filtered_sf[group_rows_mask(filtered_sf, group_dimensions, row_scope)]
+            st.info(f"🔬 Row-level diff of {len(row_scope)} group(s) whose totals disagree: {len(filtered_ns):,} NetSuite and {len(filtered_sf):,} Salesforce records")
+            if st.button("⬅️ Back to group totals", key="quick_drill_back"):
+                st.session_state.pop('quick_drill', None)
+                st.rerun()
+        else:
+            group_comparison = background_result(
+                group_signature, "Comparing group totals", reconcile_group_totals,
+                filtered_ns, filtered_sf, group_dimensions, sum_fields, hash_fields
+            )
+            with tab1:
+                st.subheader("⚡ Quick Reconciliation: Totals per Account × Month")
+                st.caption(f"Record counts{', sums of ' + ', '.join(sum_fields) if sum_fields else ''} and a content hash of the compared fields per group, from one pass over each file - no record matching. 'Values differ' means the totals agree but some record values do not")
+                status_counts = group_comparison["Status"].value_counts()
+                group_cols = st.columns(4)
+                with group_cols[0]:
+                    st.metric("Groups", f"{len(group_comparison):,}")
+                with group_cols[1]:
+                    st.metric("✅ Agree", f"{status_counts.get('Agree', 0):,}")
+                with group_cols[2]:
+                    st.metric("⚠️ Totals Differ", f"{status_counts.get('Totals differ', 0):,}")
+                with group_cols[3]:
+                    st.metric("🔍 Values Differ / One Side", f"{status_counts.get('Values differ', 0) + status_counts.get('NS Only', 0) + status_counts.get('SF Only', 0):,}")
+                st.dataframe(
+                    group_comparison.style.map(
+                        lambda v: '' if v == "Agree" else 'background-color: #FF7043; color: white',
+                        subset=["Status"]
+                    ),
+                    use_container_width=True,
+                    hide_index=True
+                )
+                disagreeing = group_comparison[group_comparison["Status"] != "Agree"]
+                if len(disagreeing) == 0:
+                    st.success("✅ Every group agrees - no row-level diff needed")
+                else:
+                    group_options = list(disagreeing[list(group_dimensions)].itertuples(index=False, name=None))
+                    drill_groups = st.multiselect(
+                        "Groups to diff at row level:",
+                        group_options,
+                        default=group_options,
+                        format_func=lambda g: " · ".join(g),
+                        key="quick_drill_groups"
+                    )
+                    if st.button("🔬 Diff Rows of Selected Groups", key="quick_drill_run", disabled=not drill_groups):
+                        st.session_state['quick_drill'] = (group_signature, drill_groups)
+                        st.rerun()
+            for quick_tab in (tab2, tab3, tab4):
+                with quick_tab:
+                    st.info("⚡ Quick totals mode: pick groups to diff on the Overview tab, or switch to row-level diff in the sidebar")
+            st.stop()
+    elif reconciliation_mode == SAMPLED_ESTIMATE and key_columns and not key_missing:
+        # Quick estimate: compare only a hash sample of the keys (the same keys on both sides)
+        estimate_rate = estimate_sample_pct / 100
+        estimate_signature = (
+            "estimate", file_fingerprint(netsuite_file), file_fingerprint(salesforce_file), column_mapping_signature,
+            tuple(date_filter) if date_filter else None, tuple(accounts_filter) if accounts_filter else None,
+            tuple(key_columns), tuple(all_fields), duplicate_key_strategy, estimate_rate
+        )
+        estimate = background_result(
+            estimate_signature, "Estimating from a key sample", estimate_comparison,
+            filtered_ns, filtered_sf, key_columns, all_fields, selected_fields, estimate_rate, duplicate_key_strategy
+        )
+        with tab1:
+            st.subheader(f"🎯 Quick Estimate from a {estimate_sample_pct}% Key Sample")
+            st.caption(f"Compared {estimate['sampled_records']:,} sampled records (≈{estimate['estimated_records']:,} in total) in {estimate['seconds']:.2f}s. Ranges are 95% confidence intervals")
+            value_pct = [v * 100 for v in estimate["value_match"]]
+            record_pct = [v * 100 for v in estimate["record_match"]]
+            score_range = [calculate_data_quality_score(v, estimate["estimated_records"], len(selected_fields)) for v in value_pct]
+            estimate_cols = st.columns(4)
+            with estimate_cols[0]:
+                st.metric("Match Rate", f"{value_pct[0]:.1f}%", help="Compared field values that agree, over records in both systems")
+                st.caption(f"95% CI: {value_pct[1]:.1f}% – {value_pct[2]:.1f}%")
+            with estimate_cols[1]:
+                st.metric("Records in Both Systems", f"{record_pct[0]:.1f}%")
+                st.caption(f"95% CI: {record_pct[1]:.1f}% – {record_pct[2]:.1f}%")
+            with estimate_cols[2]:
+                st.metric("Quality Score", f"{score_range[0]}/100", help=f"Grade {get_score_grade(score_range[0])}")
+                st.caption(f"95% CI: {score_range[1]} – {score_range[2]}")
+            with estimate_cols[3]:
+                st.metric("Estimated Records", f"{estimate['estimated_records']:,}")
+                st.caption(f"{estimate['sampled_matched']:,} sampled records in both systems")
+            field_estimates = estimate["field_mismatch"] * 100
+            if len(field_estimates) > 0:
+                fig_estimate = px.bar(
+                    field_estimates.reset_index(), x="Field", y="Estimate",
+                    error_y=field_estimates["High"].to_numpy() - field_estimates["Estimate"].to_numpy(),
+                    error_y_minus=field_estimates["Estimate"].to_numpy() - field_estimates["Low"].to_numpy(),
+                    labels={"Estimate": "Mismatch Rate (%)"},
+                    title="Estimated Mismatch Rate by Field (95% CI)"
+                )
+                st.plotly_chart(fig_estimate, use_container_width=True)
+                st.dataframe(
+                    field_estimates.round(2).rename(columns={"Estimate": "Mismatch Rate (%)", "Low": "CI Low (%)", "High": "CI High (%)"}),
+                    use_container_width=True
+                )
+
+            def launch_full_comparison():
+                st.session_state['reconciliation_mode'] = ROW_LEVEL_RECONCILIATION
+                st.session_state['comparison_triggered'] = True
+
+            st.button("🚀 Run Full Comparison", type="primary", on_click=launch_full_comparison, key="estimate_run_full")
+        for estimate_tab in (tab2, tab3, tab4):
+            with estimate_tab:
+                st.info("🎯 Quick estimate mode: see the estimate on the Overview tab, then run the full comparison from there")
+        st.stop()
+
+    # Column statistics catalog: one profiling pass over every column of both systems, kept in the
+    # shared result cache and reused by the Overview, Drill Down, Trend and Advanced Check tabs
+    catalog_signature = (
+        "catalog", file_fingerprint(netsuite_file), file_fingerprint(salesforce_file), column_mapping_signature,
+        date_col, account_col, tuple(date_filter) if date_filter else None, tuple(accounts_filter) if accounts_filter else None,
+        tuple(filtered_ns.columns), tuple(filtered_sf.columns), row_scope
+    )
+    if compare_button:
+        st.session_state['compare_pending'] = True
+        st.session_state.pop('cancelled_job', None)
+    with profile_stage(run_profile, "Column profiling", rows=len(filtered_ns) + len(filtered_sf)):
+        column_catalog = background_result(
+            catalog_signature, "Profiling columns", build_column_catalog, {"NetSuite": filtered_ns, "Salesforce": filtered_sf}
+        )
+
+    merge_job_seconds = {}  # stage timings of the background comparison job, when it ran
+    if not merge_key or key_missing:
+        st.warning(f"⚠️ Cannot calculate KPIs: Match key '{', '.join(key_missing) or merge_key}' is missing. Please select a valid match key in the sidebar.")
     else:
         st.info(f"🔑 Matching records by: **{merge_key}** | Records are compared when this field matches between NetSuite and Salesforce")
         
         # Show sample of what's being matched
         with st.expander("🔍 Preview: How records are matched", expanded=False):
             st.caption(f"Records with the same **{merge_key}** value are compared, regardless of row position")
-            sample_ns = filtered_ns[[merge_key]].head(3).reset_index(drop=True)
-            sample_sf = filtered_sf[[merge_key]].head(3).reset_index(drop=True)
+            sample_ns = filtered_ns[key_columns].head(3).reset_index(drop=True)
+            sample_sf = filtered_sf[key_columns].head(3).reset_index(drop=True)
             col1, col2 = st.columns(2)
             with col1:
                 st.markdown("**NetSuite (any rows)**")
@@ -845,16 +1285,77 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
                 st.dataframe(sample_sf, use_container_width=True)
             st.info(f"Example: If NS row 2 has {merge_key}='12345' and SF row 8 has {merge_key}='12345', they WILL be matched and compared ✅")
         
-        try:
-            # Merge on the match key to align records properly
-            merged_df = pd.merge(filtered_ns, filtered_sf, left_on=merge_key, right_on=merge_key, how="outer", indicator=True, suffixes=('_NS', '_SF'))
-            merged_df["_merge"] = merged_df["_merge"] if "_merge" in merged_df else "concat"
-            
+        # Comparison results (alignment, mismatch bitmap, rollup cube, key index, orphans) are computed
+        # by a background job and cached across sessions under everything that determines them, so
+        # switching back to an earlier key, field selection or mapping is instant.
+        key_display_col = "_key_label" if composite_key else merge_key
+        rollup_dimensions = {"Month": (date_col, "month"), "Account": (account_col, None)}
+        comparison_signature = (
+            "comparison", file_fingerprint(netsuite_file), file_fingerprint(salesforce_file), column_mapping_signature,
+            date_col, account_col, tuple(date_filter) if date_filter else None, tuple(accounts_filter) if accounts_filter else None,
+            tuple(key_columns), tuple(sorted(all_fields)), tuple(sorted(selected_fields)), duplicate_key_strategy, merge_row_budget,
+            tuple(rollup_dimensions.items()), row_scope
+        )
+        with profile_stage(run_profile, "Merge", rows=len(filtered_ns) + len(filtered_sf)):
+            comparison = background_result(
+                comparison_signature, "Comparing records", run_recorded_comparison,
+                filtered_ns, filtered_sf, key_columns, all_fields, selected_fields,
+                duplicate_key_strategy, merge_row_budget, rollup_dimensions
+            )
+        merge_job_seconds = comparison["stage_seconds"]
+        if st.session_state.pop('compare_pending', False) and not compare_button:
+            # The click's run ended while the job was computing: finish its one-off steps
+            # (progress, history, toast) on this run, which has the results
+            compare_button = True
+            progress_bar = st.progress(65)
+            status_text = st.empty()
+        key_profile = comparison["key_profile"]
+        join_strategy = comparison["join_strategy"]
+        merged_df = comparison["merged_df"]
+        rollup_fields = comparison["rollup_fields"]
+        mismatch_bitmap = comparison["mismatch_bitmap"]
+        rollup_cube = comparison["rollup_cube"]
+        key_index = comparison["key_index"]
+        orphans = comparison["orphans"]
+
+        if comparison["key_collisions"] > 0:
+            st.info(f"ℹ️ {comparison['key_collisions']} hash collisions in {merge_key} were detected and resolved by re-hashing")
+        predicted_rows = key_profile["predicted_rows"][duplicate_key_strategy]
+        input_rows = key_profile["ns_rows"] + key_profile["sf_rows"]
+        if join_strategy != duplicate_key_strategy:
+            st.warning(f"⚠️ Repeated {merge_key} values would expand the merge to {predicted_rows:,} rows (budget: {merge_row_budget:,}). Using '{STRATEGY_BY_OCCURRENCE}' instead - pick a strategy under 'When a key repeats' in the sidebar.")
+        elif join_strategy == STRATEGY_ALL_PAIRS and key_profile["many_to_many_keys"] > 0:
+            st.warning(f"⚠️ {key_profile['many_to_many_keys']:,} {merge_key} values repeat in both systems: the merge pairs every combination ({predicted_rows:,} rows from {input_rows:,} records)")
+
+        if key_profile["duplicate_keys_ns"] > 0 or key_profile["duplicate_keys_sf"] > 0:
+            with st.expander("🔁 Duplicate Key Analysis", expanded=False):
+                dup_cols = st.columns(3)
+                with dup_cols[0]:
+                    st.metric("Repeated Keys (NetSuite)", f"{key_profile['duplicate_keys_ns']:,}")
+                with dup_cols[1]:
+                    st.metric("Repeated Keys (Salesforce)", f"{key_profile['duplicate_keys_sf']:,}")
+                with dup_cols[2]:
+                    st.metric("Repeated in Both", f"{key_profile['many_to_many_keys']:,}")
+                st.markdown("**Predicted merged rows per strategy:**")
+                st.dataframe(
+                    pd.DataFrame({
+                        "Strategy": JOIN_STRATEGIES,
+                        "Merged Rows": [key_profile["predicted_rows"][s] for s in JOIN_STRATEGIES],
+                        "In Use": ["✅" if s == join_strategy else "" for s in JOIN_STRATEGIES]
+                    }),
+                    use_container_width=True,
+                    hide_index=True
+                )
+                if len(key_profile["top_keys"]) > 0:
+                    st.markdown(f"**{merge_key} values with the largest fan-out:**")
+                    st.dataframe(key_profile["top_keys"], use_container_width=True)
+
+        if comparison["merge_error"] is None:
             # Show merge statistics
             match_records = (merged_df["_merge"] == "both").sum()
-            ns_only = (merged_df["_merge"] == "left_only").sum()
-            sf_only = (merged_df["_merge"] == "right_only").sum()
-            
+            ns_only = len(orphans["ns"])
+            sf_only = len(orphans["sf"])
+
             merge_cols = st.columns(3)
             with merge_cols[0]:
                 st.metric("✅ Matched Records", f"{match_records:,}", help="Records found in both systems")
@@ -862,21 +1363,18 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
                 st.metric("🟦 NS Only", f"{ns_only:,}", delta_color="off", help="Records only in NetSuite")
             with merge_cols[2]:
                 st.metric("🟧 SF Only", f"{sf_only:,}", delta_color="off", help="Records only in Salesforce")
-            
+
             if ns_only > 0 or sf_only > 0:
                 st.warning(f"⚠️ {ns_only + sf_only} records don't have a matching {merge_key} in the other system")
-            
-        except ValueError as e:
-            st.error(f"❌ Merge error: {str(e)}")
-            merged_df = pd.concat([filtered_ns, filtered_sf], ignore_index=True)
-            merged_df["_merge"] = "concat"
+        else:
+            st.error(f"❌ Merge error: {comparison['merge_error']}")
 
-        # ------------------------- 
+        # -------------------------
         # Global KPI Summary (use merged data)
         # -------------------------
         total_match = (merged_df["_merge"] == "both").sum()
         total_mismatch = ((merged_df["_merge"] == "left_only") | (merged_df["_merge"] == "right_only")).sum()
-        total_nulls = merged_df.isnull().sum().sum()
+        total_nulls = sum(profile["Nulls"].sum() for profile in column_catalog.values())
 
         # ...existing code...
 
@@ -885,7 +1383,7 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
     # -------------------------
     # Tab 1: Overview (from merged_df)
     # -------------------------
-    with tab1:
+    with tab1, profile_stage(run_profile, "Render Overview tab"):
         st.header("Global Overview")
         
         # Calculate percentages first for overall distribution
@@ -899,30 +1397,31 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
         sunburst_data = []
         per_field_stats = []  # For KPI cards
         
-        for col in selected_fields_for_comparison:
-            # After merge with suffixes=('_NS', '_SF'), columns become col_NS and col_SF
-            col_ns = f"{col}_NS" if f"{col}_NS" in merged_df.columns else col
-            col_sf = f"{col}_SF" if f"{col}_SF" in merged_df.columns else col
+        with profile_stage(run_profile, "Per-field stats", rows=len(merged_df) * len(selected_fields_for_comparison)):
+            for col in selected_fields_for_comparison:
+                # After merge with suffixes=('_NS', '_SF'), columns become col_NS and col_SF
+                col_ns = f"{col}_NS" if f"{col}_NS" in merged_df.columns else col
+                col_sf = f"{col}_SF" if f"{col}_SF" in merged_df.columns else col
             
-            if col_ns not in merged_df.columns or col_sf not in merged_df.columns:
-                match_count = 0
-                mismatch_count = 0
-            else:
-                # Only consider rows present in both (matched by key)
-                both_mask = merged_df["_merge"] == "both"
-                ns_vals = merged_df.loc[both_mask, col_ns]
-                sf_vals = merged_df.loc[both_mask, col_sf]
+                if col_ns not in merged_df.columns or col_sf not in merged_df.columns:
+                    match_count = 0
+                    mismatch_count = 0
+                else:
+                    # Only consider rows present in both (matched by key)
+                    both_mask = merged_df["_merge"] == "both"
+                    ns_vals = merged_df.loc[both_mask, col_ns]
+                    sf_vals = merged_df.loc[both_mask, col_sf]
                 
-                # Compare values for matched records
-                match_mask = (ns_vals == sf_vals) | (ns_vals.isna() & sf_vals.isna())
-                match_count = match_mask.sum()
-                mismatch_count = (~match_mask).sum()
+                    # Compare values for matched records (two nulls count as a match)
+                    match_mask = values_match(ns_vals, sf_vals)
+                    match_count = match_mask.sum()
+                    mismatch_count = (~match_mask).sum()
                 
-                # Only count records that matched by key but have different field values
-                # Don't double-count left_only/right_only as these are different records entirely
-            sunburst_data.append(["Match", col, match_count])
-            sunburst_data.append(["Mismatch", col, mismatch_count])
-            per_field_stats.append({"Field": col, "Match": match_count, "Mismatch": mismatch_count})
+                    # Only count records that matched by key but have different field values
+                    # Don't double-count left_only/right_only as these are different records entirely
+                sunburst_data.append(["Match", col, match_count])
+                sunburst_data.append(["Mismatch", col, mismatch_count])
+                per_field_stats.append({"Field": col, "Match": match_count, "Mismatch": mismatch_count})
         
         if compare_button:
             status_text.text("⏳ Step 5/5: Generating insights...")
@@ -1038,7 +1537,7 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
         
         # Display Global Match/Mismatch KPIs right after distribution charts
         st.subheader("Global Match/Mismatch KPIs")
-        total_cells = merged_df.shape[0] * merged_df.shape[1]
+        total_cells = sum(profile["Rows"].sum() for profile in column_catalog.values())
         null_percentage = (total_nulls / total_cells * 100) if total_cells > 0 else 0
         
         kpi_cols = st.columns(3)
@@ -1062,7 +1561,7 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
                 value=f"{null_percentage:.1f}%", 
                 delta=f"{total_nulls:,} nulls",
                 delta_color="inverse",
-                help="Percentage of null values across selected data"
+                help="Percentage of null values across all columns of both systems"
             )
         
         # AI-Powered Data Quality Score - Better than Power BI!
@@ -1166,16 +1665,10 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
                     use_container_width=True
                 )
         
-        # Calculate top mismatched fields for insights
-        mismatch_counts = []
-        for field in selected_fields:
-            if field in filtered_ns.columns and field in filtered_sf.columns:
-                ns_vals = filtered_ns[field].astype(str).reset_index(drop=True)
-                sf_vals = filtered_sf[field].astype(str).reset_index(drop=True)
-                min_len = min(len(ns_vals), len(sf_vals))
-                mismatches = (ns_vals[:min_len] != sf_vals[:min_len]).sum()
-                if mismatches > 0:
-                    mismatch_counts.append((field, mismatches))
+        # Top mismatched fields for insights: per-field counts of records aligned by match key, from the
+        # mismatch bitmap (the same counts the live results streamed while the comparison ran)
+        mismatch_totals = field_mismatch_totals(mismatch_bitmap)
+        mismatch_counts = [(field, int(count)) for field, count in mismatch_totals.items() if count > 0 and field in selected_fields]
         
         mismatch_counts.sort(key=lambda x: x[1], reverse=True)
         
@@ -1205,18 +1698,19 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
         st.sidebar.markdown("---")
         st.sidebar.subheader("📄 Executive Summary")
         
-        pdf_html = generate_executive_pdf(
-            quality_score, score_grade, match_percentage, 
-            total_match_sb, total_mismatch_sb, total_records, 
-            num_fields, mismatch_counts, insights
-        )
-        
+        # The report HTML is built only when the button is clicked
         st.sidebar.download_button(
             label="📑 Download PDF Summary",
-            data=pdf_html,
+            data=partial(
+                generate_executive_pdf, quality_score, score_grade, match_percentage,
+                total_match_sb, total_mismatch_sb, total_records,
+                num_fields, mismatch_counts, insights
+            ),
             file_name=f"executive_summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html",
             mime="text/html",
             help="Download executive summary for stakeholders (HTML format - print to PDF in browser)",
+            key="download_executive_summary",
+            on_click="ignore",
             use_container_width=True
         )
         st.sidebar.caption("💡 Tip: Open in browser and print to PDF for formal reports")
@@ -1233,9 +1727,6 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
             'match_percentage': match_percentage
         }
         
-        # Generate HTML report
-        email_html = generate_email_report(summary_stats, mismatch_counts)
-        
         # Auto-send email if enabled (use values from sidebar inputs set before comparison)
         auto_send = st.session_state.get("auto_send_checkbox", False)
         sender_email_val = st.session_state.get("sender_email", "vidushi.dubey@chargepoint.com")
@@ -1250,7 +1741,7 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
                 st.session_state[comparison_key] = False
             
             if not st.session_state[comparison_key]:
-                with st.spinner("Automatically sending email..."):
+                with st.spinner("Automatically sending email..."), profile_stage(run_profile, "Send email"):
                     success, message = send_email_direct(summary_stats, mismatch_counts, sender_email_val, sender_password_val, recipient_email_val)
                     if success:
                         st.sidebar.success(f"✅ {message}")
@@ -1280,7 +1771,7 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
                 if not sender_password_val:
                     st.sidebar.error("⚠️ Please enter your email password above")
                 else:
-                    with st.spinner("Sending email..."):
+                    with st.spinner("Sending email..."), profile_stage(run_profile, "Send email"):
                         success, message = send_email_direct(summary_stats, mismatch_counts, sender_email_val, sender_password_val, recipient_email_val)
                         if success:
                             st.sidebar.success(f"✅ {message}")
@@ -1290,10 +1781,12 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
             # Download button for email report
             col3.download_button(
                 label="📥 Save",
-                data=email_html,
+                data=partial(generate_email_report, summary_stats, mismatch_counts),
                 file_name=f"data_integrity_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html",
                 mime="text/html",
                 help="Download HTML report",
+                key="download_email_report",
+                on_click="ignore",
                 use_container_width=True
             )
         
@@ -1356,11 +1849,57 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
     # -------------------------
     # Tab 2: Drill Down
     # -------------------------
-    with tab2:
+    with tab2, profile_stage(run_profile, "Render Drill Down tab"):
         # Interactive Record-Level Comparison - Better than Power BI!
         st.subheader("🔍 Interactive Record-Level Drill-Down")
         st.caption("Click-through analysis at individual record level - feature not available in standard Power BI!")
         
+        # Record lookup: answered from the key index over the whole comparison, not the visible rows
+        with st.expander("🔎 Record Lookup", expanded=False):
+            lookup_value = st.text_input(
+                f"Look up a {merge_key}:",
+                placeholder="a | b" if composite_key else "",
+                help=f"Exact {merge_key} value (for combined keys, the parts separated by ' | '). Finds the record in both systems",
+                key="record_lookup_value"
+            )
+            if lookup_value.strip() and key_index is None:
+                st.info("ℹ️ Record lookup needs the records matched by key - the merge failed, see the error above")
+            elif lookup_value.strip():
+                lookup_rows = lookup_key(key_index, lookup_value)
+                if len(lookup_rows) == 0:
+                    st.warning(f"⚠️ No record with {merge_key} '{lookup_value.strip()}' in either system")
+                else:
+                    lookup_row = lookup_rows[0]
+                    if len(lookup_rows) > 1:
+                        st.info(f"ℹ️ {merge_key} '{lookup_value.strip()}' repeats: {len(lookup_rows)} merged records")
+                        lookup_row = st.selectbox(
+                            "Record:",
+                            lookup_rows,
+                            format_func=lambda r: f"NetSuite row {merged_df['_ns_row'].iat[r]} ↔ Salesforce row {merged_df['_sf_row'].iat[r]}",
+                            key="record_lookup_choice"
+                        )
+                    merge_status = merged_df["_merge"].iat[lookup_row]
+                    if merge_status == "both":
+                        st.success("✅ Present in both systems")
+                    elif merge_status == "left_only":
+                        st.warning("🟦 Only in NetSuite")
+                    else:
+                        st.warning("🟧 Only in Salesforce")
+                    lookup_status = record_field_status(merged_df, mismatch_bitmap, lookup_row)
+                    st.dataframe(
+                        lookup_status.style.map(
+                            lambda v: 'background-color: #FF7043; color: white' if v == "Mismatch" else ('background-color: #4CAF50; color: white' if v == "Match" else ''),
+                            subset=["Status"]
+                        ),
+                        use_container_width=True,
+                        hide_index=True
+                    )
+                    st.markdown("**Full record:**")
+                    st.dataframe(
+                        side_by_side_record(filtered_ns, filtered_sf, merged_df["_ns_row"].iat[lookup_row], merged_df["_sf_row"].iat[lookup_row]),
+                        use_container_width=True
+                    )
+        
         # Field selector for drill-down
         all_available_fields = selected_primary + selected_secondary + selected_tertiary
         drill_field = st.selectbox(
@@ -1370,76 +1909,11 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
         )
         
         if drill_field:
-            # Use the MERGED data to compare records properly by match key
-            # This ensures records are matched by key, not by row position
-            
-            drill_field_ns = f"{drill_field}_NS" if f"{drill_field}_NS" in merged_df.columns else drill_field
-            drill_field_sf = f"{drill_field}_SF" if f"{drill_field}_SF" in merged_df.columns else drill_field
-            
-            # Get matched records (both)
-            matched_records = merged_df[merged_df["_merge"] == "both"].copy()
-            
-            # Get unmatched records (NS only and SF only)
-            ns_only_records = merged_df[merged_df["_merge"] == "left_only"].copy()
-            sf_only_records = merged_df[merged_df["_merge"] == "right_only"].copy()
-            
-            # Show summary
-            st.caption(f"📊 Found: {len(matched_records)} matched, {len(ns_only_records)} NS-only, {len(sf_only_records)} SF-only")
-            
-            comparison_rows = []
-            
-            # Add matched records
-            for idx, row in matched_records.iterrows():
-                ns_val = str(row[drill_field_ns]) if drill_field_ns in matched_records.columns else 'N/A'
-                sf_val = str(row[drill_field_sf]) if drill_field_sf in matched_records.columns else 'N/A'
-                comparison_rows.append({
-                    'Match Key': str(row[match_key]),
-                    'NetSuite': ns_val,
-                    'Salesforce': sf_val,
-                    'Status': '✅ Match' if ns_val == sf_val else '❌ Mismatch'
-                })
-            
-            # Add NS-only records
-            for idx, row in ns_only_records.iterrows():
-                # Try to get the drill field value, but use match key if not available
-                if drill_field_ns in ns_only_records.columns and pd.notna(row[drill_field_ns]):
-                    ns_val = str(row[drill_field_ns])
-                elif drill_field in ns_only_records.columns and pd.notna(row[drill_field]):
-                    ns_val = str(row[drill_field])
-                else:
-                    # If drill field is empty, show match key value instead
-                    ns_val = str(row[match_key]) if match_key in row.index else 'N/A'
-                
-                # Get match key value
-                key_val = str(row[match_key]) if match_key in row.index else 'N/A'
-                
-                comparison_rows.append({
-                    'Match Key': key_val,
-                    'NetSuite': ns_val,
-                    'Salesforce': '(Not in Salesforce)',
-                    'Status': '🟦 NS Only'
-                })
-            
-            # Add SF-only records
-            for idx, row in sf_only_records.iterrows():
-                # Try to get the drill field value, but use match key if not available
-                if drill_field_sf in sf_only_records.columns and pd.notna(row[drill_field_sf]):
-                    sf_val = str(row[drill_field_sf])
-                elif drill_field in sf_only_records.columns and pd.notna(row[drill_field]):
-                    sf_val = str(row[drill_field])
-                else:
-                    # If drill field is empty, show match key value instead
-                    sf_val = str(row[match_key]) if match_key in row.index else 'N/A'
-                
-                comparison_rows.append({
-                    'Match Key': str(row[match_key]) if match_key in row else 'N/A',
-                    'NetSuite': '(Not in NetSuite)',
-                    'Salesforce': sf_val,
-                    'Status': '🟧 SF Only'
-                })
-            
-            # Create comparison dataframe
-            comparison_df = pd.DataFrame(comparison_rows)
+            # Key, values and status of every record aligned by match key, taken from the mismatch
+            # bitmap (two nulls match, as in the KPIs) with whole-column operations
+            comparison_df = field_comparison(merged_df, mismatch_bitmap, drill_field, key_display_col)
+            status_counts = comparison_df['Status'].value_counts()
+            st.caption(f"📊 Found: {status_counts.get('✅ Match', 0) + status_counts.get('❌ Mismatch', 0)} matched, {status_counts.get('🟦 NS Only', 0)} NS-only, {status_counts.get('🟧 SF Only', 0)} SF-only")
             comparison_df.insert(0, 'Record #', range(1, len(comparison_df) + 1))
             
             # Statistics
@@ -1488,17 +1962,16 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
                 else:
                     return ['background-color: #E8F5E9'] * len(row)
             
-            styled_df = comparison_df.style.apply(highlight_mismatches, axis=1)
+            display_comparison_df = comparison_df.drop(columns=['_ns_row', '_sf_row'])
+            styled_df = display_comparison_df.style.apply(highlight_mismatches, axis=1)
             st.dataframe(styled_df, use_container_width=True, height=400)
             
-            # Download comparison
-            csv = comparison_df.to_csv(index=False).encode('utf-8')
-            st.download_button(
+            # Download comparison (encoded only when clicked)
+            export_download_button(
                 "📥 Download Detailed Comparison",
-                csv,
-                file_name=f"{drill_field}_comparison_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                mime="text/csv",
-                use_container_width=True
+                lambda: display_comparison_df,
+                f"{drill_field}_comparison_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
+                key="download_drill_comparison"
             )
             
             # Show sample mismatches for quick review
@@ -1520,6 +1993,35 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
                             st.warning("⚠️ NetSuite value is empty")
                         if str(row['Salesforce']).strip() == '':
                             st.warning("⚠️ Salesforce value is empty")
+                        
+                        # Every column of both records, fetched by row position only for the records shown
+                        st.markdown("**Full Records:**")
+                        st.dataframe(
+                            side_by_side_record(filtered_ns, filtered_sf, row['_ns_row'], row['_sf_row']),
+                            use_container_width=True
+                        )
+            
+            # Top value transformations: group the field's mismatched (NetSuite, Salesforce) pairs
+            value_patterns = None
+            if mismatches > 0 and drill_field in mismatch_bitmap["fields"]:
+                drill_mask = field_mismatches(mismatch_bitmap, drill_field)
+                if drill_mask.any():
+                    st.markdown("### 🔁 Top Value Transformations")
+                    st.caption("How NetSuite values were rewritten in Salesforce, most frequent first")
+                    value_patterns = transformation_patterns(
+                        merged_df[f"{drill_field}_NS"][drill_mask],
+                        merged_df[f"{drill_field}_SF"][drill_mask],
+                        top_k=10
+                    )
+                    if drill_mask.sum() > PATTERN_EXACT_LIMIT:
+                        st.caption("Counted with a streaming Count-Min sketch: counts are upper-bound estimates")
+                    top_share = value_patterns["Share (%)"].head(3).sum()
+                    st.info(f"ℹ️ The top 3 patterns explain {top_share:.1f}% of {drill_field} mismatches")
+                    st.dataframe(
+                        value_patterns.style.format({"Share (%)": "{:.1f}"}),
+                        use_container_width=True,
+                        hide_index=True
+                    )
             
             # Quick Fixes Generator - Actionable Solutions!
             if mismatches > 0:
@@ -1527,29 +2029,124 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
                 st.markdown("### 🛠️ Quick Fix Generator")
                 st.caption("Auto-generated code to resolve mismatches - copy and use directly!")
                 
-                fix_tab1, fix_tab2 = st.tabs(["📝 SQL Updates", "🔌 API Calls"])
+                fix_tab1, fix_tab2, fix_tab3 = st.tabs(["📝 SQL Updates", "🔌 API Calls", "🔁 Bulk Fixes by Pattern"])
+                
+                # Key-addressed fixes for every mismatch, generated batch by batch when a download is clicked
+                fix_scope = st.radio(
+                    "Fix scope:",
+                    [f"{drill_field} only", "All compared fields"],
+                    horizontal=True,
+                    key="fix_scope"
+                )
+                fix_fields = [f for f in mismatch_bitmap["fields"] if fix_scope == "All compared fields" or f == drill_field]
+                fix_totals = field_mismatch_totals(mismatch_bitmap).reindex(fix_fields, fill_value=0)
+                fix_fields = [f for f in fix_fields if fix_totals[f] > 0]
+                fix_file_stem = f"fix_{drill_field if fix_scope != 'All compared fields' else 'all_fields'}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
                 
                 with fix_tab1:
-                    sql_fixes = generate_sql_fixes(comparison_df[comparison_df['Status'] == '❌ Mismatch'], drill_field)
-                    st.code(sql_fixes, language="sql")
-                    st.download_button(
-                        "📥 Download SQL Script",
-                        sql_fixes,
-                        file_name=f"fix_{drill_field}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.sql",
-                        mime="text/plain",
-                        use_container_width=True
-                    )
+                    if fix_fields:
+                        st.caption(f"{int(fix_totals.sum()):,} records addressed by {merge_key}, in UPDATE ... CASE batches of {FIX_BATCH_ROWS}")
+                        preview_fixes = fix_frame(merged_df, filtered_ns, fix_fields[0], mismatch_bitmap, key_columns).head(5)
+                        st.code(next(sql_fix_statements(preview_fixes, fix_fields[0], key_columns)), language="sql")
+                        st.download_button(
+                            "📥 Download SQL Script (.sql.gz)",
+                            data=lambda: compress_stream(generate_fixes(merged_df, filtered_ns, fix_fields, mismatch_bitmap, key_columns, "sql")),
+                            file_name=f"{fix_file_stem}.sql.gz",
+                            mime="application/gzip",
+                            on_click="ignore",
+                            use_container_width=True
+                        )
+                    else:
+                        st.info("No field-level mismatches to fix")
                 
                 with fix_tab2:
-                    api_fixes = generate_api_fixes(comparison_df[comparison_df['Status'] == '❌ Mismatch'], drill_field)
-                    st.code(api_fixes, language="json")
-                    st.download_button(
-                        "📥 Download API Template",
-                        api_fixes,
-                        file_name=f"api_fix_{drill_field}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
-                        mime="application/json",
-                        use_container_width=True
-                    )
+                    if fix_fields:
+                        st.caption(f"One bulk-update payload per line (NDJSON), {API_BATCH_ROWS} records each")
+                        st.code(next(api_fix_payloads(preview_fixes, fix_fields[0], key_columns)), language="json")
+                        st.download_button(
+                            "📥 Download API Payloads (.ndjson.gz)",
+                            data=lambda: compress_stream(generate_fixes(merged_df, filtered_ns, fix_fields, mismatch_bitmap, key_columns, "ndjson")),
+                            file_name=f"api_{fix_file_stem}.ndjson.gz",
+                            mime="application/gzip",
+                            on_click="ignore",
+                            use_container_width=True
+                        )
+                    else:
+                        st.info("No field-level mismatches to fix")
+                
+                with fix_tab3:
+                    if value_patterns is not None and len(value_patterns) > 0:
+                        st.caption(f"One UPDATE per transformation pattern, setting the Salesforce value on the records with that pattern - addressed by {merge_key}, never by the old value")
+                        pattern_fixes = fix_frame(merged_df, filtered_ns, drill_field, mismatch_bitmap, key_columns)
+                        # Preview: the top pattern's first statement, five records long
+                        st.code("".join(islice(pattern_fix_statements(pattern_fixes, value_patterns.head(1), drill_field, key_columns, batch_rows=5), 2)), language="sql")
+                        st.download_button(
+                            "📥 Download Bulk SQL Script (.sql.gz)",
+                            data=lambda: compress_stream(pattern_fix_statements(pattern_fixes, value_patterns, drill_field, key_columns)),
+                            file_name=f"bulk_fix_{drill_field}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.sql.gz",
+                            mime="application/gzip",
+                            on_click="ignore",
+                            use_container_width=True
+                        )
+                    else:
+                        st.info("No transformation patterns for this field")
+        
+        st.markdown("---")
+        
+        # Multi-field filter: bitwise AND/OR over the per-field mismatch bitmaps
+        st.subheader("🧮 Multi-Field Mismatch Filter")
+        st.caption("Find records (present in both systems) that mismatch on several fields at once")
+        bitmap_fields = st.multiselect(
+            "Mismatching fields:",
+            mismatch_bitmap["fields"],
+            default=mismatch_bitmap["fields"][:2],
+            key="bitmap_filter_fields"
+        )
+        bitmap_mode = st.radio(
+            "Records mismatching on:",
+            ["All selected fields (AND)", "Any selected field (OR)"],
+            horizontal=True,
+            key="bitmap_filter_mode"
+        )
+        if bitmap_fields:
+            hit_rows = np.flatnonzero(filter_mismatches(mismatch_bitmap, bitmap_fields, require_all=(bitmap_mode == "All selected fields (AND)")))
+            record_mismatch_counts = count_record_mismatches(mismatch_bitmap)
+            compared_records = int(mismatch_bitmap["in_both"].sum())
+            bitmap_cols = st.columns(3)
+            with bitmap_cols[0]:
+                st.metric("Matching Records", f"{len(hit_rows):,}")
+            with bitmap_cols[1]:
+                st.metric("Share of Compared", f"{(len(hit_rows) / compared_records * 100) if compared_records > 0 else 0:.1f}%")
+            with bitmap_cols[2]:
+                st.metric("Records with Any Mismatch", f"{int((record_mismatch_counts > 0).sum()):,}")
+            
+            if len(hit_rows) > 0:
+                shown_rows = hit_rows[:1000]
+                # Names of every mismatched field, unpacked only for the records shown
+                shown_bits = np.unpackbits(mismatch_bitmap["by_record"][shown_rows], axis=1, count=len(mismatch_bitmap["fields"])).astype(bool)
+                field_names = np.array(mismatch_bitmap["fields"], dtype=object)
+                hits_df = pd.DataFrame({
+                    "Match Key": merged_df[key_display_col].to_numpy()[shown_rows],
+                    "Mismatched Fields": record_mismatch_counts[shown_rows],
+                    "Fields": [", ".join(field_names[bits]) for bits in shown_bits],
+                })
+                for field in bitmap_fields:
+                    hits_df[f"{field} (NS)"] = merged_df[f"{field}_NS"].to_numpy()[shown_rows]
+                    hits_df[f"{field} (SF)"] = merged_df[f"{field}_SF"].to_numpy()[shown_rows]
+                if len(hit_rows) > len(shown_rows):
+                    st.caption(f"Showing the first {len(shown_rows):,} of {len(hit_rows):,} records")
+                st.dataframe(hits_df, use_container_width=True, hide_index=True)
+        
+        with st.expander("🔗 Mismatch Co-occurrence"):
+            st.caption("Records mismatching on both fields of each pair (diagonal: all mismatches of a field)")
+            if mismatch_bitmap["fields"]:
+                cooccurrence = mismatch_cooccurrence(mismatch_bitmap)
+                fig_cooc = px.imshow(cooccurrence, text_auto=True, color_continuous_scale="Reds", aspect="auto",
+                                     labels=dict(x="Field", y="Field", color="Records"))
+                st.plotly_chart(fig_cooc, use_container_width=True, key="plotly_chart_mismatch_cooccurrence")
+                per_record = pd.Series(count_record_mismatches(mismatch_bitmap)[mismatch_bitmap["in_both"]]).value_counts().sort_index()
+                st.markdown("**Records by number of mismatched fields:**")
+                st.bar_chart(per_record.rename("Records"))
         
         st.markdown("---")
         
@@ -1693,8 +2290,8 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
         if selected_field and selected_field in filtered_ns.columns:
             # Calculate field-level metrics
             total_records = len(filtered_ns[selected_field])
-            null_count = filtered_ns[selected_field].isnull().sum()
-            duplicate_count = filtered_ns[selected_field].duplicated().sum()
+            null_count = column_catalog["NetSuite"].loc[selected_field, "Nulls"]
+            duplicate_count = column_catalog["NetSuite"].loc[selected_field, "Duplicates"]
             
             if selected_field in filtered_sf.columns:
                 # Reset indices to ensure alignment for comparison
@@ -1829,21 +2426,19 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
     # ------------------------- 
     # Tab 3: Trend
     # -------------------------
-    with tab3:
+    with tab3, profile_stage(run_profile, "Render Trend tab"):
         st.header("Trend Analysis")
 
         # 2. Field-level match rate comparison (bar chart) - moved outside date_cols check
         st.subheader("Field Match Rate Comparison")
-        field_match_data = []
-        for col in selected_primary + selected_secondary[:5]:  # Top fields
-            if col in filtered_ns.columns and col in filtered_sf.columns:
-                ns_vals = filtered_ns[col].reset_index(drop=True).astype(str)
-                sf_vals = filtered_sf[col].reset_index(drop=True).astype(str)
-                min_len = min(len(ns_vals), len(sf_vals))
-                match_count = (ns_vals[:min_len] == sf_vals[:min_len]).sum() if min_len > 0 else 0
-                total_count = len(filtered_ns[col])
-                match_rate = (match_count / total_count * 100) if total_count > 0 else 0
-                field_match_data.append({"Field": col, "Match Rate (%)": match_rate})
+        # Per-field status counts from the rollup cube (records aligned by match key)
+        trend_fields = [col for col in selected_primary + selected_secondary[:5] if col in rollup_fields]  # Top fields
+        field_status = rollup(rollup_cube, "Field", trend_fields).reindex(trend_fields, fill_value=0)
+        field_totals = field_status.sum(axis=1)
+        field_match_data = [
+            {"Field": col, "Match Rate (%)": (field_status.loc[col, "Match"] / field_totals[col] * 100) if field_totals[col] > 0 else 0}
+            for col in trend_fields
+        ]
         
         if field_match_data:
             field_match_df = pd.DataFrame(field_match_data)
@@ -1863,21 +2458,14 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
         heatmap_data = []
         for col in selected_primary + selected_secondary[:5]:
             if col in filtered_ns.columns:
-                nulls = filtered_ns[col].isnull().sum()
-                duplicates = filtered_ns[col].duplicated().sum()
-                if col in filtered_sf.columns:
-                    ns_vals = filtered_ns[col].reset_index(drop=True).astype(str)
-                    sf_vals = filtered_sf[col].reset_index(drop=True).astype(str)
-                    min_len = min(len(ns_vals), len(sf_vals))
-                    matches = (ns_vals[:min_len] == sf_vals[:min_len]).sum() if min_len > 0 else 0
-                else:
-                    matches = 0
+                nulls = column_catalog["NetSuite"].loc[col, "Nulls"]
+                duplicates = column_catalog["NetSuite"].loc[col, "Duplicates"]
                 total = len(filtered_ns[col])
                 heatmap_data.append({
                     "Field": col,
                     "Null Rate (%)": (nulls / total * 100) if total > 0 else 0,
                     "Duplicate Rate (%)": (duplicates / total * 100) if total > 0 else 0,
-                    "Match Rate (%)": (matches / total * 100) if total > 0 else 0
+                    "Match Rate (%)": (field_status.loc[col, "Match"] / field_totals[col] * 100) if col in trend_fields and field_totals[col] > 0 else 0
                 })
         
         if heatmap_data:
@@ -1902,21 +2490,12 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
                 st.write("**Available columns:**", list(filtered_ns.columns))
 
         if date_cols and date_col:
-            # 1. Monthly match vs mismatch (stacked bar)
-            merged_month = merged_df.copy()
-            if date_col in merged_month.columns:
-                # Ensure date column is datetime type
-                merged_month[date_col] = pd.to_datetime(merged_month[date_col], errors="coerce")
-                # Remove rows with invalid dates
-                merged_month = merged_month[merged_month[date_col].notna()]
-                if len(merged_month) > 0:
-                    merged_month["Month"] = merged_month[date_col].dt.to_period("M").astype(str)
-                    match_mask = merged_month["_merge"] == "both"
-                    mismatch_mask = (merged_month["_merge"] == "left_only") | (merged_month["_merge"] == "right_only")
-                    match_month = merged_month[match_mask].groupby("Month").size().reset_index(name="Match")
-                    mismatch_month = merged_month[mismatch_mask].groupby("Month").size().reset_index(name="Mismatch")
-                    match_mismatch = pd.merge(match_month, mismatch_month, on="Month", how="outer").fillna(0)
-                    match_mismatch = match_mismatch.sort_values("Month")
+            # 1. Monthly match vs mismatch (stacked bar), from the rollup cube (undated records are left out)
+            if "Month" in rollup_cube.columns:
+                match_mismatch = rollup(rollup_cube, "Month").reset_index()
+                match_mismatch["Mismatch"] = match_mismatch["NS Only"] + match_mismatch["SF Only"]
+                match_mismatch = match_mismatch.sort_values("Month")
+                if len(match_mismatch) > 0:
                     fig_mm = go.Figure()
                     fig_mm.add_trace(go.Bar(x=match_mismatch["Month"], y=match_mismatch["Match"], name="Match", marker_color="#4CAF50"))
                     fig_mm.add_trace(go.Bar(x=match_mismatch["Month"], y=match_mismatch["Mismatch"], name="Mismatch", marker_color="#FF7043"))
@@ -1926,38 +2505,27 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
                                         font_color='white' if theme == 'Dark' else 'black')
                     st.plotly_chart(fig_mm, use_container_width=True, key="plotly_chart_trend_matchmismatch_tab3")
 
-            # 4. Cumulative match rate trend
-            if date_col in merged_df.columns:
+            # 4. Cumulative match rate trend: running totals over the monthly counts
+            if "Month" in rollup_cube.columns and len(match_mismatch) > 0:
                 st.subheader("Cumulative Match Rate Over Time")
-                merged_cumulative = merged_df.copy()
-                # Ensure date column is datetime type
-                merged_cumulative[date_col] = pd.to_datetime(merged_cumulative[date_col], errors="coerce")
-                # Remove rows with invalid dates
-                merged_cumulative = merged_cumulative[merged_cumulative[date_col].notna()]
-                if len(merged_cumulative) > 0:
-                    merged_cumulative = merged_cumulative.sort_values(date_col)
-                    merged_cumulative["is_match"] = merged_cumulative["_merge"] == "both"
-                    merged_cumulative["cum_match"] = merged_cumulative["is_match"].cumsum()
-                    merged_cumulative["cum_total"] = range(1, len(merged_cumulative) + 1)
-                    merged_cumulative["cum_rate"] = merged_cumulative["cum_match"] / merged_cumulative["cum_total"]
-                    merged_cumulative["Month"] = merged_cumulative[date_col].dt.to_period("M").astype(str)
-                    cum_month = merged_cumulative.groupby("Month").agg({"cum_rate": "max"}).reset_index()
-                    fig_cum = px.line(cum_month, x="Month", y="cum_rate", 
-                                     title="Cumulative Match Rate Trend",
-                                     labels={"cum_rate": "Cumulative Match Rate"},
-                                     markers=True)
-                    fig_cum.update_layout(paper_bgcolor='white' if theme == 'Light' else '#121212',
-                                         plot_bgcolor='white' if theme == 'Light' else '#121212',
-                                         font_color='white' if theme == 'Dark' else 'black')
-                    st.plotly_chart(fig_cum, use_container_width=True, key="plotly_chart_trend_cumrate_tab3")
+                cum_month = match_mismatch[["Month"]].copy()
+                cum_month["cum_rate"] = match_mismatch["Match"].cumsum() / (match_mismatch["Match"] + match_mismatch["Mismatch"]).cumsum()
+                fig_cum = px.line(cum_month, x="Month", y="cum_rate", 
+                                 title="Cumulative Match Rate Trend",
+                                 labels={"cum_rate": "Cumulative Match Rate"},
+                                 markers=True)
+                fig_cum.update_layout(paper_bgcolor='white' if theme == 'Light' else '#121212',
+                                     plot_bgcolor='white' if theme == 'Light' else '#121212',
+                                     font_color='white' if theme == 'Dark' else 'black')
+                st.plotly_chart(fig_cum, use_container_width=True, key="plotly_chart_trend_cumrate_tab3")
         else:
             st.info("No date columns available for time-based trend analysis.")
 
         # 5. Top 10 accounts/entities with most mismatches
-        if account_col and account_col in merged_df.columns:
+        if account_col and "Account" in rollup_cube.columns:
             st.subheader("Top Accounts with Mismatches")
-            mismatch_mask = (merged_df["_merge"] == "left_only") | (merged_df["_merge"] == "right_only")
-            mismatch_accounts = merged_df[mismatch_mask][account_col].value_counts().nlargest(10).reset_index()
+            account_status = rollup(rollup_cube, "Account")
+            mismatch_accounts = (account_status["NS Only"] + account_status["SF Only"]).nlargest(10).reset_index()
             mismatch_accounts.columns = [account_col, "Mismatch Count"]
             fig_acc = px.bar(mismatch_accounts, x=account_col, y="Mismatch Count", 
                             title="Top 10 Accounts with Most Mismatches",
@@ -1971,31 +2539,28 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
     # -------------------------
     # Tab 4: Advanced Check
     # -------------------------
-    with tab4:
+    with tab4, profile_stage(run_profile, "Render Advanced Check tab"):
         st.header("Advanced Data Quality Checks")
         
-        # Calculate summary metrics for all checks
-        checks = []
-        total_nulls = 0
-        total_duplicates = 0
-        total_negatives = 0
-        total_empties = 0
-        
-        for col in filtered_ns.columns:
-            nulls = filtered_ns[col].isnull().sum()
-            duplicates = filtered_ns[col].duplicated().sum()
-            negatives = (filtered_ns[col] < 0).sum() if pd.api.types.is_numeric_dtype(filtered_ns[col]) else 0
-            empties = (filtered_ns[col] == "").sum()
-            checks.append([col, nulls, duplicates, negatives, empties])
-            total_nulls += nulls
-            total_duplicates += duplicates
-            total_negatives += negatives
-            total_empties += empties
+        # Summary metrics come from the column statistics catalog (profiled once for both systems)
+        check_system = st.radio(
+            "System:",
+            ["Both", "NetSuite", "Salesforce"],
+            horizontal=True,
+            key="advanced_check_system"
+        )
+        check_profiles = [profile.reset_index().assign(System=system) for system, profile in column_catalog.items()
+                          if check_system in ("Both", system)]
+        check_df = pd.concat(check_profiles, ignore_index=True)
+        total_nulls = check_df["Nulls"].sum()
+        total_duplicates = check_df["Duplicates"].sum()
+        total_negatives = check_df["Negatives"].sum()
+        total_empties = check_df["Empty Strings"].sum()
         
         # Display summary donut chart at the top
         st.subheader("Data Quality Issues Summary")
         total_issues = total_nulls + total_duplicates + total_negatives + total_empties
-        total_cells = filtered_ns.shape[0] * filtered_ns.shape[1]
+        total_cells = check_df["Rows"].sum()
         clean_records = total_cells - total_issues
         
         summary_data = pd.DataFrame({
@@ -2046,7 +2611,10 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
         
         # Detailed checks table
         st.subheader("Field-Level Quality Checks")
-        check_df = pd.DataFrame(checks, columns=["Field", "Nulls", "Duplicates", "Negatives", "Empty Strings"])
+        check_df = check_df[["System", "Field", "Nulls", "Duplicates", "Negatives", "Empty Strings", "Cardinality", "Min", "Max"]]
+        # Min/Max mix numbers, dates and text across fields - show them as text
+        check_df["Min"] = check_df["Min"].astype(str)
+        check_df["Max"] = check_df["Max"].astype(str)
         
         # Highlight non-zero values
         def highlight_nonzero(val):
@@ -2054,66 +2622,193 @@ if netsuite_file and salesforce_file and (compare_button or st.session_state.get
                 return 'background-color: #FF7043; color: white'
             return ''
         
-        styled_df = check_df.style.applymap(highlight_nonzero, subset=["Nulls", "Duplicates", "Negatives", "Empty Strings"])
+        styled_df = check_df.style.map(highlight_nonzero, subset=["Nulls", "Duplicates", "Negatives", "Empty Strings"])
         st.dataframe(styled_df, use_container_width=True)
         
         # Orphan Records Section
         st.subheader("Orphan Records Analysis")
         
+        # Orphans are two arrays of original row positions (kept with the comparison result), not slices
+        # of the merged frame; pages and downloads are fetched from the source frames with that system's own columns
         # NetSuite Orphans (records in NetSuite but not in Salesforce)
-        netsuite_orphans = merged_df[merged_df["_merge"] == "left_only"]
-        with st.expander(f"🔴 NetSuite Orphans ({len(netsuite_orphans)} records)"):
-            if len(netsuite_orphans) > 0:
-                st.info(f"Records present in NetSuite but missing in Salesforce: {len(netsuite_orphans)}")
-                # Show only columns from the original NetSuite data (ending with _x)
-                ns_cols = [col for col in netsuite_orphans.columns if col.endswith("_x") or col == merge_key]
-                if ns_cols:
-                    display_orphans_ns = netsuite_orphans[ns_cols].copy()
-                    # Remove _x suffix for cleaner display
-                    display_orphans_ns.columns = [col.replace("_x", "") for col in display_orphans_ns.columns]
-                    st.dataframe(display_orphans_ns, use_container_width=True)
-                else:
-                    st.dataframe(netsuite_orphans.drop(columns=["_merge"], errors="ignore"), use_container_width=True)
+        with st.expander(f"🔴 NetSuite Orphans ({len(orphans['ns'])} records)"):
+            if len(orphans["ns"]) > 0:
+                st.info(f"Records present in NetSuite but missing in Salesforce: {len(orphans['ns'])}")
+                show_record_page(filtered_ns, orphans["ns"], key="ns_orphan_page")
                 
                 # Download button
-                csv = display_orphans_ns.to_csv(index=False) if ns_cols else netsuite_orphans.to_csv(index=False)
-                st.download_button(
-                    label="📥 Download NetSuite Orphans",
-                    data=csv,
-                    file_name="netsuite_orphans.csv",
-                    mime="text/csv",
-                    key="download_ns_orphans"
-                )
+                export_download_button("📥 Download NetSuite Orphans", lambda: fetch_records(filtered_ns, orphans["ns"]), "netsuite_orphans", key="download_ns_orphans")
             else:
                 st.success("No orphan records found in NetSuite!")
         
         # Salesforce Orphans (records in Salesforce but not in NetSuite)
-        salesforce_orphans = merged_df[merged_df["_merge"] == "right_only"]
-        with st.expander(f"🔵 Salesforce Orphans ({len(salesforce_orphans)} records)"):
-            if len(salesforce_orphans) > 0:
-                st.info(f"Records present in Salesforce but missing in NetSuite: {len(salesforce_orphans)}")
-                # Show only columns from the original Salesforce data (ending with _y)
-                sf_cols = [col for col in salesforce_orphans.columns if col.endswith("_y") or col == merge_key]
-                if sf_cols:
-                    display_orphans_sf = salesforce_orphans[sf_cols].copy()
-                    # Remove _y suffix for cleaner display
-                    display_orphans_sf.columns = [col.replace("_y", "") for col in display_orphans_sf.columns]
-                    st.dataframe(display_orphans_sf, use_container_width=True)
-                else:
-                    st.dataframe(salesforce_orphans.drop(columns=["_merge"], errors="ignore"), use_container_width=True)
+        with st.expander(f"🔵 Salesforce Orphans ({len(orphans['sf'])} records)"):
+            if len(orphans["sf"]) > 0:
+                st.info(f"Records present in Salesforce but missing in NetSuite: {len(orphans['sf'])}")
+                show_record_page(filtered_sf, orphans["sf"], key="sf_orphan_page")
                 
                 # Download button
-                csv = display_orphans_sf.to_csv(index=False) if sf_cols else salesforce_orphans.to_csv(index=False)
-                st.download_button(
-                    label="📥 Download Salesforce Orphans",
-                    data=csv,
-                    file_name="salesforce_orphans.csv",
-                    mime="text/csv",
-                    key="download_sf_orphans"
-                )
+                export_download_button("📥 Download Salesforce Orphans", lambda: fetch_records(filtered_sf, orphans["sf"]), "salesforce_orphans", key="download_sf_orphans")
             else:
                 st.success("No orphan records found in Salesforce!")
 
+        # Fuzzy reconciliation: most orphans are the same record under a typo'd or reformatted key
+        if len(orphans["ns"]) > 0 and len(orphans["sf"]) > 0:
+            with st.expander("🧩 Suggested Orphan Pairs"):
+                st.caption(f"NS-only and SF-only records whose **{merge_key}** looks like the same record (typos, reformatting), scored by key similarity and agreement on the selected fields")
+                pair_fields = [f for f in selected_fields if f not in key_columns and f"{f}_NS" in merged_df.columns and f"{f}_SF" in merged_df.columns]
+                block_by_account = False
+                if account_col and account_col in pair_fields:
+                    block_by_account = st.checkbox(f"Only pair orphans with the same {account_col}", value=False, key="orphan_pair_block")
+                min_pair_score = st.slider("Minimum score", min_value=0.5, max_value=1.0, value=0.7, step=0.05, key="orphan_pair_min_score")
+
+                # The comparison's signature covers the data, filters, mapping and key the orphans come from
+                pair_signature = (comparison_signature, tuple(pair_fields), block_by_account, min_pair_score)
+                if st.button("🔗 Find Likely Pairs", key="find_orphan_pairs"):
+                    def orphan_side(source, positions):
+                        side = fetch_records(source, positions, list(dict.fromkeys(key_columns + pair_fields))).reset_index(drop=True)
+                        if composite_key:
+                            side[merge_key] = key_labels(side, key_columns)
+                        return side[[merge_key] + pair_fields]
+                    ns_side = orphan_side(filtered_ns, orphans["ns"])
+                    sf_side = orphan_side(filtered_sf, orphans["sf"])
+                    start_time = time.time()
+                    st.session_state['orphan_pairs'] = (pair_signature, propose_orphan_pairs(
+                        ns_side, sf_side, merge_key, pair_fields,
+                        block_col=account_col if block_by_account else None,
+                        min_score=min_pair_score
+                    ), time.time() - start_time)
+
+                stored_pairs = st.session_state.get('orphan_pairs')
+                if stored_pairs and stored_pairs[0] == pair_signature:
+                    _, orphan_pairs, pair_seconds = stored_pairs
+                    paired_pct = len(orphan_pairs) / min(len(orphans["ns"]), len(orphans["sf"])) * 100
+                    st.info(f"Proposed {len(orphan_pairs):,} pairs ({paired_pct:.1f}% of the smaller orphan side) in {pair_seconds:.2f}s")
+                    display_pairs = orphan_pairs.drop(columns=["ns_pos", "sf_pos"])
+                    st.dataframe(display_pairs.head(1000), use_container_width=True)
+                    export_download_button("📥 Download Suggested Pairs", lambda: display_pairs, "suggested_orphan_pairs", key="download_orphan_pairs")
+
+        # Multi-sheet reconciliation workbook, streamed row by row into a write-only XLSX on click
+        st.subheader("📦 Reconciliation Workbook")
+        st.caption("Summary, one diff sheet per mismatched field and both orphan lists in a single Excel file. Built when you click download; large sheets take a while")
+        mismatch_totals = field_mismatch_totals(mismatch_bitmap)
+
+        def build_reconciliation_workbook():
+            summary = pd.DataFrame({
+                "Metric": ["Match key", "NetSuite records", "Salesforce records", "Matched records", "NetSuite orphans", "Salesforce orphans"]
+                          + [f"Mismatches: {field}" for field in mismatch_totals.index],
+                "Value": [merge_key, len(filtered_ns), len(filtered_sf), int(total_match), len(orphans["ns"]), len(orphans["sf"])]
+                         + mismatch_totals.tolist()
+            })
+            sheets = {"Summary": summary}
+            for field, count in mismatch_totals.items():
+                if count > 0:
+                    diffs = fix_frame(merged_df, filtered_ns, field, mismatch_bitmap, key_columns)
+                    sheets[f"Diff - {field}"] = diffs.rename(columns={"old_value": f"{field} (NetSuite)", "new_value": f"{field} (Salesforce)"})
+            sheets["NetSuite Orphans"] = fetch_records(filtered_ns, orphans["ns"])
+            sheets["Salesforce Orphans"] = fetch_records(filtered_sf, orphans["sf"])
+            return reconciliation_workbook(sheets)[0]
+
+        st.download_button(
+            "📥 Download Reconciliation Workbook (.xlsx)",
+            data=build_reconciliation_workbook,
+            file_name=f"reconciliation_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            key="download_reconciliation_workbook",
+            on_click="ignore",
+            use_container_width=True
+        )
+        sheet_rows = {f"Diff - {field}": count for field, count in mismatch_totals.items()}
+        sheet_rows.update({"NetSuite Orphans": len(orphans["ns"]), "Salesforce Orphans": len(orphans["sf"])})
+        truncated_sheets = [name for name, rows in sheet_rows.items() if rows > EXCEL_MAX_ROWS]
+        if truncated_sheets:
+            st.warning(f"⚠️ Sheets over Excel's row limit will be cut at {EXCEL_MAX_ROWS:,} rows: {', '.join(truncated_sheets)}")
+
+        # Partitioned comparison: the same comparison split by month (or another column), run in parallel
+        # worker processes and checkpointed per partition, so a re-run only recomputes what changed
+        st.subheader("🧩 Partitioned Comparison")
+        st.caption(f"Compares the data partition by partition and saves each finished partition to disk. Re-running after a crash or with updated files only recomputes partitions that are missing or changed. Records stay in their {merge_key}'s partition even if their dates differ between systems")
+        partition_options = ([date_col] if date_col else []) + [c for c in all_fields if c != date_col and c not in key_columns]
+        if partition_options:
+            partition_col = st.selectbox(
+                "Partition by:",
+                partition_options,
+                format_func=lambda c: f"{c} (month)" if c == date_col else c,
+                key="partition_col"
+            )
+            partition_signature = ("partitioned", comparison_signature, partition_col)
+            if st.button("▶️ Run Partitioned Comparison", key="run_partitioned_comparison"):
+                st.session_state['partitioned_signature'] = partition_signature
+            if st.session_state.get('partitioned_signature') == partition_signature:
+                partitioned = background_result(
+                    partition_signature, "Comparing partitions", run_partitioned_comparison,
+                    filtered_ns, filtered_sf, key_columns, all_fields, selected_fields,
+                    partition_col, "month" if partition_col == date_col else None, join_strategy,
+                    (netsuite_file.name, salesforce_file.name)
+                )
+                part_cols = st.columns(4)
+                with part_cols[0]:
+                    st.metric("Partitions", f"{len(partitioned['partitions']):,}")
+                with part_cols[1]:
+                    st.metric("Restored from Checkpoints", f"{partitioned['reused']:,}")
+                with part_cols[2]:
+                    st.metric("Computed", f"{partitioned['computed']:,}")
+                with part_cols[3]:
+                    st.metric("Time", f"{partitioned['seconds']:.1f}s")
+                partition_totals = partitioned["totals"]
+                if partition_totals and partition_totals["Matched"] == total_match:
+                    st.success(f"✅ Combined: {partition_totals['Matched']:,} matched, {partition_totals['NS Only']:,} NS only, {partition_totals['SF Only']:,} SF only, {partition_totals['Mismatched Values']:,} mismatched values - consistent with the full comparison")
+                elif partition_totals:
+                    st.warning(f"⚠️ Combined: {partition_totals['Matched']:,} matched vs {total_match:,} in the full comparison (repeated keys spanning partitions are paired within each partition)")
+                st.dataframe(partitioned["partitions"], use_container_width=True, hide_index=True)
+
+    # -------------------------
+    # Run Performance (Admin Mode)
+    # -------------------------
+    if is_admin_mode:
+        with st.expander("⏱️ Run Performance", expanded=False):
+            st.checkbox(
+                "Trace memory allocations",
+                key="profile_trace_memory",
+                on_change=lambda: set_memory_tracing(st.session_state["profile_trace_memory"]),
+                help="Adds the process's peak and retained memory (tracemalloc) while each operation ran - other sessions' allocations are included. Applies to the whole server and slows allocation-heavy stages while on"
+            )
+            operations = operation_timeline(run_profile)
+            st.caption(f"This rerun: {len(operations)} operations in {time.perf_counter() - run_profile['started']:.2f}s. Tab render times include the stats, charts and exports drawn in them")
+            if len(operations) > 0:
+                fig_timeline = px.bar(
+                    operations, x="Seconds", y="Operation", base="Start (s)", orientation="h",
+                    hover_data=["CPU Seconds", "Rows/s", "Process Peak (MB)"],
+                    category_orders={"Operation": list(dict.fromkeys(operations["Operation"]))},
+                    title="Operation Timeline"
+                )
+                fig_timeline.update_layout(xaxis_title="Seconds since the rerun started", height=120 + 28 * operations["Operation"].nunique())
+                st.plotly_chart(fig_timeline, use_container_width=True, key="plotly_chart_run_timeline")
+
+                memory_series = [col for col in ("RSS (MB)", "Traced (MB)") if operations[col].notna().any()]
+                if memory_series:
+                    fig_memory = px.line(operations.sort_values("End (s)"), x="End (s)", y=memory_series, markers=True,
+                                         hover_data=["Operation"], title="Memory Timeline")
+                    fig_memory.update_layout(xaxis_title="Seconds since the rerun started", yaxis_title="MB")
+                    st.plotly_chart(fig_memory, use_container_width=True, key="plotly_chart_memory_timeline")
+                if operations["Process Peak (MB)"].isna().all():
+                    st.caption("💡 Turn on memory tracing above for the process's peak and retained memory during each operation")
+
+                st.session_state.setdefault('profile_top_n', 5)
+                top_n = st.number_input("Slowest operations to list", min_value=1, max_value=20, step=1, key="profile_top_n")
+                st.dataframe(
+                    slowest_operations(run_profile, top_n).drop(columns=["Depth", "Start (s)", "End (s)"]),
+                    use_container_width=True,
+                    hide_index=True
+                )
+            if merge_job_seconds:
+                st.markdown("**Background comparison job** (timed in its worker when it ran; cached results skip it)")
+                st.dataframe(
+                    pd.DataFrame({"Stage": list(merge_job_seconds), "Seconds": list(merge_job_seconds.values())}),
+                    use_container_width=True,
+                    hide_index=True
+                )
+
 elif netsuite_file and salesforce_file and not compare_button and not st.session_state.get('comparison_triggered', False):
     st.info("👈 Click the '🔍 Compare Data' button in the sidebar to start the analysis.")
 elif not netsuite_file or not salesforce_file:
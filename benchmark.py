@@ -0,0 +1,282 @@
+"""Synthetic NetSuite/Salesforce workloads and a stage-level benchmark of the comparison pipeline.
+
+    python benchmark.py generate --rows 100000 --out bench_data
+    python benchmark.py run --rows 10000 100000 1000000
+    python benchmark.py report
+
+Every run appends the wall time, CPU time and peak memory of each stage to
+benchmark_history.jsonl, tagged with the git version, so `report` shows what got
+slower between versions. The comparison's internal stages also calibrate the
+app's Explain step (see integrity_engine.stage_rates).
+"""
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from integrity_engine import (
+    enable_copy_on_write, optimize_dtypes, parse_date_columns, values_match, run_comparison, build_column_catalog,
+    field_mismatches, transformation_patterns, fetch_records, record_page, export_table, reconciliation_workbook,
+    record_stage_timings, memory_kb, reset_peak_memory, TABLE_EXPORT_FORMATS, EXCEL_MAX_ROWS, BENCHMARK_HISTORY, STRATEGY_ALL_PAIRS, MERGE_ROW_BUDGET
+)
+
+enable_copy_on_write()
+
+# -------------------------
+# Workload Generator
+# -------------------------
+NS_COLUMNS = ["Document Number", "Line Number", "Account Name", "Order Date", "Status", "Amount", "Currency", "Memo"]
+SF_COLUMNS = ["Opportunity Number", "Line Item", "Account", "Close Date", "Stage", "Total Amount", "Currency Code", "Description"]
+STATUSES = np.array(["Pending Approval", "Pending Fulfillment", "Billed", "Closed", "Cancelled"])
+CURRENCIES = np.array(["USD", "EUR", "GBP", "CAD"])
+
+# How Salesforce differs from NetSuite on a mismatched record, per NetSuite column
+MISMATCH_CHANGES = {
+    "Account Name": lambda v: v.str.upper(),
+    "Order Date": lambda v: v + pd.Timedelta(days=1),
+    "Status": lambda v: v.where(v != "Billed", "Closed").where(v == "Billed", "Billed"),
+    "Amount": lambda v: (v + 0.01).round(2),
+    "Currency": lambda v: v.where(v != "USD", "EUR").where(v == "USD", "USD"),
+    "Memo": lambda v: v + " (edited)",
+}
+
+def generate_workload(rows, columns=len(NS_COLUMNS), duplicate_ratio=0.01, orphan_ratio=0.05, mismatch_rate=0.02, seed=0):
+    """NetSuite and Salesforce frames shaped like the real exports, with controlled differences.
+
+    `duplicate_ratio` of NetSuite records repeat another record's Document Number,
+    `orphan_ratio` of records exist in one system only (half each way), and every
+    compared field differs on `mismatch_rate` of the shared records. Columns past
+    the standard eight are custom number fields. Salesforce uses its own column
+    names in the same order, so the app's by-position mapping lines them up.
+    The same arguments always give the same frames.
+    """
+    rng = np.random.default_rng(seed)
+    documents = np.arange(100_000, 100_000 + rows)
+    repeated = rng.random(rows) < duplicate_ratio
+    documents[repeated] = rng.choice(documents, int(repeated.sum()))
+    accounts = np.array([f"Account {i:05d}" for i in range(max(1, rows // 50))])
+    ns = pd.DataFrame({
+        "Document Number": documents,
+        "Line Number": rng.integers(1, 6, rows),
+        "Account Name": accounts[rng.integers(0, len(accounts), rows)],
+        "Order Date": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 730, rows), unit="D"),
+        "Status": STATUSES[rng.integers(0, len(STATUSES), rows)],
+        "Amount": rng.gamma(2.0, 500.0, rows).round(2),
+        "Currency": CURRENCIES[rng.integers(0, len(CURRENCIES), rows)],
+        "Memo": "Order " + pd.Series(rng.integers(0, 1_000_000, rows)).astype(str),
+    })
+    for i in range(len(NS_COLUMNS), columns):
+        ns[f"Custom Field {i - len(NS_COLUMNS) + 1}"] = rng.integers(0, 1000, rows)
+    ns = ns.iloc[:, :max(1, columns)]
+
+    # Salesforce: the shared records (NetSuite-only ones dropped) with changes, plus its own orphans
+    sf = ns[rng.random(rows) >= orphan_ratio / 2].reset_index(drop=True)
+    for col in sf.columns[1:]:
+        changed = rng.random(len(sf)) < mismatch_rate
+        change = MISMATCH_CHANGES.get(col, lambda v: v + 1)
+        sf.loc[changed, col] = change(sf.loc[changed, col])
+    sf_only = ns.iloc[rng.integers(0, rows, int(rows * orphan_ratio / 2))].reset_index(drop=True)
+    sf_only["Document Number"] = 10**9 + np.arange(len(sf_only))
+    sf = pd.concat([sf, sf_only], ignore_index=True)
+    sf = sf.iloc[rng.permutation(len(sf))].reset_index(drop=True)
+    sf.columns = SF_COLUMNS[:len(sf.columns)] + [f"Custom_Field_{i + 1}__c" for i in range(len(sf.columns) - len(SF_COLUMNS))]
+    return ns, sf
+
+def write_workbook(df, path):
+    """Write one system's export as the app accepts it (.xlsx, first sheet)."""
+    if len(df) > EXCEL_MAX_ROWS:
+        raise ValueError(f"A worksheet holds at most {EXCEL_MAX_ROWS:,} records; generate fewer rows to write workbooks")
+    df.to_excel(path, index=False, engine="openpyxl")
+
+# -------------------------
+# Stage Benchmark Functions
+# -------------------------
+PARSE_MAX_ROWS = 200_000  # larger workloads skip the (slow) workbook round trip and start from frames
+REGRESSION_RATIO = 1.2  # a stage this much slower than in the previous version is flagged
+
+def measure(results, stage, rows, fn, *args):
+    """Run fn(*args) as one stage, appending its wall time, CPU time and peak memory growth to `results`."""
+    reset_peak_memory()
+    rss_before = memory_kb("VmRSS")
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    value = fn(*args)
+    seconds, cpu_seconds = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    peak = memory_kb("VmHWM")
+    results.append({
+        "stage": stage,
+        "rows": rows,
+        "seconds": seconds,
+        "cpu_seconds": cpu_seconds,
+        "peak_mb": max(0, peak - rss_before) / 1024 if peak is not None and rss_before is not None else None,
+    })
+    return value
+
+def ingest(df):
+    """The app's ingest after reading a workbook: date parsing and compact column types."""
+    return optimize_dtypes(parse_date_columns(df, [col for col in df.columns if "date" in col.lower()]))
+
+def field_statistics(merged, fields):
+    """Match/mismatch counts per field over the records in both systems, as the Overview computes them."""
+    both = merged["_merge"] == "both"
+    stats = []
+    for field in fields:
+        matches = values_match(merged.loc[both, f"{field}_NS"], merged.loc[both, f"{field}_SF"])
+        stats.append({"Field": field, "Match": int(matches.sum()), "Mismatch": int((~matches).sum())})
+    return pd.DataFrame(stats)
+
+def drill_down(comparison, ns, sf, fields):
+    """What the Drill Down tab builds per field: mismatch mask, first page of records and top transformations."""
+    merged, bitmap = comparison["merged_df"], comparison["mismatch_bitmap"]
+    for field in fields:
+        mask = field_mismatches(bitmap, field)
+        record_page(ns, merged["_ns_row"].to_numpy()[mask], 0)
+        record_page(sf, merged["_sf_row"].to_numpy()[mask], 0)
+        if mask.any():
+            transformation_patterns(merged[f"{field}_NS"][mask], merged[f"{field}_SF"][mask], top_k=10)
+
+def git_version():
+    """Short commit of the code being measured (with -dirty for local changes), or 'unknown'."""
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip() or "unknown"
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def run_benchmark(rows, columns=len(NS_COLUMNS), duplicate_ratio=0.01, orphan_ratio=0.05, mismatch_rate=0.02,
+                  seed=0, parse_max_rows=PARSE_MAX_ROWS):
+    """Time and memory-profile every pipeline stage on one generated workload; returns one dict per stage."""
+    ns, sf = generate_workload(rows, columns, duplicate_ratio, orphan_ratio, mismatch_rate, seed)
+    results = []
+    if rows <= parse_max_rows:
+        with tempfile.TemporaryDirectory() as folder:
+            paths = [os.path.join(folder, name) for name in ("netsuite.xlsx", "salesforce.xlsx")]
+            write_workbook(ns, paths[0])
+            write_workbook(sf, paths[1])
+            ns, sf = measure(results, "parse", rows, lambda: [pd.read_excel(path, engine="openpyxl") for path in paths])
+    ns, sf = measure(results, "ingest", rows, lambda: (ingest(ns), ingest(sf)))
+    # By-position mapping, as the app's default
+    sf = measure(results, "map", rows, lambda: sf.rename(columns=dict(zip(sf.columns, ns.columns))))
+
+    key_columns = [ns.columns[0]]
+    compared = [col for col in ns.columns if col not in key_columns]
+    dimensions = {"Month": ("Order Date", "month"), "Account": ("Account Name", None)}
+    comparison = measure(
+        results, "merge", rows, run_comparison, ns, sf, key_columns, key_columns + compared, compared,
+        STRATEGY_ALL_PAIRS, MERGE_ROW_BUDGET, {name: dim for name, dim in dimensions.items() if dim[0] in ns.columns}
+    )
+    measure(results, "per-field stats", rows, field_statistics, comparison["merged_df"], compared)
+    measure(results, "drill-down build", rows, drill_down, comparison, ns, sf, compared)
+    measure(results, "profiling", rows, build_column_catalog, {"NetSuite": ns, "Salesforce": sf})
+    export_frame = comparison["merged_df"]
+    for export_format in TABLE_EXPORT_FORMATS:
+        measure(results, f"export: {export_format}", rows, export_table, export_frame, export_format)
+    orphans = comparison["orphans"]
+    measure(results, "export: workbook", rows, reconciliation_workbook, {
+        "NetSuite Orphans": fetch_records(ns, orphans["ns"]),
+        "Salesforce Orphans": fetch_records(sf, orphans["sf"]),
+    })
+    return results, comparison
+
+def save_results(results, comparison, workload, version, history=BENCHMARK_HISTORY):
+    """Append a benchmark run to the history: every stage, plus the comparison's internal stages."""
+    for result in results:
+        record_stage_timings(
+            {result["stage"]: result["seconds"]}, {result["stage"]: result["rows"]}, source="benchmark", path=history,
+            version=version, rows=result["rows"], cpu_seconds=round(result["cpu_seconds"], 6),
+            peak_mb=None if result["peak_mb"] is None else round(result["peak_mb"], 1), workload=workload
+        )
+    # Seconds per unit of work of run_comparison's stages: these calibrate Explain
+    record_stage_timings(
+        comparison["stage_seconds"], comparison["stage_work"], source="benchmark", path=history,
+        version=version, rows=workload["rows"], workload=workload
+    )
+
+def load_history(history=BENCHMARK_HISTORY):
+    """Benchmark lines of the history as a frame (app runs are left out)."""
+    entries = []
+    try:
+        with open(history) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("source") == "benchmark" and "version" in entry:
+                    entries.append(entry)
+    except OSError:
+        pass
+    return pd.DataFrame(entries)
+
+def regression_report(history=BENCHMARK_HISTORY, ratio=REGRESSION_RATIO):
+    """Median seconds and peak memory per stage and workload size for the last two versions benchmarked.
+
+    Stages at least `ratio` times slower than in the previous version are flagged.
+    """
+    entries = load_history(history)
+    if entries.empty:
+        return entries
+    versions = list(dict.fromkeys(entries["version"]))[-2:]
+    entries = entries[entries["version"].isin(versions)]
+    if "peak_mb" not in entries:
+        entries["peak_mb"] = np.nan
+    medians = entries.groupby(["stage", "rows", "version"], sort=False).agg(seconds=("seconds", "median"), peak_mb=("peak_mb", "median"))
+    report = medians.unstack("version")
+    report.columns = [f"{metric} ({version})" for metric, version in report.columns]
+    if len(versions) == 2:
+        before, after = report[f"seconds ({versions[0]})"], report[f"seconds ({versions[1]})"]
+        report["change"] = after / before
+        report["regression"] = report["change"] >= ratio
+    return report.reset_index()
+
+def format_results(results):
+    """Stage results of one workload as a printable table."""
+    table = pd.DataFrame(results)
+    table["rows/s"] = (table["rows"] / table["seconds"].where(table["seconds"] > 0)).round(0)
+    return table.round({"seconds": 3, "cpu_seconds": 3, "peak_mb": 1}).to_string(index=False)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name in ("generate", "run"):
+        command = commands.add_parser(name)
+        command.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000], help="NetSuite records per workload (10k-5M)")
+        command.add_argument("--columns", type=int, default=len(NS_COLUMNS), help="columns per system")
+        command.add_argument("--duplicates", type=float, default=0.01, help="share of records repeating another's key")
+        command.add_argument("--orphans", type=float, default=0.05, help="share of records in one system only")
+        command.add_argument("--mismatches", type=float, default=0.02, help="share of shared records differing per field")
+        command.add_argument("--seed", type=int, default=0)
+    commands.choices["generate"].add_argument("--out", default="bench_data", help="folder for the workbook pairs")
+    commands.choices["run"].add_argument("--parse-max-rows", type=int, default=PARSE_MAX_ROWS,
+                                         help="largest workload that is written to and parsed from .xlsx")
+    commands.choices["run"].add_argument("--history", default=BENCHMARK_HISTORY)
+    commands.add_parser("report").add_argument("--history", default=BENCHMARK_HISTORY)
+    args = parser.parse_args()
+
+    if args.command == "report":
+        report = regression_report(args.history)
+        print(report.to_string(index=False) if not report.empty else "No benchmark runs recorded yet")
+        return
+    version = git_version()
+    for rows in args.rows:
+        params = dict(columns=args.columns, duplicate_ratio=args.duplicates, orphan_ratio=args.orphans,
+                      mismatch_rate=args.mismatches, seed=args.seed)
+        if args.command == "generate":
+            os.makedirs(args.out, exist_ok=True)
+            ns, sf = generate_workload(rows, **params)
+            for system, df in (("netsuite", ns), ("salesforce", sf)):
+                path = os.path.join(args.out, f"{system}_{rows}.xlsx")
+                write_workbook(df, path)
+                print(f"Wrote {len(df):,} records to {path}")
+            continue
+        results, comparison = run_benchmark(rows, parse_max_rows=args.parse_max_rows, **params)
+        save_results(results, comparison, dict(rows=rows, **params), version, args.history)
+        print(f"\n{rows:,} records ({version}):")
+        print(format_results(results))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2003 @@
+import gzip
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import CancelledError, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from pandas.tseries.api import guess_datetime_format
+
+# -------------------------
+# Ingest Functions
+# -------------------------
+CATEGORY_MAX_RATIO = 0.5  # text columns with fewer distinct values than this share of rows become categoricals
+
+try:
+    import pyarrow  # noqa: F401
+    TEXT_DTYPE = pd.StringDtype("pyarrow")
+except ImportError:
+    TEXT_DTYPE = None
+
+def enable_copy_on_write():
+    """Turn on pandas copy-on-write so copies and column edits share memory until written."""
+    if int(pd.__version__.split(".")[0]) < 3:  # always on from pandas 3.0
+        pd.set_option("mode.copy_on_write", True)
+
+def optimize_dtypes(df, category_max_ratio=CATEGORY_MAX_RATIO):
+    """Shrink a freshly read frame: categoricals, Arrow strings and lossless numeric downcasts."""
+    optimized = {}
+    for col in df.columns:
+        values = df[col]
+        if pd.api.types.is_bool_dtype(values) or pd.api.types.is_datetime64_any_dtype(values):
+            optimized[col] = values
+        elif pd.api.types.is_integer_dtype(values):
+            optimized[col] = pd.to_numeric(values, downcast="integer")
+        elif pd.api.types.is_float_dtype(values):
+            # Only keep float32 when every value survives the round trip (amounts must not drift)
+            narrow = values.astype(np.float32)
+            lossless = ((narrow.astype(np.float64) == values) | values.isna()).all()
+            optimized[col] = narrow if lossless else values
+        elif pd.api.types.infer_dtype(values, skipna=True) in ("string", "empty"):
+            # Mixed object columns (numbers and text) are left alone so comparisons keep their meaning
+            distinct = values.nunique(dropna=True)
+            if len(values) > 0 and distinct <= category_max_ratio * len(values):
+                optimized[col] = values.astype("category")
+            elif TEXT_DTYPE is not None:
+                optimized[col] = values.astype(TEXT_DTYPE)
+            else:
+                optimized[col] = values
+        else:
+            optimized[col] = values
+    return pd.DataFrame(optimized, index=df.index)
+
+_date_formats = {}  # column name -> strftime format last inferred for it
+
+DATE_FORMAT_MIN_SHARE = 0.9  # a format is kept when it parses at least this share of a sample (the rest are bad values)
+
+def _format_parses(sample, date_format):
+    """True when `date_format` parses (nearly) every value of `sample`."""
+    return bool(pd.to_datetime(sample, format=date_format, errors="coerce").notna().mean() >= DATE_FORMAT_MIN_SHARE)
+
+def infer_date_format(values, sample_size=200):
+    """Guess one strftime format for a text date column, checked against a sample (None if none fits)."""
+    if pd.api.types.is_numeric_dtype(values):
+        return None
+    sample = values.dropna().astype(str).head(sample_size)
+    if len(sample) == 0:
+        return None
+    date_format = guess_datetime_format(sample.iloc[0])
+    return date_format if date_format and _format_parses(sample, date_format) else None
+
+def parse_date_columns(df, columns):
+    """Convert date columns to datetime64 once, on the fixed-format fast path where possible.
+
+    Columns that are already datetime64 are left alone, so calling this again is
+    free. The format inferred for a column name is cached and reused as long as
+    it still fits the data.
+    """
+    parsed = {}
+    for col in columns:
+        values = df[col]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            continue
+        date_format = _date_formats.get(col)
+        if date_format is None or not _format_parses(values.dropna().astype(str).head(200), date_format):
+            date_format = infer_date_format(values)
+            if date_format:
+                _date_formats[col] = date_format
+        parsed[col] = pd.to_datetime(values, format=date_format, errors="coerce")
+    return df.assign(**parsed) if parsed else df
+
+def values_match(ns_vals, sf_vals):
+    """Element-wise equality of two aligned columns as a bool array; two nulls count as a match."""
+    ns_cat = isinstance(ns_vals.dtype, pd.CategoricalDtype)
+    sf_cat = isinstance(sf_vals.dtype, pd.CategoricalDtype)
+    if ns_cat and sf_cat:
+        # Compare category codes over the union of both category sets
+        categories = ns_vals.cat.categories.union(sf_vals.cat.categories)
+        ns_codes = ns_vals.cat.set_categories(categories).cat.codes.to_numpy()
+        sf_codes = sf_vals.cat.set_categories(categories).cat.codes.to_numpy()
+        return ns_codes == sf_codes
+    if ns_cat:
+        ns_vals = ns_vals.astype(ns_vals.cat.categories.dtype)
+    if sf_cat:
+        sf_vals = sf_vals.astype(sf_vals.cat.categories.dtype)
+    try:
+        equal = (ns_vals == sf_vals).fillna(False).to_numpy(dtype=bool)
+    except TypeError:
+        equal = np.zeros(len(ns_vals), dtype=bool)
+    return equal | (ns_vals.isna().to_numpy() & sf_vals.isna().to_numpy())
+
+# -------------------------
+# Filter Functions
+# -------------------------
+def filter_mask(df, date_col=None, date_range=None, account_col=None, accounts=None):
+    """Row mask for the sidebar date range (inclusive) and account filters.
+
+    A filter whose column is missing from `df` is skipped, so each system is
+    scoped by whichever filter columns it has.
+    """
+    mask = np.ones(len(df), dtype=bool)
+    if date_col and date_col in df.columns and date_range is not None and len(date_range) == 2:
+        dates = parse_date_columns(df[[date_col]], [date_col])[date_col]
+        if dates.dt.tz is not None:
+            dates = dates.dt.tz_localize(None)
+        start = pd.Timestamp(date_range[0])
+        end = pd.Timestamp(date_range[1]) + pd.Timedelta(days=1)  # whole last day
+        mask &= ((dates >= start) & (dates < end)).to_numpy()
+    if account_col and account_col in df.columns and accounts:
+        mask &= df[account_col].isin(accounts).to_numpy()
+    return mask
+
+# -------------------------
+# Key Normalization Functions
+# -------------------------
+def key_strings(values):
+    """Render key values as plain strings (whole floats lose their '.0', nulls become '')."""
+    values = pd.Series(values)
+    if pd.api.types.is_float_dtype(values):
+        whole = values.notna() & (values == values.round()) & (values.abs() < 2**63)
+        rendered = pd.Series("", index=values.index, dtype=object)
+        rendered[whole] = values[whole].astype("int64").astype(str).astype(object)
+        fractional = values.notna() & ~whole
+        rendered[fractional] = values[fractional].astype(str).astype(object)
+        return rendered
+    return values.astype(object).where(values.notna(), "").astype(str)
+
+def fuzzy_key(values):
+    """Collapse a key to lower-case alphanumerics so reformatted keys line up."""
+    return key_strings(values).str.lower().str.replace(r"[^0-9a-z]", "", regex=True)
+
+# Seeds for hashing composite keys; the next one is tried if two different keys share a hash
+KEY_HASH_SEEDS = ("0123456789123456", "5f3c9a1e7b2d4860", "a84e1c6f02d9b735", "3d7b05e9c1f8a264")
+
+def _key_parts(df, columns):
+    """Normalized string parts of a multi-column key, one column per key field."""
+    return pd.DataFrame({col: key_strings(df[col]).str.strip().to_numpy() for col in columns})
+
+def hash_key_columns(frames, columns):
+    """Hash the multi-column key of each frame into one uint64 join key per row.
+
+    Every field is normalized (see key_strings) before hashing, so 1001, 1001.0
+    and " 1001" agree across systems. The hashes are verified: if two different
+    key tuples share a hash, all frames are re-hashed with the next seed.
+    Returns one uint64 array per frame and the number of collisions resolved.
+    """
+    parts = pd.concat([_key_parts(df, columns) for df in frames], ignore_index=True)
+    distinct_keys = len(parts.drop_duplicates())
+    bounds = np.cumsum([0] + [len(df) for df in frames])
+    resolved = 0
+    for seed in KEY_HASH_SEEDS:
+        hashes = pd.util.hash_pandas_object(parts, index=False, hash_key=seed).to_numpy()
+        # Exact check: as many distinct hashes as distinct key tuples means no two keys share one
+        collisions = distinct_keys - len(pd.unique(hashes))
+        if collisions == 0:
+            return [hashes[start:end] for start, end in zip(bounds[:-1], bounds[1:])], resolved
+        resolved += collisions
+    raise ValueError(f"{collisions} different {' + '.join(columns)} values share a 64-bit hash under every seed")
+
+def key_labels(df, columns):
+    """Readable 'a | b' rendering of a multi-column key, for display only."""
+    parts = _key_parts(df, columns)
+    return parts[columns[0]].str.cat([parts[col] for col in columns[1:]], sep=" | ").to_numpy()
+
+# -------------------------
+# Orphan Reconciliation Functions
+# -------------------------
+ORPHAN_KEY_WIDTH = 32  # normalized keys are truncated to this many characters
+_SIGNATURE_WORDS = 4  # 256-bit trigram signature per key
+
+def _key_matrix(keys):
+    """Pack normalized keys into an (n, ORPHAN_KEY_WIDTH) uint8 matrix, zero padded."""
+    packed = np.array([k[:ORPHAN_KEY_WIDTH] for k in keys], dtype=f"S{ORPHAN_KEY_WIDTH}")
+    return packed.view(np.uint8).reshape(len(keys), ORPHAN_KEY_WIDTH)
+
+def _popcount(words):
+    """Count set bits of a uint64 array along its last axis."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    table = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+    return table[words.view(np.uint8)].sum(axis=-1)
+
+def _trigram_signatures(matrix):
+    """Hash every padded character trigram of each key into a 256-bit signature."""
+    n = len(matrix)
+    padded = np.concatenate([np.full((n, 2), ord("#"), dtype=np.uint8), matrix, np.zeros((n, 1), dtype=np.uint8)], axis=1)
+    lengths = (matrix != 0).sum(axis=1)
+    codes = (padded[:, :-2].astype(np.uint32) << 16) | (padded[:, 1:-1].astype(np.uint32) << 8) | padded[:, 2:]
+    bits = (codes * np.uint32(2654435761)) >> np.uint32(24)  # multiplicative hash -> 0..255
+    # Trigrams past the end-of-key marker are padding
+    valid = np.arange(codes.shape[1])[None, :] <= lengths[:, None]
+    rows = np.broadcast_to(np.arange(n)[:, None], codes.shape)[valid]
+    bits = bits[valid]
+    signatures = np.zeros((n, _SIGNATURE_WORDS), dtype=np.uint64)
+    np.bitwise_or.at(signatures, (rows, bits >> 6), np.uint64(1) << (bits & 63).astype(np.uint64))
+    return signatures
+
+def _capped_join(ns_tokens, sf_tokens, max_postings):
+    """Inverted-index join on tokens, skipping tokens with more than `max_postings` rows per side."""
+    ns_tokens = ns_tokens.drop_duplicates()
+    sf_tokens = sf_tokens.drop_duplicates()
+    ns_tokens = ns_tokens[ns_tokens.groupby("token")["ns"].transform("size") <= max_postings]
+    sf_tokens = sf_tokens[sf_tokens.groupby("token")["sf"].transform("size") <= max_postings]
+    return ns_tokens.merge(sf_tokens, on="token")[["ns", "sf"]].to_numpy(dtype=np.int64)
+
+def _deletion_tokens(matrix, side_name):
+    """Hash every single-character deletion of each key (edit-distance-1 blocking)."""
+    n, width = matrix.shape
+    powers = np.uint64(1099511628211) ** np.arange(width - 1, dtype=np.uint64)
+    frames = []
+    # Deleting any padding byte gives the key itself, so one padding position is enough
+    longest = int((matrix != 0).sum(axis=1).max()) if n else 0
+    for pos in range(min(longest + 1, width)):
+        variant = np.delete(matrix, pos, axis=1).astype(np.uint64)
+        frames.append(pd.DataFrame({side_name: np.arange(n), "token": (variant * powers).sum(axis=1)}))
+    return pd.concat(frames, ignore_index=True)
+
+def _neighbour_pairs(sort_keys, side, window):
+    """Sorted-neighbourhood blocking: pair each row with the next `window` rows of the other side."""
+    order = np.argsort(sort_keys, kind="stable")
+    sorted_side = side[order]
+    pairs = [np.empty((0, 2), dtype=np.int64)]
+    for offset in range(1, min(window, len(order) - 1) + 1):
+        a, b = order[:-offset], order[offset:]
+        cross = sorted_side[:-offset] != sorted_side[offset:]
+        pairs.append(np.column_stack([a[cross], b[cross]]))
+    return np.concatenate(pairs)
+
+def propose_orphan_pairs(ns_orphans, sf_orphans, key_col, secondary_cols=None, block_col=None,
+                         window=3, max_postings=20, min_score=0.6, key_weight=0.7):
+    """Propose likely NS-only ↔ SF-only pairs with similarity scores.
+
+    Candidate pairs come from a token index instead of comparing every orphan to
+    every other: the normalized key itself ("SO-00123" vs "so00123"), every
+    single-character deletion of the key (typos, transpositions, dropped
+    characters), rare exact values of the secondary fields, and sorted
+    neighbourhoods of the key read forwards and backwards. Candidates are scored
+    by trigram similarity of the keys (256-bit signatures, compared with bitwise
+    ops) blended with agreement on the secondary fields. `ns_orphans` and
+    `sf_orphans` share column names; returned positions index into them.
+    """
+    secondary_cols = [c for c in (secondary_cols or []) if c != key_col and c in ns_orphans.columns and c in sf_orphans.columns]
+    result_columns = ["ns_pos", "sf_pos", "NetSuite Key", "Salesforce Key", "Key Similarity", "Field Agreement", "Score"]
+    n_ns, n_sf = len(ns_orphans), len(sf_orphans)
+    if n_ns == 0 or n_sf == 0:
+        return pd.DataFrame(columns=result_columns)
+
+    ns_keys = fuzzy_key(ns_orphans[key_col]).tolist()
+    sf_keys = fuzzy_key(sf_orphans[key_col]).tolist()
+    ns_matrix, sf_matrix = _key_matrix(ns_keys), _key_matrix(sf_keys)
+    if block_col and block_col in ns_orphans.columns and block_col in sf_orphans.columns:
+        ns_block = key_strings(ns_orphans[block_col]).str.strip().str.lower().to_numpy(dtype=object)
+        sf_block = key_strings(sf_orphans[block_col]).str.strip().str.lower().to_numpy(dtype=object)
+    else:
+        ns_block = np.full(n_ns, "", dtype=object)
+        sf_block = np.full(n_sf, "", dtype=object)
+
+    # Edit-distance-1 keys share a deletion variant; the full key is one of them too
+    candidate_sets = [_capped_join(_deletion_tokens(ns_matrix, "ns"), _deletion_tokens(sf_matrix, "sf"), max_postings)]
+
+    # Rare secondary values (an email, an exact amount) pair records whose keys differ entirely
+    secondary_values = {}
+    for col in secondary_cols:
+        ns_vals = key_strings(ns_orphans[col]).str.strip().str.lower()
+        sf_vals = key_strings(sf_orphans[col]).str.strip().str.lower()
+        secondary_values[col] = (ns_vals.to_numpy(dtype=object), sf_vals.to_numpy(dtype=object))
+        ns_tokens = pd.DataFrame({"ns": np.arange(n_ns), "token": ns_vals.to_numpy(dtype=object)})
+        sf_tokens = pd.DataFrame({"sf": np.arange(n_sf), "token": sf_vals.to_numpy(dtype=object)})
+        candidate_sets.append(_capped_join(ns_tokens[ns_tokens["token"] != ""], sf_tokens[sf_tokens["token"] != ""], max_postings))
+
+    # Sorted neighbourhood over both sides stacked together (NS rows first)
+    side = np.concatenate([np.zeros(n_ns, dtype=np.int8), np.ones(n_sf, dtype=np.int8)])
+    all_blocks = np.concatenate([ns_block, sf_block]).astype(str)
+    for keys in (ns_keys + sf_keys, [k[::-1] for k in ns_keys + sf_keys]):
+        pairs = _neighbour_pairs(np.char.add(np.char.add(all_blocks, "\x00"), np.array(keys, dtype=str)), side, window)
+        ns_first = pairs[:, 0] < n_ns
+        candidate_sets.append(np.column_stack([
+            np.where(ns_first, pairs[:, 0], pairs[:, 1]),
+            np.where(ns_first, pairs[:, 1], pairs[:, 0]) - n_ns,
+        ]))
+
+    candidates = pd.unique(np.concatenate(candidate_sets) @ np.array([n_sf, 1], dtype=np.int64))
+    ns_pos, sf_pos = candidates // n_sf, candidates % n_sf
+    same_block = ns_block[ns_pos] == sf_block[sf_pos]
+    ns_pos, sf_pos = ns_pos[same_block], sf_pos[same_block]
+    if len(ns_pos) == 0:
+        return pd.DataFrame(columns=result_columns)
+
+    # Dice similarity of the trigram signatures: 2|A∩B| / (|A| + |B|)
+    ns_sig, sf_sig = _trigram_signatures(ns_matrix), _trigram_signatures(sf_matrix)
+    shared = _popcount(ns_sig[ns_pos] & sf_sig[sf_pos])
+    sizes = _popcount(ns_sig)[ns_pos] + _popcount(sf_sig)[sf_pos]
+    key_sim = np.where(sizes > 0, 2 * shared / np.maximum(sizes, 1), 0.0)
+    if secondary_cols:
+        agreement = np.zeros(len(ns_pos))
+        for ns_vals, sf_vals in secondary_values.values():
+            agreement += ns_vals[ns_pos] == sf_vals[sf_pos]
+        agreement /= len(secondary_cols)
+        score = key_weight * key_sim + (1 - key_weight) * agreement
+    else:
+        agreement = np.full(len(ns_pos), np.nan)
+        score = key_sim
+
+    pairs = pd.DataFrame({"ns_pos": ns_pos, "sf_pos": sf_pos, "Key Similarity": key_sim,
+                          "Field Agreement": agreement, "Score": score})
+    pairs = pairs[pairs["Score"] >= min_score]
+    # Greedy one-to-one assignment: best score first, each orphan used once
+    pairs = pairs.sort_values("Score", ascending=False, kind="stable")
+    pairs = pairs.drop_duplicates("ns_pos").drop_duplicates("sf_pos")
+    pairs.insert(2, "NetSuite Key", ns_orphans[key_col].to_numpy()[pairs["ns_pos"].to_numpy()])
+    pairs.insert(3, "Salesforce Key", sf_orphans[key_col].to_numpy()[pairs["sf_pos"].to_numpy()])
+    return pairs[result_columns].reset_index(drop=True)
+
+# -------------------------
+# Column Profiling Functions
+# -------------------------
+PROFILE_COLUMNS = ["Field", "Rows", "Nulls", "Duplicates", "Negatives", "Empty Strings", "Cardinality", "Min", "Max"]
+
+def profile_column(values):
+    """Nulls, duplicates, negatives, empties, min/max and cardinality from a single hash pass."""
+    counts = values.value_counts(dropna=False, sort=False)
+    counts = counts[counts > 0]  # categoricals report unused categories with a zero count
+    keys = counts.index
+    null_keys = pd.isna(keys)
+    present = keys[~null_keys]
+    if isinstance(present, pd.CategoricalIndex):  # unordered categories have no min/max
+        present = pd.Index(np.asarray(present))
+    rows = len(values)
+    negatives = 0
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        negatives = int(counts[~null_keys][present < 0].sum())
+    empties = 0
+    if not pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_datetime64_any_dtype(values):
+        empties = int(counts[~null_keys][np.asarray(present == "", dtype=bool)].sum())
+    try:
+        min_value, max_value = (present.min(), present.max()) if len(present) else (None, None)
+    except TypeError:  # mixed types in an object column have no ordering
+        min_value, max_value = None, None
+    return {
+        "Rows": rows,
+        "Nulls": int(counts[null_keys].sum()),
+        "Duplicates": rows - len(counts),  # same as values.duplicated().sum(): nulls count as one value
+        "Negatives": negatives,
+        "Empty Strings": empties,
+        "Cardinality": len(present),
+        "Min": min_value,
+        "Max": max_value,
+    }
+
+def profile_frame(df, max_workers=None):
+    """Profile every column of a frame, one column per worker thread."""
+    columns = list(df.columns)
+    if not columns:
+        return pd.DataFrame(columns=PROFILE_COLUMNS).set_index("Field")
+    max_workers = max_workers or min(len(columns), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        stats = list(pool.map(lambda col: profile_column(df[col]), columns))
+    profile = pd.DataFrame(stats, index=pd.Index(columns, name="Field"))
+    return profile[PROFILE_COLUMNS[1:]]
+
+def build_column_catalog(frames, max_workers=None, progress=None):
+    """Column statistics catalog for several systems, e.g. {"NetSuite": df, "Salesforce": df}.
+
+    `progress(fraction, stage)` is called before each system is profiled (see submit_job).
+    """
+    catalog = {}
+    for done, (system, df) in enumerate(frames.items()):
+        if progress:
+            progress(done / len(frames), f"Profiling {system} columns")
+        catalog[system] = profile_frame(df, max_workers)
+    return catalog
+
+# -------------------------
+# Merge Functions
+# -------------------------
+ROW_COLUMNS = ["_ns_row", "_sf_row"]  # original row positions carried through the merge (-1 = no record)
+RECORD_PAGE_ROWS = 500  # records per page when browsing rows fetched by position
+
+# How to join when a key repeats within a system
+STRATEGY_ALL_PAIRS = "All pairs (many-to-many)"
+STRATEGY_FIRST_MATCH = "First match per key"
+STRATEGY_BY_OCCURRENCE = "Pair by occurrence within key"
+STRATEGY_AGGREGATE = "Aggregate then compare"
+JOIN_STRATEGIES = [STRATEGY_ALL_PAIRS, STRATEGY_FIRST_MATCH, STRATEGY_BY_OCCURRENCE, STRATEGY_AGGREGATE]
+MERGE_ROW_BUDGET = 5_000_000  # all-pairs merges predicted above this are refused
+
+def analyze_key_multiplicity(ns_keys, sf_keys, top_n=10):
+    """Predict merged row counts per join strategy from key multiplicities, without running the join."""
+    counts = pd.concat(
+        [ns_keys.value_counts(dropna=True).rename("ns"), sf_keys.value_counts(dropna=True).rename("sf")], axis=1
+    ).fillna(0).astype(np.int64)
+    counts = counts[(counts["ns"] > 0) | (counts["sf"] > 0)]
+    # pandas joins null keys to each other, so they behave like one more key
+    ns_nulls, sf_nulls = int(ns_keys.isna().sum()), int(sf_keys.isna().sum())
+    ns = np.append(counts["ns"].to_numpy(), ns_nulls)
+    sf = np.append(counts["sf"].to_numpy(), sf_nulls)
+    in_both = (ns > 0) & (sf > 0)
+    pairs = np.where(in_both, ns * sf, ns + sf)
+    many_to_many = in_both & (ns > 1) & (sf > 1)
+    offenders = counts.assign(pairs=pairs[:-1])[many_to_many[:-1]].nlargest(top_n, "pairs")
+    return {
+        "ns_rows": int(ns.sum()),
+        "sf_rows": int(sf.sum()),
+        "duplicate_keys_ns": int((ns > 1).sum()),
+        "duplicate_keys_sf": int((sf > 1).sum()),
+        "many_to_many_keys": int(many_to_many.sum()),
+        "predicted_rows": {
+            STRATEGY_ALL_PAIRS: int(pairs.sum()),
+            STRATEGY_FIRST_MATCH: int(((ns > 0) | (sf > 0)).sum()),
+            STRATEGY_BY_OCCURRENCE: int(np.maximum(ns, sf).sum()),
+            STRATEGY_AGGREGATE: int(((ns > 0) | (sf > 0)).sum()),
+        },
+        "top_keys": offenders.rename(columns={"ns": "NetSuite Rows", "sf": "Salesforce Rows", "pairs": "Merged Rows"}),
+    }
+
+def _shape_join_side(df, key, strategy, row_column):
+    """Collapse or number repeated keys on one side so the join cannot fan out."""
+    if strategy == STRATEGY_FIRST_MATCH:
+        return df.drop_duplicates(subset=key, keep="first")
+    if strategy == STRATEGY_BY_OCCURRENCE:
+        return df.assign(_key_seq=df.groupby(key, dropna=False, observed=True, sort=False).cumcount())
+    if strategy == STRATEGY_AGGREGATE:
+        # Numbers are summed per key; everything else (and the row position) keeps the first value
+        aggregations = {
+            col: "sum" if pd.api.types.is_numeric_dtype(df[col]) and not pd.api.types.is_bool_dtype(df[col]) and col != row_column else "first"
+            for col in df.columns if col != key
+        }
+        return df.groupby(key, dropna=False, observed=True, sort=False).agg(aggregations).reset_index()
+    return df
+
+def project_for_merge(df, columns, row_column):
+    """Keep only the columns the comparison needs, plus each row's original position."""
+    projected = df[list(dict.fromkeys(columns))]
+    return projected.assign(**{row_column: np.arange(len(df), dtype=np.int64)})
+
+def merge_projected(ns, sf, key, columns, strategy=STRATEGY_ALL_PAIRS):
+    """Outer-merge just `columns` of both sides on `key` (projection pushdown).
+
+    Merge time and merged-frame memory depend on the selected fields, not on the
+    width of the exports; every other column stays in the source frames and is
+    fetched by row position when a record is displayed. `strategy` decides how
+    repeated keys are joined (see JOIN_STRATEGIES).
+    """
+    ns_side = _shape_join_side(project_for_merge(ns, columns, "_ns_row"), key, strategy, "_ns_row")
+    sf_side = _shape_join_side(project_for_merge(sf, columns, "_sf_row"), key, strategy, "_sf_row")
+    join_on = [key, "_key_seq"] if strategy == STRATEGY_BY_OCCURRENCE else key
+    merged = pd.merge(ns_side, sf_side, on=join_on, how="outer", indicator=True, suffixes=("_NS", "_SF"))
+    if strategy == STRATEGY_BY_OCCURRENCE:
+        merged = merged.drop(columns="_key_seq")
+    for row_column in ROW_COLUMNS:
+        merged[row_column] = merged[row_column].fillna(-1).astype(np.int64)
+    return merged
+
+def fetch_records(df, positions, columns=None):
+    """Original rows by position for display; -1 positions (no record on that side) are skipped."""
+    positions = np.asarray(positions, dtype=np.int64)
+    records = df.iloc[positions[positions >= 0]]
+    return records if columns is None else records[columns]
+
+def orphan_positions(merged):
+    """Original row positions of the records only one system has: {"ns": NetSuite only, "sf": Salesforce only}.
+
+    Orphans are kept as these two integer arrays instead of slices of the merged
+    frame; pages and exports are fetched from the source frames on demand.
+    """
+    status = merge_status_codes(merged)
+    return {
+        "ns": merged["_ns_row"].to_numpy()[status == 2],
+        "sf": merged["_sf_row"].to_numpy()[status == 3],
+    }
+
+def record_page(df, positions, page, page_rows=RECORD_PAGE_ROWS):
+    """One page (0-based) of the records at `positions`, with the frame's original columns."""
+    return fetch_records(df, positions[page * page_rows:(page + 1) * page_rows])
+
+def side_by_side_record(ns, sf, ns_pos, sf_pos):
+    """One record from both systems as a Field × (NetSuite, Salesforce) frame of display strings."""
+    columns = list(dict.fromkeys(list(ns.columns) + list(sf.columns)))
+    sides = {}
+    for system, df, pos in (("NetSuite", ns, ns_pos), ("Salesforce", sf, sf_pos)):
+        if pos is not None and pos >= 0:
+            sides[system] = df.iloc[int(pos)].reindex(columns).astype(object).where(lambda v: v.notna(), "").astype(str)
+        else:
+            sides[system] = pd.Series("(not in system)", index=columns)
+    return pd.DataFrame(sides, index=pd.Index(columns, name="Field"))
+
+# -------------------------
+# Mismatch Bitmap Functions
+# -------------------------
+def build_mismatch_bitmap(merged, fields):
+    """Pack which fields mismatch on which records into bit matrices.
+
+    Only records present in both systems can mismatch on a field; orphans have
+    no bits set. Two layouts of the same bits are kept: `by_field` (one packed
+    bitmap index per field, for AND/OR filters and co-occurrence) and
+    `by_record` (fields packed per record, for per-record counts).
+    """
+    fields = list(fields)
+    in_both = merge_status_codes(merged) == 0
+    return _pack_mismatch_bitmap(fields, _mismatch_bits(merged, fields, in_both), in_both)
+
+def _mismatch_bits(merged, fields, in_both):
+    """Fields × records bool matrix of mismatches (records in both systems only)."""
+    bits = np.zeros((len(fields), len(merged)), dtype=bool)
+    for i, field in enumerate(fields):
+        bits[i] = in_both & ~values_match(merged[f"{field}_NS"], merged[f"{field}_SF"])
+    return bits
+
+def _pack_mismatch_bitmap(fields, bits, in_both):
+    """The bitmap dict of build_mismatch_bitmap from an unpacked fields × records matrix."""
+    return {
+        "fields": fields,
+        "records": bits.shape[1],
+        "in_both": in_both,
+        "by_field": np.packbits(bits, axis=1),
+        "by_record": np.packbits(bits.T, axis=1),
+    }
+
+def field_mismatches(bitmap, field):
+    """Bool mask of the records that mismatch on `field`."""
+    return np.unpackbits(bitmap["by_field"][bitmap["fields"].index(field)], count=bitmap["records"]).astype(bool)
+
+def filter_mismatches(bitmap, fields, require_all=True):
+    """Bool mask of records mismatching on all (AND) or any (OR) of `fields`."""
+    rows = bitmap["by_field"][[bitmap["fields"].index(f) for f in fields]]
+    combined = np.bitwise_and.reduce(rows, axis=0) if require_all else np.bitwise_or.reduce(rows, axis=0)
+    return np.unpackbits(combined, count=bitmap["records"]).astype(bool)
+
+def count_record_mismatches(bitmap):
+    """Number of mismatched fields per record."""
+    return _popcount(bitmap["by_record"])
+
+def mismatch_cooccurrence(bitmap):
+    """Field × field counts of records mismatching on both (the diagonal is each field's total)."""
+    by_field = bitmap["by_field"]
+    counts = np.array([_popcount(by_field[i] & by_field) for i in range(len(by_field))], dtype=np.int64).reshape(len(by_field), len(by_field))
+    return pd.DataFrame(counts, index=bitmap["fields"], columns=bitmap["fields"])
+
+# -------------------------
+# Key Index Functions
+# -------------------------
+def build_key_index(merged, key_col):
+    """Hash index from key text to the merged records carrying that key.
+
+    Keys are normalized as for matching (see key_strings) and stripped, so a
+    lookup for "1001" finds 1001.0 too. Records are grouped by key with one
+    sort, so a lookup is a hash probe plus a slice, however large the merge.
+    """
+    # Normalize the distinct keys only, then fold keys that normalize alike
+    codes, uniques = pd.factorize(merged[key_col], use_na_sentinel=False)
+    normalized_codes, uniques = pd.factorize(key_strings(uniques).str.strip())
+    codes = normalized_codes[codes]
+    keys = pd.Index(uniques)
+    keys.is_unique  # builds the hash table now rather than on the first lookup
+    return {
+        "keys": keys,
+        "order": np.argsort(codes, kind="stable"),
+        "starts": np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(uniques)))]),
+    }
+
+def lookup_key(index, value):
+    """Merged-frame positions of the records whose key is `value` (empty if there is none)."""
+    code = index["keys"].get_indexer(key_strings([value]).str.strip())[0]
+    if code < 0:
+        return np.empty(0, dtype=np.int64)
+    return index["order"][index["starts"][code]:index["starts"][code + 1]]
+
+def record_field_status(merged, bitmap, row):
+    """NetSuite value, Salesforce value and status of every compared field of one merged record."""
+    row = int(row)
+    fields = bitmap["fields"]
+    status = merge_status_codes(merged.iloc[[row]])[0]
+    if status == 0:
+        codes = np.unpackbits(bitmap["by_record"][row], count=len(fields))
+    else:
+        codes = np.full(len(fields), status)
+
+    def rendered(column):
+        values = merged.iloc[row][[f"{f}_{column}" for f in fields]].astype(object)
+        return values.where(values.notna(), "").astype(str).to_numpy()
+
+    return pd.DataFrame({
+        "Field": fields,
+        "NetSuite": rendered("NS"),
+        "Salesforce": rendered("SF"),
+        "Status": [STATUS_LABELS[c] for c in codes],
+    })
+
+DRILL_STATUS_LABELS = np.array(["✅ Match", "❌ Mismatch", "🟦 NS Only", "🟧 SF Only"])
+
+def _display_strings(values):
+    """Values as display strings, nulls as '' (as record_field_status shows them)."""
+    values = pd.Series(values).astype(object)
+    return values.where(values.notna(), "").astype(str).to_numpy()
+
+def field_comparison(merged, bitmap, field, key_col):
+    """Key, both values and status of `field` for every aligned record: matched ones first, then orphans.
+
+    Statuses come from the mismatch bitmap (or values_match for fields outside it),
+    so two nulls are a match as in the KPIs. Records of a failed merge are left
+    out. Built with whole-column operations, never per row.
+    """
+    status = merge_status_codes(merged)
+    if field in bitmap["fields"]:
+        status = np.where(field_mismatches(bitmap, field), np.int8(1), status)
+    elif f"{field}_NS" in merged.columns and f"{field}_SF" in merged.columns:
+        status = field_status_codes(merged, field, status)
+    order = np.concatenate([np.flatnonzero(status <= 1), np.flatnonzero(status == 2), np.flatnonzero(status == 3)])
+    status = status[order]
+
+    def side(suffix, missing):
+        column = f"{field}_{suffix}" if f"{field}_{suffix}" in merged.columns else field
+        if column not in merged.columns:
+            return np.full(len(order), "N/A", dtype=object)
+        return np.where(status == missing, f"(Not in {'NetSuite' if suffix == 'NS' else 'Salesforce'})",
+                        _display_strings(merged[column].to_numpy()[order]))
+
+    return pd.DataFrame({
+        "Match Key": _display_strings(merged[key_col].to_numpy()[order]) if key_col in merged.columns else "N/A",
+        "NetSuite": side("NS", 3),
+        "Salesforce": side("SF", 2),
+        "Status": DRILL_STATUS_LABELS[status],
+        "_ns_row": merged["_ns_row"].to_numpy()[order],
+        "_sf_row": merged["_sf_row"].to_numpy()[order],
+    })
+
+# -------------------------
+# Rollup Functions
+# -------------------------
+RECORD_FIELD = "(record)"  # cube rows that count whole records by merge status
+MERGE_STATUS_CODES = {"both": 0, "left_only": 2, "right_only": 3}
+# "Unaligned": records of a failed merge, stacked without being matched by key
+STATUS_LABELS = np.array(["Match", "Mismatch", "NS Only", "SF Only", "Unaligned"])
+
+def merged_column(merged, column):
+    """One field of the merged frame: the key as is, otherwise NetSuite's value with Salesforce's as fallback."""
+    if column in merged.columns:
+        return merged[column]
+    ns, sf = merged.get(f"{column}_NS"), merged.get(f"{column}_SF")
+    if ns is None or sf is None:
+        return sf if ns is None else ns
+    if isinstance(ns.dtype, pd.CategoricalDtype) and isinstance(sf.dtype, pd.CategoricalDtype):
+        categories = ns.cat.categories.union(sf.cat.categories)
+        ns, sf = ns.cat.set_categories(categories), sf.cat.set_categories(categories)
+    elif ns.dtype != sf.dtype:
+        ns, sf = ns.astype(object), sf.astype(object)
+    return ns.where(ns.notna(), sf)
+
+def merge_status_codes(merged):
+    """Per-record status code (index into STATUS_LABELS): 0 in both systems, 2 NetSuite only, 3 Salesforce only.
+
+    Any other `_merge` value (the unmatched concat of a failed merge) is 4, unaligned,
+    so those records never count as matched.
+    """
+    merge = merged["_merge"]
+    if isinstance(merge.dtype, pd.CategoricalDtype):
+        # Look the status up per category instead of comparing strings per record
+        lookup = np.array([MERGE_STATUS_CODES.get(c, 4) for c in merge.cat.categories], dtype=np.int8)
+        return lookup[merge.cat.codes.to_numpy()]
+    merge = merge.astype(str).to_numpy()
+    return np.select([merge == status for status in MERGE_STATUS_CODES], list(MERGE_STATUS_CODES.values()), 4).astype(np.int8)
+
+def field_status_codes(merged, field, record_status):
+    """Per-record status of one field: records in both systems become 0 (match) or 1 (mismatch)."""
+    codes = record_status.copy()
+    both = codes == 0
+    codes[both & ~values_match(merged[f"{field}_NS"], merged[f"{field}_SF"])] = 1
+    return codes
+
+def _factorize_dimension(values, bucket=None):
+    """Codes and distinct values of one cube dimension; bucket 'month' turns dates into 'YYYY-MM' (undated rows become null)."""
+    if bucket == "month":
+        codes, months = pd.factorize(pd.to_datetime(values, errors="coerce").dt.to_period("M"), use_na_sentinel=False)
+        # Only the distinct months are rendered as text
+        return codes, np.array([None if pd.isna(m) else str(m) for m in months], dtype=object)
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    return codes, np.asarray(uniques, dtype=object)
+
+def build_rollup_cube(merged, fields, dimensions, bitmap=None):
+    """Record counts by (dimensions..., Field, Status), built in one pass over the merged frame.
+
+    `dimensions` maps a dimension name to (merged column, bucket); dimensions
+    whose column is not in the merge are skipped. Each field is counted with
+    one bincount over a combined (dimension cell, status) code, so the cube
+    holds one row per non-empty cell instead of one per record. Field
+    mismatches are read from `bitmap` when one is passed.
+    """
+    record_status = merge_status_codes(merged)
+    dim_codes, dim_uniques = [], {}
+    for name, (column, bucket) in dimensions.items():
+        if column and (column in merged.columns or f"{column}_NS" in merged.columns or f"{column}_SF" in merged.columns):
+            codes, uniques = _factorize_dimension(merged_column(merged, column), bucket)
+            dim_codes.append(codes)
+            dim_uniques[name] = uniques
+    # Mixed-radix combination of the dimension codes, renumbered to the cells that occur
+    combined = np.zeros(len(merged), dtype=np.int64)
+    for codes, uniques in zip(dim_codes, dim_uniques.values()):
+        combined = combined * len(uniques) + codes
+    cells, cell_codes = np.unique(combined, return_inverse=True)
+    statuses = len(STATUS_LABELS)
+    pieces = []
+    for field in [RECORD_FIELD] + list(fields):
+        if field == RECORD_FIELD:
+            status = record_status
+        elif bitmap is not None and field in bitmap["fields"]:
+            status = np.where(field_mismatches(bitmap, field), np.int8(1), record_status)
+        else:
+            status = field_status_codes(merged, field, record_status)
+        counts = np.bincount(cell_codes * statuses + status, minlength=len(cells) * statuses)
+        present = np.flatnonzero(counts)
+        pieces.append(pd.DataFrame({
+            "_cell": present // statuses, "Field": field, "Status": STATUS_LABELS[present % statuses], "Count": counts[present]
+        }))
+    cube = pd.concat(pieces, ignore_index=True)
+    # Decode each cell back into its dimension values
+    remainder = cells[cube["_cell"].to_numpy()]
+    for name, uniques in reversed(list(dim_uniques.items())):
+        cube.insert(0, name, uniques[remainder % len(uniques)])
+        remainder = remainder // len(uniques)
+    return cube.drop(columns="_cell")
+
+def rollup(cube, by, fields=(RECORD_FIELD,)):
+    """Sum cube counts for `fields` by one or more dimensions, one column per status (null groups dropped)."""
+    subset = cube[cube["Field"].isin(fields)]
+    table = subset.pivot_table(index=by, columns="Status", values="Count", aggfunc="sum", fill_value=0)
+    return table.reindex(columns=STATUS_LABELS, fill_value=0).astype(np.int64)
+
+# -------------------------
+# Transformation Pattern Functions
+# -------------------------
+PATTERN_EXACT_LIMIT = 2_000_000  # mismatched pairs above this are counted with the streaming sketch
+PATTERN_CHUNK_ROWS = 500_000
+_SKETCH_MULTIPLIERS = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93], dtype=np.uint64)
+
+def _pair_hashes(ns_text, sf_text):
+    """64-bit hash of each (NetSuite value, Salesforce value) pair."""
+    return pd.util.hash_pandas_object(pd.DataFrame({"ns": ns_text, "sf": sf_text}), index=False).to_numpy()
+
+def describe_transformation(ns_value, sf_value):
+    """Short name for how a NetSuite value was rewritten in Salesforce."""
+    if ns_value == "":
+        return "Empty in NetSuite"
+    if sf_value == "":
+        return "Empty in Salesforce"
+    if ns_value.strip() == sf_value.strip():
+        return "Whitespace"
+    if ns_value.lower() == sf_value.lower():
+        return "Letter case"
+    try:
+        float(ns_value), float(sf_value)
+        return "Number changed"
+    except ValueError:
+        pass
+    if ns_value.lower() in sf_value.lower() or sf_value.lower() in ns_value.lower():
+        return "Prefix/suffix"
+    return "Value changed"
+
+def _pattern_frame(ns_values, sf_values, counts, total):
+    """Top patterns as a display frame."""
+    return pd.DataFrame({
+        "NetSuite Value": ns_values,
+        "Salesforce Value": sf_values,
+        "Pattern": [describe_transformation(n, s) for n, s in zip(ns_values, sf_values)],
+        "Count": np.asarray(counts, dtype=np.int64),
+        "Share (%)": np.asarray(counts, dtype=np.float64) / total * 100 if total > 0 else 0.0,
+    })
+
+def transformation_patterns(ns_vals, sf_vals, top_k=10):
+    """Most frequent NetSuite → Salesforce rewrites among mismatched value pairs.
+
+    Pairs are grouped on a 64-bit hash of (NetSuite text, Salesforce text)
+    rather than on the strings. Above PATTERN_EXACT_LIMIT pairs the counts come
+    from the streaming Count-Min sketch instead (see heavy_hitter_patterns).
+    """
+    if len(ns_vals) > PATTERN_EXACT_LIMIT:
+        chunks = ((ns_vals.iloc[i:i + PATTERN_CHUNK_ROWS], sf_vals.iloc[i:i + PATTERN_CHUNK_ROWS])
+                  for i in range(0, len(ns_vals), PATTERN_CHUNK_ROWS))
+        return heavy_hitter_patterns(chunks, top_k)
+    ns_text, sf_text = key_strings(ns_vals).to_numpy(), key_strings(sf_vals).to_numpy()
+    codes, _ = pd.factorize(_pair_hashes(ns_text, sf_text))
+    counts = np.bincount(codes)
+    _, first_rows = np.unique(codes, return_index=True)
+    top = np.argsort(-counts, kind="stable")[:top_k]
+    return _pattern_frame(ns_text[first_rows[top]], sf_text[first_rows[top]], counts[top], len(codes))
+
+def heavy_hitter_patterns(chunks, top_k=10, width=1 << 20, depth=4):
+    """Streaming top-k patterns over (NetSuite values, Salesforce values) chunks in bounded memory.
+
+    Each pair hash is counted in a depth × width Count-Min sketch; the pairs
+    with the highest estimates are kept as heavy-hitter candidates. Counts are
+    upper bounds that overestimate by at most about total * e / width.
+    """
+    sketch = np.zeros((depth, width), dtype=np.int64)
+    candidates = {}  # pair hash -> (NetSuite text, Salesforce text)
+    total = 0
+    for ns_chunk, sf_chunk in chunks:
+        ns_text, sf_text = key_strings(ns_chunk).to_numpy(), key_strings(sf_chunk).to_numpy()
+        hashes = _pair_hashes(ns_text, sf_text)
+        total += len(hashes)
+        distinct, first_rows, chunk_counts = np.unique(hashes, return_index=True, return_counts=True)
+        buckets = (distinct[None, :] * _SKETCH_MULTIPLIERS[:depth, None]) >> np.uint64(64 - int(np.log2(width)))
+        for row in range(depth):
+            np.add.at(sketch[row], buckets[row].astype(np.int64), chunk_counts)
+        estimates = sketch[np.arange(depth)[:, None], buckets.astype(np.int64)].min(axis=0)
+        # Keep this chunk's strongest pairs next to the running candidates, then trim
+        for i in np.argsort(-estimates, kind="stable")[:top_k * 4]:
+            candidates.setdefault(int(distinct[i]), (ns_text[first_rows[i]], sf_text[first_rows[i]]))
+        if len(candidates) > top_k * 8:
+            keys = np.fromiter(candidates, dtype=np.uint64, count=len(candidates))
+            kept = keys[np.argsort(-_sketch_estimates(sketch, keys), kind="stable")[:top_k * 4]]
+            candidates = {int(k): candidates[int(k)] for k in kept}
+    if not candidates:
+        return _pattern_frame([], [], [], 0)
+    keys = np.fromiter(candidates, dtype=np.uint64, count=len(candidates))
+    estimates = _sketch_estimates(sketch, keys)
+    top = np.argsort(-estimates, kind="stable")[:top_k]
+    pairs = [candidates[int(keys[i])] for i in top]
+    return _pattern_frame([p[0] for p in pairs], [p[1] for p in pairs], estimates[top], total)
+
+def _sketch_estimates(sketch, hashes):
+    """Count-Min estimates for pair hashes: the smallest counter over the sketch rows."""
+    depth, width = sketch.shape
+    buckets = (hashes[None, :] * _SKETCH_MULTIPLIERS[:depth, None]) >> np.uint64(64 - int(np.log2(width)))
+    return sketch[np.arange(depth)[:, None], buckets.astype(np.int64)].min(axis=0)
+
+# -------------------------
+# Fix Generation Functions
+# -------------------------
+FIX_BATCH_ROWS = 500  # records per UPDATE ... CASE statement
+API_BATCH_ROWS = 200  # records per bulk-API payload line
+FIX_BLOCK_ROWS = 50_000  # records rendered together before being cut into batches
+
+def field_mismatch_totals(bitmap):
+    """Number of mismatched records per field."""
+    return pd.Series(_popcount(bitmap["by_field"]), index=bitmap["fields"], dtype=np.int64)
+
+def fix_frame(merged, ns, field, bitmap, key_columns):
+    """Key values, current NetSuite value and target Salesforce value of every record mismatching on `field`."""
+    mask = field_mismatches(bitmap, field)
+    rows = merged["_ns_row"].to_numpy()[mask]
+    fixes = {col: ns[col].iloc[rows].to_numpy() for col in key_columns}
+    fixes["old_value"] = merged[f"{field}_NS"].to_numpy()[mask]
+    fixes["new_value"] = merged[f"{field}_SF"].to_numpy()[mask]
+    return pd.DataFrame(fixes)
+
+def _sql_identifier(name):
+    """Double-quoted SQL identifier (field names may contain spaces)."""
+    return '"' + str(name).replace('"', '""') + '"'
+
+def _sql_literals(values):
+    """SQL string literals for a column of values, NULL for missing ones."""
+    values = pd.Series(values).reset_index(drop=True)
+    quoted = "'" + key_strings(values).str.replace("'", "''", regex=False) + "'"
+    return quoted.where(values.notna(), "NULL")
+
+def _fix_blocks(fixes, batch_rows):
+    """Slices of `fixes` that are vectorized in one go: many batches, but never the whole frame at once."""
+    block_rows = batch_rows * max(1, FIX_BLOCK_ROWS // batch_rows)
+    for start in range(0, len(fixes), block_rows):
+        yield fixes.iloc[start:start + block_rows]
+
+def _key_conditions(block, key_columns):
+    """Per-record `key = literal` conditions of a block (parenthesized for composite keys), and the first key's literals."""
+    key_sql = [_sql_identifier(col) for col in key_columns]
+    key_literals = [_sql_literals(block[col]) for col in key_columns]
+    conditions = f"{key_sql[0]} = " + key_literals[0]
+    for name, literals in zip(key_sql[1:], key_literals[1:]):
+        conditions = conditions + f" AND {name} = " + literals
+    if len(key_columns) > 1:
+        conditions = "(" + conditions + ")"
+    return conditions, key_literals[0]
+
+def _where_keys(conditions, literals, key_columns):
+    """WHERE clause addressing a batch of records: `key IN (...)`, or OR-ed conditions for composite keys."""
+    if len(key_columns) > 1:
+        return "\n   OR ".join(conditions)
+    return f"{_sql_identifier(key_columns[0])} IN ({', '.join(literals)})"
+
+def sql_fix_statements(fixes, field, key_columns, table="records", batch_rows=FIX_BATCH_ROWS):
+    """Yield one key-addressed UPDATE ... CASE statement per batch of fixes.
+
+    Records are addressed by their match key, never by the old value, so an
+    update cannot touch rows that merely share that value. Literals are built
+    vectorized per block; each batch only joins precomputed strings.
+    """
+    column, table_sql = _sql_identifier(field), _sql_identifier(table)
+    for block in _fix_blocks(fixes, batch_rows):
+        conditions, literals = _key_conditions(block, key_columns)
+        cases = ("\n    WHEN " + conditions + " THEN " + _sql_literals(block["new_value"])).to_numpy()
+        conditions, literals = conditions.to_numpy(), literals.to_numpy()
+        for start in range(0, len(block), batch_rows):
+            batch = slice(start, start + batch_rows)
+            where = _where_keys(conditions[batch], literals[batch], key_columns)
+            yield f"UPDATE {table_sql} SET {column} = CASE{''.join(cases[batch])}\n    ELSE {column} END\nWHERE {where};\n"
+
+def pattern_fix_statements(fixes, patterns, field, key_columns, table="records", batch_rows=FIX_BATCH_ROWS):
+    """Yield the fixes grouped by transformation pattern: one key-addressed UPDATE per pattern and batch.
+
+    A pattern's statements set the field to its Salesforce value on exactly the
+    records showing that (NetSuite, Salesforce) pair, addressed by match key
+    like sql_fix_statements - never on other rows that hold the old value.
+    """
+    column, table_sql = _sql_identifier(field), _sql_identifier(table)
+    old_text, new_text = key_strings(fixes["old_value"]).to_numpy(), key_strings(fixes["new_value"]).to_numpy()
+    for ns_value, sf_value, pattern in zip(patterns["NetSuite Value"], patterns["Salesforce Value"], patterns["Pattern"]):
+        matching = fixes[(old_text == ns_value) & (new_text == sf_value)]
+        yield f"-- {pattern}: {len(matching):,} records\n"
+        if len(matching) == 0:
+            continue
+        # Missing and empty values render alike; each keeps its own literal (NULL or '')
+        for new_literal, group in matching.groupby(_sql_literals(matching["new_value"]).to_numpy(), sort=False):
+            for block in _fix_blocks(group, batch_rows):
+                conditions, literals = _key_conditions(block, key_columns)
+                conditions, literals = conditions.to_numpy(), literals.to_numpy()
+                for start in range(0, len(block), batch_rows):
+                    batch = slice(start, start + batch_rows)
+                    yield f"UPDATE {table_sql} SET {column} = {new_literal}\nWHERE {_where_keys(conditions[batch], literals[batch], key_columns)};\n"
+
+def api_fix_payloads(fixes, field, key_columns, batch_rows=API_BATCH_ROWS):
+    """Yield NDJSON lines, one bulk-update API payload per batch of fixes."""
+    for block in _fix_blocks(fixes, batch_rows):
+        records = pd.DataFrame({col: key_strings(block[col]).to_numpy() for col in key_columns})
+        records["field"] = field
+        for col in ("old_value", "new_value"):
+            values = block[col].reset_index(drop=True)
+            records[col] = key_strings(values).where(values.notna(), None)
+        # One JSON object per record for the whole block, then grouped into payloads
+        objects = records.to_json(orient="records", lines=True).splitlines()
+        for start in range(0, len(objects), batch_rows):
+            yield '{"endpoint": "/api/v1/records/bulk-update", "method": "POST", "payload": [' + ",".join(objects[start:start + batch_rows]) + "]}\n"
+
+def generate_fixes(merged, ns, fields, bitmap, key_columns, output="sql"):
+    """Yield the SQL script ("sql") or NDJSON payload lines ("ndjson") fixing every mismatch of `fields`, batch by batch."""
+    for field in fields:
+        fixes = fix_frame(merged, ns, field, bitmap, key_columns)
+        if output == "sql":
+            yield f"-- {field}: {len(fixes):,} records\n"
+            yield from sql_fix_statements(fixes, field, key_columns)
+        else:
+            yield from api_fix_payloads(fixes, field, key_columns)
+
+# -------------------------
+# Export Functions
+# -------------------------
+EXPORT_CHUNK_ROWS = 100_000  # rows rendered per chunk by every export writer
+EXCEL_MAX_ROWS = 1_048_575  # data rows per worksheet (Excel's limit minus the header)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+TABLE_EXPORT_FORMATS = {  # label -> (file extension, mime type)
+    "CSV": ("csv", "text/csv"),
+    "CSV (gzip)": ("csv.gz", "application/gzip"),
+}
+if pa is not None and pa.Codec.is_available("zstd"):
+    TABLE_EXPORT_FORMATS["CSV (zstd)"] = ("csv.zst", "application/zstd")
+if pq is not None:
+    TABLE_EXPORT_FORMATS["Parquet"] = ("parquet", "application/vnd.apache.parquet")
+
+def compress_stream(chunks, compression="gzip"):
+    """Compress text chunks as they are produced ("gzip", "zstd" or None), so the
+    uncompressed output never sits in memory as one string."""
+    if compression == "zstd":
+        sink = pa.BufferOutputStream()
+        with pa.CompressedOutputStream(sink, "zstd") as compressed:
+            for chunk in chunks:
+                compressed.write(chunk.encode("utf-8"))
+        return sink.getvalue().to_pybytes()
+    buffer = io.BytesIO()
+    if compression is None:
+        for chunk in chunks:
+            buffer.write(chunk.encode("utf-8"))
+        return buffer.getvalue()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=6) as compressed:
+        for chunk in chunks:
+            compressed.write(chunk.encode("utf-8"))
+    return buffer.getvalue()
+
+def csv_chunks(df, chunk_rows=EXPORT_CHUNK_ROWS):
+    """CSV text of `df` in row chunks, header first."""
+    yield df.head(0).to_csv(index=False)
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows].to_csv(index=False, header=False)
+
+def _arrow_safe(df):
+    """Frame Arrow can convert: mixed-type object columns are written as text."""
+    safe = {}
+    for col in df.columns:
+        values = df[col]
+        if values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) not in ("string", "empty", "boolean", "integer", "floating", "datetime", "date"):
+            values = values.astype(str).where(values.notna(), None)
+        safe[str(col)] = values
+    return pd.DataFrame(safe, index=df.index)
+
+def parquet_bytes(df, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Parquet file of `df`, written one row group per chunk."""
+    df = _arrow_safe(df)
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pq.ParquetWriter(sink, schema, compression="zstd") as writer:
+        for start in range(0, max(len(df), 1), chunk_rows):
+            writer.write_table(pa.Table.from_pandas(df.iloc[start:start + chunk_rows], schema=schema, preserve_index=False))
+    return sink.getvalue().to_pybytes()
+
+def export_table(df, export_format):
+    """Encode a frame in one of TABLE_EXPORT_FORMATS; returns the bytes and throughput stats."""
+    start_time = time.perf_counter()
+    if export_format == "Parquet":
+        data = parquet_bytes(df)
+    else:
+        compression = {"CSV (gzip)": "gzip", "CSV (zstd)": "zstd"}.get(export_format)
+        data = compress_stream(csv_chunks(df), compression)
+    return data, _export_stats(len(df), data, start_time)
+
+def _excel_rows(df):
+    """Rows of `df` as lists of values openpyxl can store, converted column by column."""
+    columns = []
+    for col in df.columns:
+        values = df[col]
+        if isinstance(values.dtype, pd.DatetimeTZDtype):
+            values = values.dt.tz_localize(None)
+        columns.append(values.astype(object).where(values.notna(), None).tolist())
+    return zip(*columns)
+
+def reconciliation_workbook(sheets, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Multi-sheet XLSX from {sheet name: frame}, streamed row by row with a write-only workbook.
+
+    openpyxl's write-only mode spools rows to disk instead of building cell
+    objects, so memory stays flat however many rows are written. Sheets longer
+    than Excel's row limit are truncated; returns the bytes and throughput stats.
+    """
+    from openpyxl import Workbook
+    start_time = time.perf_counter()
+    workbook = Workbook(write_only=True)
+    total_rows = 0
+    truncated = []
+    for name, df in sheets.items():
+        sheet = workbook.create_sheet(title=re.sub(r"[\[\]:*?/\\]", "_", str(name))[:31])
+        sheet.append([str(col) for col in df.columns])
+        rows = df.iloc[:EXCEL_MAX_ROWS]
+        if len(df) > EXCEL_MAX_ROWS:
+            truncated.append(str(name))
+        for start in range(0, len(rows), chunk_rows):
+            for record in _excel_rows(rows.iloc[start:start + chunk_rows]):
+                sheet.append(record)
+        total_rows += len(rows)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    data = buffer.getvalue()
+    stats = _export_stats(total_rows, data, start_time)
+    stats["truncated_sheets"] = truncated
+    return data, stats
+
+def _export_stats(rows, data, start_time):
+    """Rows, size and bytes/s of a finished export."""
+    seconds = max(time.perf_counter() - start_time, 1e-6)
+    return {"rows": rows, "bytes": len(data), "seconds": seconds, "bytes_per_second": len(data) / seconds}
+
+# -------------------------
+# Result Cache Functions
+# -------------------------
+RESULT_CACHE_MAX_BYTES = 1_000_000_000  # default memory ceiling of the comparison-result cache
+
+def new_result_cache(max_bytes=RESULT_CACHE_MAX_BYTES):
+    """Empty least-recently-used cache bounded by the total size of its entries, safe to share between threads."""
+    return {"entries": OrderedDict(), "sizes": {}, "bytes": 0, "max_bytes": max_bytes,
+            "hits": 0, "misses": 0, "evictions": 0, "lock": threading.Lock()}
+
+def result_nbytes(value):
+    """Approximate memory held by a cached value: frames, arrays and dicts/lists/tuples of them."""
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        usage = value.memory_usage(deep=True)
+        return int(usage.sum()) if isinstance(usage, pd.Series) else int(usage)
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sum(result_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(result_nbytes(v) for v in value)
+    return sys.getsizeof(value)
+
+def _evict(cache):
+    """Drop least recently used entries until the cache fits its ceiling (caller holds the lock)."""
+    while cache["bytes"] > cache["max_bytes"] and cache["entries"]:
+        key, _ = cache["entries"].popitem(last=False)
+        cache["bytes"] -= cache["sizes"].pop(key)
+        cache["evictions"] += 1
+
+def cache_get(cache, key):
+    """Cached value for `key` (marked most recently used), or None."""
+    with cache["lock"]:
+        if key not in cache["entries"]:
+            cache["misses"] += 1
+            return None
+        cache["entries"].move_to_end(key)
+        cache["hits"] += 1
+        return cache["entries"][key]
+
+def cache_put(cache, key, value):
+    """Store `value` under `key`, evicting older entries to stay under the ceiling.
+
+    Values larger than the whole ceiling are not cached; returns whether it was stored.
+    """
+    size = result_nbytes(value)
+    with cache["lock"]:
+        if key in cache["entries"]:
+            del cache["entries"][key]
+            cache["bytes"] -= cache["sizes"].pop(key)
+        if size > cache["max_bytes"]:
+            return False
+        cache["entries"][key] = value
+        cache["sizes"][key] = size
+        cache["bytes"] += size
+        _evict(cache)
+    return True
+
+def set_cache_ceiling(cache, max_bytes):
+    """Change the memory ceiling, evicting entries if the cache no longer fits."""
+    with cache["lock"]:
+        cache["max_bytes"] = max_bytes
+        _evict(cache)
+
+def cache_stats(cache):
+    """Entries, bytes held, ceiling and hit/miss/eviction counts of a result cache."""
+    with cache["lock"]:
+        return {"entries": len(cache["entries"]), "bytes": cache["bytes"], "max_bytes": cache["max_bytes"],
+                "hits": cache["hits"], "misses": cache["misses"], "evictions": cache["evictions"]}
+
+# -------------------------
+# Comparison Job Functions
+# -------------------------
+JOB_WORKERS = 2  # comparisons computed at the same time; more are queued
+PROGRESSIVE_CHUNK_ROWS = 250_000  # input records merged per chunk; running totals are published after each
+
+def _merge_progressively(ns, sf, merge_key, columns, compared_fields, strategy, progress):
+    """merge_projected in chunks of keys, publishing running totals after each chunk.
+
+    Every record of a key falls in the same chunk, so together the chunks are
+    exactly the full merge (row positions are mapped back to the whole frames).
+    After each chunk `progress` gets a `partial` dict of the counts so far, in
+    the shape of comparison_summary. Returns the merged frame, the compared
+    fields and their fields × records mismatch bits.
+    """
+    chunks = max(1, -(-(len(ns) + len(sf)) // PROGRESSIVE_CHUNK_ROWS))
+    if chunks > 1:
+        # Factorize both sides' keys together: values the merge joins get the same code, hence the same chunk
+        codes, _ = pd.factorize(pd.concat([ns[merge_key], sf[merge_key]], ignore_index=True), use_na_sentinel=False)
+        buckets = (codes[:len(ns)] % chunks, codes[len(ns):] % chunks)
+    parts, part_bits, compared = [], [], None
+    totals = {"NetSuite Records": 0, "Salesforce Records": 0, "Matched": 0, "NS Only": 0, "SF Only": 0}
+    for chunk in range(chunks):
+        if chunks > 1:
+            ns_rows, sf_rows = np.flatnonzero(buckets[0] == chunk), np.flatnonzero(buckets[1] == chunk)
+            part = merge_projected(ns.iloc[ns_rows], sf.iloc[sf_rows], merge_key, columns, strategy)
+            for row_column, rows in (("_ns_row", ns_rows), ("_sf_row", sf_rows)):
+                local = part[row_column].to_numpy()
+                positions = np.full(len(local), -1, dtype=np.int64)
+                positions[local >= 0] = rows[local[local >= 0]]
+                part[row_column] = positions
+        else:
+            ns_rows, sf_rows = ns, sf
+            part = merge_projected(ns, sf, merge_key, columns, strategy)
+        if compared is None:
+            compared = [f for f in compared_fields if f"{f}_NS" in part.columns and f"{f}_SF" in part.columns]
+            field_totals = np.zeros(len(compared), dtype=np.int64)
+        status = merge_status_codes(part)
+        bits = _mismatch_bits(part, compared, status == 0)
+        parts.append(part)
+        part_bits.append(bits)
+        totals["NetSuite Records"] += len(ns_rows)
+        totals["Salesforce Records"] += len(sf_rows)
+        totals["Matched"] += int((status == 0).sum())
+        totals["NS Only"] += int((status == 2).sum())
+        totals["SF Only"] += int((status == 3).sum())
+        field_totals += bits.sum(axis=1)
+        partial = dict(totals, **{"Field Mismatches": dict(zip(compared, field_totals.tolist())),
+                                  "Records Total": len(ns) + len(sf)})
+        progress(0.3 + 0.3 * (chunk + 1) / chunks, f"Merged chunk {chunk + 1}/{chunks}", partial=partial)
+    merged = parts[0] if chunks == 1 else pd.concat(parts, ignore_index=True)
+    return merged, compared, np.concatenate(part_bits, axis=1)
+
+
+def run_comparison(ns, sf, key_columns, fields, compared_fields, strategy=STRATEGY_ALL_PAIRS,
+                   row_budget=MERGE_ROW_BUDGET, rollup_dimensions=None, progress=None):
+    """Align both systems on `key_columns` and build everything the tabs read from the alignment.
+
+    `fields` are merged (compared fields plus date/account columns); `compared_fields`
+    get mismatch bits. Returns a dict with the key profile, the join strategy actually
+    used (all-pairs merges over `row_budget` fall back to pairing by occurrence), the
+    merged frame, mismatch bitmap, rollup cube, key index and orphan positions,
+    plus the wall time and work of every stage.
+    Records are merged in chunks (see _merge_progressively), so `progress` also
+    receives running totals while the merge is under way.
+    Raises ValueError if a composite key cannot be hashed without collisions.
+    """
+    report = progress or (lambda fraction, stage, partial=None: None)
+    stage_starts = []
+
+    def stage(fraction, name):
+        stage_starts.append((name, time.perf_counter()))
+        report(fraction, name)
+
+    composite = len(key_columns) > 1
+    merge_key = " + ".join(key_columns)
+    key_col = "_key_label" if composite else merge_key
+    ns_side, sf_side, key_collisions = ns, sf, 0
+    if composite:
+        stage(0.05, "Hashing composite keys")
+        (ns_hash, sf_hash), key_collisions = hash_key_columns([ns, sf], key_columns)
+        ns_side, sf_side = ns.assign(**{merge_key: ns_hash}), sf.assign(**{merge_key: sf_hash})
+
+    stage(0.15, "Profiling key multiplicity")
+    key_profile = analyze_key_multiplicity(ns_side[merge_key], sf_side[merge_key])
+    if composite and len(key_profile["top_keys"]) > 0:
+        # Show the offending keys as 'a | b' instead of their hashes
+        label_lookup = pd.Series(key_labels(ns, key_columns), index=ns_hash)
+        label_lookup = label_lookup[~label_lookup.index.duplicated()]
+        key_profile["top_keys"].index = label_lookup.reindex(key_profile["top_keys"].index).to_numpy()
+    join_strategy = strategy
+    if strategy == STRATEGY_ALL_PAIRS and key_profile["predicted_rows"][strategy] > row_budget:
+        join_strategy = STRATEGY_BY_OCCURRENCE
+
+    stage(0.3, "Merging records")
+    merge_error = None
+    try:
+        merged, rollup_fields, bits = _merge_progressively(
+            ns_side, sf_side, merge_key, [merge_key] + list(fields), compared_fields, join_strategy, report)
+        if composite:
+            # Readable key, taken from whichever side has the record
+            stage(0.55, "Labelling composite keys")
+            ns_labels, sf_labels = key_labels(ns, key_columns), key_labels(sf, key_columns)
+            ns_rows, sf_rows = merged["_ns_row"].to_numpy(), merged["_sf_row"].to_numpy()
+            merged[key_col] = np.where(ns_rows >= 0, ns_labels[ns_rows], sf_labels[sf_rows])
+    except ValueError as e:
+        merge_error = str(e)
+        merged = pd.concat([ns, sf], ignore_index=True)
+        merged["_merge"] = "concat"
+        merged["_ns_row"] = np.concatenate([np.arange(len(ns)), np.full(len(sf), -1)])
+        merged["_sf_row"] = np.concatenate([np.full(len(ns), -1), np.arange(len(sf))])
+        rollup_fields = [f for f in compared_fields if f"{f}_NS" in merged.columns and f"{f}_SF" in merged.columns]
+        bits = np.zeros((len(rollup_fields), len(merged)), dtype=bool)
+
+    stage(0.6, "Flagging mismatches")
+    bitmap = _pack_mismatch_bitmap(rollup_fields, bits, merge_status_codes(merged) == 0)
+    stage(0.75, "Building trend rollup")
+    cube = build_rollup_cube(merged, rollup_fields, rollup_dimensions or {}, bitmap)
+    stage(0.9, "Indexing keys")
+    no_rows = np.empty(0, dtype=np.int64)
+    key_index = build_key_index(merged, key_col) if merge_error is None else None
+    orphans = orphan_positions(merged) if merge_error is None else {"ns": no_rows, "sf": no_rows}
+    stage_starts.append((None, time.perf_counter()))
+    return {
+        "key_collisions": key_collisions,
+        "key_profile": key_profile,
+        "join_strategy": join_strategy,
+        "merge_error": merge_error,
+        "merged_df": merged,
+        "rollup_fields": rollup_fields,
+        "mismatch_bitmap": bitmap,
+        "rollup_cube": cube,
+        "key_index": key_index,
+        "orphans": orphans,
+        # Wall time and units of work per stage, for the benchmark history that calibrates explain_comparison
+        "stage_seconds": {name: end - start for (name, start), (_, end) in zip(stage_starts, stage_starts[1:])},
+        "stage_work": comparison_work(len(ns) + len(sf), len(merged), len(key_columns), len(fields), len(rollup_fields)),
+    }
+
+def new_job_pool(max_workers=JOB_WORKERS):
+    """Worker threads plus the registry of queued/running jobs, keyed by what they compute."""
+    return {"executor": ThreadPoolExecutor(max_workers, thread_name_prefix="comparison"),
+            "jobs": {}, "lock": threading.Lock()}
+
+def submit_job(pool, key, fn, *args, **kwargs):
+    """Run fn(*args, progress=..., **kwargs) in the background, unless a job with the same key is already pending.
+
+    Identical requests (same key) share one job. The job dict exposes the future,
+    the latest progress fraction and stage text, the latest `partial` results the
+    job published (if any) and a cancel event; `progress` raises CancelledError
+    once the job is cancelled, so work stops at the next stage.
+    """
+    with pool["lock"]:
+        job = pool["jobs"].get(key)
+        if job is not None:
+            return job
+        job = {"key": key, "progress": 0.0, "stage": "Queued", "partial": None, "started": time.time(), "cancel": threading.Event()}
+
+        def progress(fraction, stage, partial=None):
+            if job["cancel"].is_set():
+                raise CancelledError()
+            job["progress"], job["stage"] = fraction, stage
+            if partial is not None:
+                job["partial"] = partial
+
+        job["future"] = pool["executor"].submit(fn, *args, progress=progress, **kwargs)
+        pool["jobs"][key] = job
+        return job
+
+def cancel_job(pool, key):
+    """Cancel a pending job: dropped if still queued, stopped at its next stage if running."""
+    with pool["lock"]:
+        job = pool["jobs"].pop(key, None)
+    if job is not None:
+        job["cancel"].set()
+        job["future"].cancel()
+
+def finish_job(pool, key, job=None):
+    """Remove a finished job and return its result (re-raises the job's exception).
+
+    Sessions sharing a job may finish it at the same time: pass the job submit_job
+    returned, and its result is read even when another session removed it first.
+    """
+    with pool["lock"]:
+        pending = pool["jobs"].get(key)
+        if pending is not None and (job is None or pending is job):
+            job = pool["jobs"].pop(key)
+    if job is None:
+        raise KeyError(key)
+    return job["future"].result()
+
+# -------------------------
+# Partitioned Comparison Functions
+# -------------------------
+# One JSON summary per finished partition, in a folder per input files and settings (INTEGRITY_CHECKPOINT_DIR moves them)
+CHECKPOINT_DIR = os.environ.get("INTEGRITY_CHECKPOINT_DIR", os.path.join(tempfile.gettempdir(), "integrity_checkpoints"))
+CHECKPOINT_MAX_AGE_DAYS = 7  # checkpoint folders unused for longer are deleted
+MISSING_LABEL = "(none)"  # partition/group of records without a value in its column
+
+def _merge_on_keys(ns, sf, key_columns, fields, strategy):
+    """merge_projected on one or several key columns (several are hashed into one join key first)."""
+    merge_key = " + ".join(key_columns)
+    if len(key_columns) > 1:
+        (ns_hash, sf_hash), _ = hash_key_columns([ns, sf], key_columns)
+        ns, sf = ns.assign(**{merge_key: ns_hash}), sf.assign(**{merge_key: sf_hash})
+    return merge_projected(ns, sf, merge_key, [merge_key] + list(fields), strategy)
+
+def comparison_summary(ns, sf, key_columns, fields, compared_fields, strategy=STRATEGY_ALL_PAIRS):
+    """Record counts and per-field mismatch counts of one comparison, as plain (JSON-ready) numbers."""
+    merged = _merge_on_keys(ns, sf, key_columns, fields, strategy)
+    status = merge_status_codes(merged)
+    compared = [f for f in compared_fields if f"{f}_NS" in merged.columns and f"{f}_SF" in merged.columns]
+    totals = field_mismatch_totals(build_mismatch_bitmap(merged, compared))
+    return {
+        "NetSuite Records": len(ns),
+        "Salesforce Records": len(sf),
+        "Matched": int((status == 0).sum()),
+        "NS Only": int((status == 2).sum()),
+        "SF Only": int((status == 3).sum()),
+        "Field Mismatches": {field: int(n) for field, n in totals.items()},
+    }
+
+def dimension_labels(df, column, bucket=None):
+    """Text label of every row's value in `column` (bucket 'month' gives 'YYYY-MM'); missing values get MISSING_LABEL."""
+    if not column or column not in df.columns:
+        return np.full(len(df), MISSING_LABEL, dtype=object)
+    codes, uniques = _factorize_dimension(df[column], bucket)
+    return np.array([MISSING_LABEL if pd.isna(u) else str(u) for u in uniques], dtype=object)[codes]
+
+def key_partitions(ns, sf, key_columns, column, bucket=None):
+    """Partition label per NetSuite and Salesforce row, equal for every row sharing a key.
+
+    A key's partition comes from its first NetSuite record (its first Salesforce
+    record when NetSuite lacks it), so a record whose date differs between the
+    systems is still compared within one partition instead of becoming two orphans.
+    """
+    def keys(df):
+        if len(key_columns) > 1:
+            return pd.Series(key_labels(df, key_columns))
+        return key_strings(df[key_columns[0]]).str.strip().reset_index(drop=True)
+
+    ns_keys, sf_keys = keys(ns), keys(sf)
+    ns_labels, sf_labels = dimension_labels(ns, column, bucket), dimension_labels(sf, column, bucket)
+    first_ns = pd.Series(ns_labels, index=ns_keys.to_numpy())
+    first_ns = first_ns[~first_ns.index.duplicated()]
+    first_sf = pd.Series(sf_labels, index=sf_keys.to_numpy())
+    first_sf = first_sf[~first_sf.index.duplicated()]
+    ns_partition = first_ns.reindex(ns_keys).to_numpy()
+    sf_partition = first_ns.reindex(sf_keys).to_numpy()
+    missing = pd.isna(sf_partition)
+    sf_partition[missing] = first_sf.reindex(sf_keys[missing]).to_numpy()
+    return ns_partition, sf_partition
+
+def frame_digest(df):
+    """Content hash of a frame's rows and column names, for detecting changed partitions."""
+    digest = hashlib.sha1(",".join(map(str, df.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def _checkpoint_path(checkpoint_dir, label):
+    """Checkpoint file of one partition; the label is made filename-safe."""
+    return os.path.join(checkpoint_dir, re.sub(r"[^0-9A-Za-z._-]", "_", label) + ".json")
+
+def _load_checkpoint(path, digest):
+    """Summary stored at `path` if it was computed from the same partition content, else None."""
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return checkpoint["summary"] if checkpoint.get("digest") == digest else None
+
+def _run_partition(path, digest, ns, sf, key_columns, fields, compared_fields, strategy):
+    """Compare one partition and checkpoint its summary (runs in a worker process)."""
+    summary = comparison_summary(ns, sf, key_columns, fields, compared_fields, strategy)
+    os.makedirs(os.path.dirname(path), exist_ok=True)  # the folder may have been pruned while it sat unused
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"digest": digest, "summary": summary}, f)
+    os.replace(temp_path, path)  # atomic: a crash never leaves a half-written checkpoint
+    return summary
+
+def prune_checkpoints(checkpoint_dir=CHECKPOINT_DIR, max_age_days=CHECKPOINT_MAX_AGE_DAYS):
+    """Delete the checkpoint folders of runs that haven't been used for `max_age_days`."""
+    cutoff = time.time() - max_age_days * 86400
+    try:
+        entries = list(os.scandir(checkpoint_dir))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass
+
+def run_partitioned_comparison(ns, sf, key_columns, fields, compared_fields, partition_col, bucket=None,
+                               strategy=STRATEGY_ALL_PAIRS, source=None, checkpoint_dir=CHECKPOINT_DIR,
+                               max_workers=None, progress=None):
+    """Compare both systems partition by partition (e.g. per month), resuming from disk checkpoints.
+
+    Partitions are compared in parallel worker processes; each finished partition
+    is written to `checkpoint_dir` under a hash of the input files (`source`, e.g.
+    the uploaded file names) and the comparison settings. A re-run, after a crash
+    or with updated exports, reuses every partition whose content is unchanged and
+    recomputes only missing or changed ones. Checkpoints of partitions that no
+    longer exist are removed, and folders unused for CHECKPOINT_MAX_AGE_DAYS are
+    pruned. Returns the per-partition table, the combined totals and how many
+    partitions were reused.
+    """
+    report = progress or (lambda fraction, stage: None)
+    start_time = time.perf_counter()
+    settings = json.dumps([source, list(key_columns), list(fields), sorted(compared_fields), partition_col, bucket, strategy], default=str)
+    root_dir = checkpoint_dir
+    checkpoint_dir = os.path.join(root_dir, hashlib.sha1(settings.encode()).hexdigest()[:16])
+    os.makedirs(checkpoint_dir, exist_ok=True)
+
+    report(0.02, "Assigning partitions")
+    columns = list(dict.fromkeys(list(key_columns) + list(fields)))
+    ns, sf = ns[[c for c in columns if c in ns.columns]], sf[[c for c in columns if c in sf.columns]]
+    ns_partition, sf_partition = key_partitions(ns, sf, key_columns, partition_col, bucket)
+    ns_groups = pd.Series(np.arange(len(ns))).groupby(ns_partition).indices
+    sf_groups = pd.Series(np.arange(len(sf))).groupby(sf_partition).indices
+    labels = sorted(set(ns_groups) | set(sf_groups))
+
+    summaries, pending = {}, []
+    for label in labels:
+        ns_part = ns.iloc[ns_groups.get(label, [])]
+        sf_part = sf.iloc[sf_groups.get(label, [])]
+        digest = hashlib.sha1((frame_digest(ns_part) + frame_digest(sf_part)).encode()).hexdigest()
+        path = _checkpoint_path(checkpoint_dir, label)
+        summary = _load_checkpoint(path, digest)
+        if summary is not None:
+            summaries[label] = summary
+        else:
+            pending.append((label, path, digest, ns_part, sf_part))
+    reused = len(summaries)
+
+    if pending:
+        report(0.05, f"{reused} of {len(labels)} partitions restored, computing {len(pending)}")
+        workers = max(1, min(max_workers or os.cpu_count() or 1, len(pending)))
+        # Spawned workers: forking a multi-threaded server process is unsafe
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = {
+                executor.submit(_run_partition, path, digest, ns_part, sf_part, key_columns, fields, compared_fields, strategy): label
+                for label, path, digest, ns_part, sf_part in pending
+            }
+            try:
+                for done, future in enumerate(as_completed(futures), start=1):
+                    summaries[futures[future]] = future.result()
+                    report(0.05 + 0.9 * done / len(pending), f"Partition {futures[future]} done ({reused + done} of {len(labels)})")
+            except CancelledError:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+    report(0.98, "Combining partitions")
+    computed = {label for label, *_ in pending}
+    partitions = pd.DataFrame([
+        {"Partition": label, **{k: v for k, v in summaries[label].items() if k != "Field Mismatches"},
+         "Mismatched Values": sum(summaries[label]["Field Mismatches"].values()), "Restored": label not in computed}
+        for label in labels
+    ])
+    field_totals = pd.DataFrame([summaries[label]["Field Mismatches"] for label in labels]).sum().astype(np.int64) if labels else pd.Series(dtype=np.int64)
+    current = {os.path.basename(_checkpoint_path(checkpoint_dir, label)) for label in labels}
+    for entry in os.scandir(checkpoint_dir):
+        if entry.name.endswith(".json") and entry.name not in current:
+            try:
+                os.remove(entry.path)  # a partition the data no longer has
+            except OSError:
+                pass
+    os.utime(checkpoint_dir)  # in use: keep it out of the age-based pruning
+    prune_checkpoints(root_dir)
+    return {
+        "partitions": partitions,
+        "totals": partitions.drop(columns=["Partition", "Restored"]).sum().to_dict() if labels else {},
+        "field_mismatches": field_totals,
+        "reused": reused,
+        "computed": len(pending),
+        "seconds": time.perf_counter() - start_time,
+    }
+
+# -------------------------
+# Aggregate Reconciliation Functions
+# -------------------------
+_ROW_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+def _value_hashes(values):
+    """64-bit hash per value of the normalized text (see key_strings), so 1001 and 1001.0 hash alike."""
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    hashes = pd.util.hash_pandas_object(key_strings(uniques).str.strip(), index=False).to_numpy()
+    return hashes[codes]
+
+def group_aggregates(df, dimensions, sum_fields, hash_fields):
+    """Per-group record count, sums of `sum_fields` and a content hash of `hash_fields`, in one scan.
+
+    `dimensions` maps a label to (column, bucket) as for the rollup cube. The
+    content hash adds up one hash per row, so it does not depend on row order
+    but changes if any hashed value of any row in the group changes.
+    """
+    labels = pd.DataFrame({name: dimension_labels(df, column, bucket) for name, (column, bucket) in dimensions.items()})
+    codes = labels.groupby(list(dimensions), sort=False).ngroup().to_numpy()
+    aggregates = labels.drop_duplicates(ignore_index=True)  # same first-appearance order as the group codes
+    n_groups = len(aggregates)
+    aggregates["Records"] = np.bincount(codes, minlength=n_groups)
+    for field in sum_fields:
+        values = pd.to_numeric(df[field], errors="coerce").fillna(0).to_numpy(dtype=np.float64) if field in df.columns else np.zeros(len(df))
+        aggregates[field] = np.bincount(codes, weights=values, minlength=n_groups)
+    row_hashes = np.zeros(len(df), dtype=np.uint64)
+    for field in hash_fields:
+        column_hashes = _value_hashes(df[field]) if field in df.columns else np.zeros(len(df), dtype=np.uint64)
+        row_hashes = row_hashes * _ROW_HASH_MULTIPLIER + column_hashes
+    group_hashes = np.zeros(n_groups, dtype=np.uint64)
+    np.add.at(group_hashes, codes, row_hashes)
+    aggregates["_hash"] = group_hashes
+    return aggregates
+
+def compare_group_aggregates(ns_aggregates, sf_aggregates, dimensions, sum_fields):
+    """Side-by-side group summaries with a status per group.
+
+    'Agree' means equal counts, sums and content hash; 'Totals differ' means a
+    count or sum is off; 'Values differ' means totals agree but some row values
+    do not; groups present on one side only are 'NS Only' / 'SF Only'.
+    """
+    names = list(dimensions)
+    both = ns_aggregates.merge(sf_aggregates, on=names, how="outer", suffixes=(" (NS)", " (SF)"), indicator=True)
+    measures = ["Records"] + list(sum_fields)
+    for measure in measures:
+        both[[f"{measure} (NS)", f"{measure} (SF)"]] = both[[f"{measure} (NS)", f"{measure} (SF)"]].fillna(0)
+        both[f"{measure} Δ"] = both[f"{measure} (SF)"] - both[f"{measure} (NS)"]
+    totals_agree = np.logical_and.reduce([
+        np.isclose(both[f"{m} (NS)"].to_numpy(dtype=np.float64), both[f"{m} (SF)"].to_numpy(dtype=np.float64), rtol=1e-9, atol=1e-6)
+        for m in measures
+    ])
+    hashes_agree = (both["_hash (NS)"] == both["_hash (SF)"]).to_numpy()
+    merge = both["_merge"].astype(str).to_numpy()
+    both["Status"] = np.select(
+        [merge == "left_only", merge == "right_only", ~totals_agree, ~hashes_agree],
+        ["NS Only", "SF Only", "Totals differ", "Values differ"],
+        "Agree"
+    )
+    ordered = names + ["Status"] + [f"{m} {side}" for m in measures for side in ("(NS)", "(SF)", "Δ")]
+    return both[ordered].sort_values(names, ignore_index=True)
+
+def group_rows_mask(df, dimensions, groups):
+    """Bool mask of the rows of `df` that fall in any of `groups` (tuples of dimension labels)."""
+    labels = pd.DataFrame({name: dimension_labels(df, column, bucket) for name, (column, bucket) in dimensions.items()})
+    return pd.MultiIndex.from_frame(labels).isin(list(groups))
+
+def reconcile_group_totals(ns, sf, dimensions, sum_fields, hash_fields, progress=None):
+    """Compare both systems per group (e.g. account × month) from one aggregation pass over each side."""
+    report = progress or (lambda fraction, stage: None)
+    report(0.05, "Aggregating NetSuite")
+    ns_aggregates = group_aggregates(ns, dimensions, sum_fields, hash_fields)
+    report(0.5, "Aggregating Salesforce")
+    sf_aggregates = group_aggregates(sf, dimensions, sum_fields, hash_fields)
+    report(0.95, "Comparing groups")
+    return compare_group_aggregates(ns_aggregates, sf_aggregates, dimensions, sum_fields)
+
+# -------------------------
+# Sampled Estimate Functions
+# -------------------------
+ESTIMATE_SAMPLE_RATE = 0.05  # share of keys compared by a quick estimate
+CONFIDENCE_Z = 1.96  # 95% confidence intervals
+
+KEY_SAMPLE_WIDTH = 64  # characters of a key that decide whether it is sampled
+
+def _key_text_hashes(values):
+    """64-bit hash of each normalized key text (see key_strings), vectorized over the characters.
+
+    FNV-1a over the first KEY_SAMPLE_WIDTH characters, then a splitmix64
+    finalizer so every output bit is usable; much faster than hashing each
+    string object, which matters because sampling must scan every row.
+    """
+    text = key_strings(values).str.strip()
+    width = max(1, min(KEY_SAMPLE_WIDTH, int(text.str.len().max()) if len(text) else 1))
+    chars = text.to_numpy(dtype=f"U{width}").view(np.uint32).reshape(len(text), width)
+    lengths = text.str.len().to_numpy()
+    hashes = np.full(len(text), 0xCBF29CE484222325, dtype=np.uint64)
+    for i in range(width):
+        # Padding is not hashed, so the result does not depend on the longest key in the column
+        hashes = np.where(i < lengths, (hashes ^ chars[:, i]) * np.uint64(0x100000001B3), hashes)
+    hashes ^= hashes >> np.uint64(30)
+    hashes *= np.uint64(0xBF58476D1CE4E5B9)
+    hashes ^= hashes >> np.uint64(27)
+    hashes *= np.uint64(0x94D049BB133111EB)
+    return hashes ^ (hashes >> np.uint64(31))
+
+def key_sample_mask(df, key_columns, rate):
+    """Bool mask of the rows whose key falls in a `rate` share of the key space.
+
+    The decision is a hash of the normalized key, so NetSuite and Salesforce
+    select exactly the same keys (and every record of a selected key).
+    """
+    hashes = np.zeros(len(df), dtype=np.uint64)
+    for col in key_columns:
+        hashes = hashes * _ROW_HASH_MULTIPLIER + _key_text_hashes(df[col])
+    return (hashes >> np.uint64(11)).astype(np.float64) / float(1 << 53) < rate
+
+def wilson_interval(successes, n, z=CONFIDENCE_Z):
+    """Share successes/n with its Wilson score interval, as (estimate, low, high) fractions."""
+    if n == 0:
+        return 0.0, 0.0, 1.0
+    p = successes / n
+    center = (p + z * z / (2 * n)) / (1 + z * z / n)
+    margin = z * np.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return p, max(0.0, center - margin), min(1.0, center + margin)
+
+def estimate_comparison(ns, sf, key_columns, fields, compared_fields, rate=ESTIMATE_SAMPLE_RATE,
+                        strategy=STRATEGY_ALL_PAIRS, progress=None):
+    """Estimate the comparison KPIs from a hash sample of the keys, with 95% confidence intervals.
+
+    Returns the record match rate (records in both systems), the value match
+    rate (compared field values that agree, over records in both systems) and
+    per-field mismatch rates, each as (estimate, low, high) fractions, plus
+    the sample size and the scaled-up number of records. The value match rate
+    interval treats records as clusters of field values, so fields that
+    mismatch together do not overstate its precision.
+    """
+    report = progress or (lambda fraction, stage: None)
+    start_time = time.perf_counter()
+    report(0.05, f"Sampling {rate:.0%} of keys")
+    ns_sample = ns[key_sample_mask(ns, key_columns, rate)]
+    sf_sample = sf[key_sample_mask(sf, key_columns, rate)]
+    report(0.4, f"Comparing {len(ns_sample) + len(sf_sample):,} sampled records")
+    merged = _merge_on_keys(ns_sample, sf_sample, key_columns, fields, strategy)
+    compared = [f for f in compared_fields if f"{f}_NS" in merged.columns and f"{f}_SF" in merged.columns]
+    bitmap = build_mismatch_bitmap(merged, compared)
+    report(0.9, "Estimating")
+    in_both = merge_status_codes(merged) == 0
+    records, matched = len(merged), int(in_both.sum())
+
+    if matched and compared:
+        # Per-record share of agreeing fields; the interval uses their spread across records
+        record_shares = 1 - count_record_mismatches(bitmap)[in_both] / len(compared)
+        value_rate = float(record_shares.mean())
+        margin = CONFIDENCE_Z * float(record_shares.std(ddof=1)) / np.sqrt(matched) if matched > 1 else 1.0
+        value_match = (value_rate, max(0.0, value_rate - margin), min(1.0, value_rate + margin))
+    else:
+        value_match = (0.0, 0.0, 1.0)
+    field_rates = [wilson_interval(int(n), matched) for n in field_mismatch_totals(bitmap)]
+    return {
+        "rate": rate,
+        "sampled_records": records,
+        "sampled_matched": matched,
+        "estimated_records": int(round(records / rate)) if rate > 0 else 0,
+        "record_match": wilson_interval(matched, records),
+        "value_match": value_match,
+        "field_mismatch": pd.DataFrame(field_rates, index=pd.Index(compared, name="Field"), columns=["Estimate", "Low", "High"]),
+        "seconds": time.perf_counter() - start_time,
+    }
+
+# -------------------------
+# Cost Estimate Functions
+# -------------------------
+# Measured stage timings, one JSON object per line, next to this module (INTEGRITY_BENCHMARK_HISTORY moves it)
+BENCHMARK_HISTORY = os.environ.get(
+    "INTEGRITY_BENCHMARK_HISTORY", os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_history.jsonl")
+)
+HISTORY_MAX_BYTES = 4 * 1024 ** 2  # past this size the history keeps only its newest half
+CALIBRATION_RUNS = 20  # latest measurements of a stage that calibrate its rate
+MEMORY_BUDGET_BYTES = 512 * 1024 ** 2  # memory one comparison may add (RAM of a standard dyno)
+INTERACTIVE_SECONDS = 30  # longest full run recommended without a quick look first
+MERGE_MEMORY_FACTOR = 2.5  # peak memory of a merge relative to its result (join indexers, column takes)
+EXPLAIN_SAMPLE_ROWS = 10_000  # rows measured to estimate bytes per record
+
+PLAN_IN_MEMORY = "In-memory row-level diff"
+PLAN_OUT_OF_CORE = "Partitioned by month (out-of-core)"
+PLAN_SAMPLED = "Quick estimate from a key sample"
+PLAN_AGGREGATE = "Quick totals first (aggregate-first)"
+
+# Seconds per unit of work (see comparison_work) until the benchmark history has measurements
+DEFAULT_STAGE_RATES = {
+    "Hashing composite keys": 9.0e-7,
+    "Profiling key multiplicity": 2.5e-7,
+    "Merging records": 1.1e-7,
+    "Labelling composite keys": 1.0e-6,
+    "Flagging mismatches": 1.0e-8,
+    "Building trend rollup": 2.0e-8,
+    "Indexing keys": 1.0e-6,
+}
+_HISTORY_LOCK = threading.Lock()
+
+def comparison_work(input_rows, merged_rows, key_count, field_count, compared_count):
+    """Units of work of every run_comparison stage: the quantity its time grows with."""
+    return {
+        "Hashing composite keys": input_rows * key_count if key_count > 1 else 0,
+        "Profiling key multiplicity": input_rows,
+        "Merging records": merged_rows * (field_count + compared_count),
+        "Labelling composite keys": input_rows * key_count if key_count > 1 else 0,
+        "Flagging mismatches": merged_rows * compared_count,
+        "Building trend rollup": merged_rows * (compared_count + 1),
+        "Indexing keys": merged_rows,
+    }
+
+def record_stage_timings(stage_seconds, stage_work, source="app", path=BENCHMARK_HISTORY, **extra):
+    """Append one measured run (seconds and work per stage) to the benchmark history.
+
+    `extra` fields (e.g. the code version or memory use) are stored on every line.
+    """
+    timestamp = time.strftime("%Y-%m-%dT%H:%M:%S")
+    lines = [
+        json.dumps({"time": timestamp, "source": source, "stage": name, "units": int(stage_work.get(name, 0)),
+                    "seconds": round(seconds, 6), **extra})
+        for name, seconds in stage_seconds.items()
+    ]
+    with _HISTORY_LOCK:
+        with open(path, "a") as f:
+            f.write("".join(line + "\n" for line in lines))
+        _trim_history(path)
+
+def _trim_history(path, max_bytes=HISTORY_MAX_BYTES):
+    """Rotate a history past `max_bytes`: keep the newest lines that fit in half of it."""
+    try:
+        if os.path.getsize(path) <= max_bytes:
+            return
+        with open(path, "rb") as f:
+            f.seek(-(max_bytes // 2), os.SEEK_END)
+            tail = f.read()
+    except OSError:
+        return
+    tail = tail[tail.find(b"\n") + 1:]  # drop the line cut in half
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(tail)
+    os.replace(temp_path, path)
+
+def stage_rates(path=BENCHMARK_HISTORY, runs=CALIBRATION_RUNS):
+    """Seconds per unit of work of every stage: the median of its latest `runs` measurements.
+
+    Stages without measurements keep DEFAULT_STAGE_RATES. Returns the rates and
+    the names of the stages calibrated from history.
+    """
+    measured = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # a line cut off by a crash
+                if entry.get("stage") in DEFAULT_STAGE_RATES and entry.get("units", 0) > 0:
+                    measured.setdefault(entry["stage"], []).append(entry["seconds"] / entry["units"])
+    except OSError:
+        pass
+    rates = dict(DEFAULT_STAGE_RATES)
+    for name, values in measured.items():
+        rates[name] = float(np.median(values[-runs:]))
+    return rates, sorted(measured)
+
+def _key_sketch(df, key_columns):
+    """The join key as the merge sees it; several columns are folded into one cheap (not normalized) hash."""
+    if len(key_columns) == 1:
+        return df[key_columns[0]]
+    hashes = np.zeros(len(df), dtype=np.uint64)
+    for col in key_columns:
+        values = df[col]
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            values = values.astype(np.float64)  # 1001 and 1001.0 join, so they must hash alike
+        hashes = hashes * _ROW_HASH_MULTIPLIER + pd.util.hash_pandas_object(values, index=False).to_numpy()
+    return pd.Series(hashes)
+
+def _bytes_per_row(df, columns):
+    """Average in-memory bytes of one record's `columns`, measured on an evenly spread sample."""
+    if len(df) == 0:
+        return 0.0
+    sample = df[columns].iloc[::max(1, len(df) // EXPLAIN_SAMPLE_ROWS)]
+    return float(sample.memory_usage(deep=True, index=False).sum()) / len(sample)
+
+def explain_comparison(ns, sf, key_columns, fields, compared_fields, strategy=STRATEGY_ALL_PAIRS,
+                       row_budget=MERGE_ROW_BUDGET, partition_col=None, memory_budget=MEMORY_BUDGET_BYTES,
+                       history=BENCHMARK_HISTORY):
+    """Predict what run_comparison will cost, from metadata only, and recommend how to run it.
+
+    Uses row counts, key multiplicities (the merged row count per strategy),
+    bytes per record of the merged fields and per-stage rates calibrated from
+    the benchmark history. Returns the predicted merged rows, join strategy,
+    per-stage seconds, peak added memory, and a recommended plan (PLAN_*)
+    with the reason; out-of-core is only offered when a `partition_col` exists.
+    """
+    start_time = time.perf_counter()
+    profile = analyze_key_multiplicity(_key_sketch(ns, key_columns), _key_sketch(sf, key_columns))
+    join_strategy = strategy
+    if strategy == STRATEGY_ALL_PAIRS and profile["predicted_rows"][strategy] > row_budget:
+        join_strategy = STRATEGY_BY_OCCURRENCE
+    merged_rows = profile["predicted_rows"][join_strategy]
+    input_rows = len(ns) + len(sf)
+    columns = list(dict.fromkeys(c for c in fields if c in ns.columns and c in sf.columns))
+    compared = [f for f in compared_fields if f in columns]
+
+    # Merged frame: both sides' fields plus row positions and the merge indicator per merged row
+    merged_bytes = merged_rows * (_bytes_per_row(ns, columns) + _bytes_per_row(sf, columns) + 2 * 8 + 1)
+    if len(key_columns) > 1:
+        merged_bytes += merged_rows * 72  # readable 'a | b' key label objects
+    # Peak: the merge's temporaries, unpacked mismatch bits (1 byte per field and row) and the key index
+    memory_bytes = int(MERGE_MEMORY_FACTOR * merged_bytes + merged_rows * (len(compared) + 16))
+
+    rates, calibrated = stage_rates(history)
+    work = comparison_work(input_rows, merged_rows, len(key_columns), len(columns), len(compared))
+    stages = pd.DataFrame({
+        "Stage": list(work),
+        "Work": list(work.values()),
+        "Seconds": [work[name] * rates[name] for name in work],
+        "Calibrated": [name in calibrated for name in work],
+    })
+    stages = stages[stages["Work"] > 0].reset_index(drop=True)
+    seconds = float(stages["Seconds"].sum())
+
+    if memory_bytes > memory_budget and partition_col:
+        plan = PLAN_OUT_OF_CORE
+        reason = f"The merge needs about {memory_bytes / 1e6:,.0f} MB, over the {memory_budget / 1e6:,.0f} MB budget: compare one month at a time"
+    elif memory_bytes > memory_budget:
+        plan = PLAN_SAMPLED
+        reason = f"The merge needs about {memory_bytes / 1e6:,.0f} MB, over the {memory_budget / 1e6:,.0f} MB budget and there is no column to partition by"
+    elif seconds > INTERACTIVE_SECONDS and partition_col:
+        plan = PLAN_AGGREGATE
+        reason = f"A full run takes about {seconds:,.0f}s: check totals per account and month first, then diff only the groups that disagree"
+    elif seconds > INTERACTIVE_SECONDS:
+        plan = PLAN_SAMPLED
+        reason = f"A full run takes about {seconds:,.0f}s: estimate the KPIs from a sample first"
+    else:
+        plan = PLAN_IN_MEMORY
+        reason = f"Fits in memory and finishes in about {max(seconds, 0.1):,.1f}s"
+    # Sample just small enough for the memory budget and an interactive wait
+    sample_rate = min(memory_budget / max(memory_bytes, 1), INTERACTIVE_SECONDS / max(seconds, 1e-9)) / 2
+    return {
+        "input_rows": input_rows,
+        "predicted_rows": merged_rows,
+        "join_strategy": join_strategy,
+        "many_to_many_keys": profile["many_to_many_keys"],
+        "stages": stages,
+        "seconds": seconds,
+        "memory_bytes": memory_bytes,
+        "memory_budget": memory_budget,
+        "calibrated_stages": len(calibrated),
+        "plan": plan,
+        "reason": reason,
+        "sample_rate": float(np.clip(sample_rate, 0.01, 0.25)),
+        "explain_seconds": time.perf_counter() - start_time,
+    }
+
+# -------------------------
+# Instrumentation Functions
+# -------------------------
+def memory_kb(field):
+    """A memory figure of this process from /proc (VmRSS, VmHWM), in KB; None off Linux."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def reset_peak_memory():
+    """Restart the peak-RSS counter (VmHWM), so the next reading covers one stage only."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def set_memory_tracing(enabled):
+    """Start or stop tracemalloc for the whole process (it slows allocation-heavy stages while on)."""
+    if enabled and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not enabled and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+# Operations of every session being profiled while tracemalloc traces (its peak counter is process-wide)
+_TRACED_OPERATIONS = []
+_TRACE_LOCK = threading.Lock()
+
+def _fold_traced_peak():
+    """Carry the traced peak so far into every open operation; call with _TRACE_LOCK held."""
+    current, peak = tracemalloc.get_traced_memory()
+    for entry in _TRACED_OPERATIONS:
+        entry["peak"] = max(entry["peak"], peak)
+    return current
+
+def new_run_profile():
+    """An empty profile of one run, filled by profile_stage."""
+    return {"started": time.perf_counter(), "operations": [], "open": []}
+
+@contextmanager
+def profile_stage(profile, name, rows=0):
+    """Record the enclosed block as one operation of `profile`: wall and CPU time, rows/s and memory.
+
+    CPU time is the calling thread's, so other sessions' work doesn't count. Memory
+    can't be split that way: with tracemalloc tracing, the peak and retained figures
+    are the whole process's (Python and numpy allocations of every session) while
+    the block ran. The shared peak counter is only reset after its value is carried
+    into every open operation, so concurrent sessions never cut each other's peaks
+    short. RSS after the block is always recorded. The yielded dict takes a row
+    count known only inside the block as entry["rows"].
+    """
+    tracing = tracemalloc.is_tracing()
+    entry = {"rows": rows, "peak": 0, "traced": 0}
+    if tracing:
+        with _TRACE_LOCK:
+            entry["traced"] = entry["peak"] = _fold_traced_peak()
+            tracemalloc.reset_peak()
+            _TRACED_OPERATIONS.append(entry)
+    profile["open"].append(entry)
+    wall_start, cpu_start = time.perf_counter(), time.thread_time()
+    try:
+        yield entry
+    finally:
+        seconds, cpu_seconds = time.perf_counter() - wall_start, time.thread_time() - cpu_start
+        profile["open"].pop()
+        peak_mb = retained_mb = traced_mb = None
+        if tracing:
+            with _TRACE_LOCK:
+                if tracemalloc.is_tracing():
+                    current = _fold_traced_peak()
+                    peak_mb, retained_mb, traced_mb = (entry["peak"] - entry["traced"]) / 1e6, (current - entry["traced"]) / 1e6, current / 1e6
+                _TRACED_OPERATIONS[:] = [open_entry for open_entry in _TRACED_OPERATIONS if open_entry is not entry]
+        rss = memory_kb("VmRSS")
+        profile["operations"].append({
+            "Operation": name,
+            "Depth": len(profile["open"]),
+            "Start (s)": wall_start - profile["started"],
+            "End (s)": wall_start + seconds - profile["started"],
+            "Seconds": seconds,
+            "CPU Seconds": cpu_seconds,
+            "Rows": entry["rows"],
+            "Rows/s": entry["rows"] / seconds if entry["rows"] and seconds > 0 else None,
+            "Process Peak (MB)": peak_mb,
+            "Process Retained (MB)": retained_mb,
+            "Traced (MB)": traced_mb,
+            "RSS (MB)": rss / 1024 if rss is not None else None,
+        })
+
+def operation_timeline(profile):
+    """The profile's operations as a frame in start order, for the timeline."""
+    operations = pd.DataFrame(profile["operations"])
+    return operations.sort_values("Start (s)", kind="stable").reset_index(drop=True) if len(operations) > 0 else operations
+
+def slowest_operations(profile, n=5):
+    """The `n` operations that took the most wall time."""
+    operations = pd.DataFrame(profile["operations"])
+    return operations.nlargest(n, "Seconds").reset_index(drop=True) if len(operations) > 0 else operations
@@ -0,0 +1,243 @@
+"""Concurrent-session load test of the dashboard, driven in-process with Streamlit's AppTest.
+
+    python load_test.py --users 1 2 4 8 --rows 5000
+
+Each simulated analyst is one AppTest session of Ht.py, all in this one process
+(like the Procfile's single `streamlit run`), sharing its caches and worker
+pool. Every session goes upload -> compare -> drill-down -> export. For each
+session count the harness reports p50/p95 rerun latency, throughput and memory.
+
+Uploads are served from generated workbooks and no email ever leaves the
+process: SMTP is replaced by an offline stub that only counts messages.
+"""
+import argparse
+import contextlib
+import io
+import os
+import smtplib
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import streamlit as st
+from streamlit import config
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest, app_test
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+from benchmark import generate_workload, write_workbook  # noqa: E402
+from integrity_engine import memory_kb, reset_peak_memory  # noqa: E402
+
+APP_PATH = os.path.join(REPO_DIR, "Ht.py")
+UPLOAD_LABELS = ("Upload NetSuite XLSX", "Upload Salesforce XLSX")
+EXPORT_KEYS = ("download_drill_comparison", "download_ns_orphans", "download_reconciliation_workbook")
+POLL_SECONDS = 0.5  # matches the job progress fragment's refresh
+RUN_TIMEOUT = 600  # seconds one rerun may take before the session counts as failed
+
+# -------------------------
+# Session Stubs
+# -------------------------
+class _Upload(io.BytesIO):
+    """An uploaded file as Streamlit hands it to the app."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            super().__init__(f.read())
+        self.name = os.path.basename(path)
+        self.file_id = path
+
+class OfflineSMTP:
+    """SMTP / SMTP_SSL replacement: accepts the app's calls and counts messages, never connects."""
+    sent = 0
+    lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def _count(self, *args, **kwargs):
+        with OfflineSMTP.lock:
+            OfflineSMTP.sent += 1
+        return {}
+
+    def __getattr__(self, name):
+        # ehlo, starttls, login, set_debuglevel, quit, ...: accepted and ignored
+        return lambda *args, **kwargs: None
+
+    sendmail = send_message = _count
+
+def install_stubs():
+    """Serve uploads from each session's workbook pair, disable outgoing email, allow simulated clicks
+    and let sessions rerun concurrently.
+
+    A session picks its workbooks with session_state["load_test_uploads"]
+    ({uploader label: path}). Download buttons build their data lazily when
+    clicked; a session "clicks" them by listing their keys in
+    session_state["load_test_clicks"], which builds the data on its next rerun.
+    """
+    def file_uploader(label, *args, **kwargs):
+        path = st.session_state.get("load_test_uploads", {}).get(label)
+        return _Upload(path) if path else None
+
+    original_download_button = st.download_button
+
+    def download_button(label, data, *args, **kwargs):
+        if callable(data) and kwargs.get("key") in st.session_state.get("load_test_clicks", ()):
+            data = data()
+            st.session_state["load_test_exports"] = st.session_state.get("load_test_exports", 0) + 1
+        return original_download_button(label, data, *args, **kwargs)
+
+    # AppTest installs a runtime for each rerun and removes it afterwards, so concurrent sessions
+    # would remove each other's mid-run: keep serving the latest one, like the server's single Runtime
+    installed = {}
+
+    def runtime_instance(cls):
+        if cls._instance is not None:
+            installed["runtime"] = cls._instance
+        if "runtime" not in installed:
+            raise RuntimeError("Runtime hasn't been created!")
+        return installed["runtime"]
+
+    Runtime.instance = classmethod(runtime_instance)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or "runtime" in installed)
+
+    # ...and compiles the script on every rerun, which concurrent threads can't do safely:
+    # share one compiled copy, as the server does
+    shared_scripts = ScriptCache()
+    original_get_bytecode = ScriptCache.get_bytecode
+    ScriptCache.get_bytecode = lambda self, script_path: original_get_bytecode(shared_scripts, script_path)
+
+    # ...and patches the config for each rerun, which overlapping reruns undo for each other:
+    # patch it once for the whole run
+    config.set_option("global.appTest", True)
+    app_test.patch_config_options = lambda overrides: contextlib.nullcontext()
+
+    st.sidebar.file_uploader = file_uploader
+    st.download_button = download_button
+    smtplib.SMTP = smtplib.SMTP_SSL = OfflineSMTP
+
+# -------------------------
+# Simulated Sessions
+# -------------------------
+def prepare_workloads(folder, users, rows, shared_files):
+    """Workbook pair per simulated user (one pair for everyone with `shared_files`)."""
+    pairs = []
+    for user in range(1 if shared_files else users):
+        ns, sf = generate_workload(rows, seed=user)
+        paths = [os.path.join(folder, f"{system}_{user}.xlsx") for system in ("netsuite", "salesforce")]
+        write_workbook(ns, paths[0])
+        write_workbook(sf, paths[1])
+        pairs.append((dict(zip(UPLOAD_LABELS, paths)), str(ns.iloc[0, 0])))
+    return pairs
+
+def _job_running(at):
+    """True while the page shows a background job's progress bar."""
+    return any("⏳" in str(getattr(bar, "proto", "")) for bar in at.get("progress"))
+
+def run_session(uploads, lookup_key):
+    """One analyst: upload -> compare -> drill-down -> export. Returns the timed reruns and any errors."""
+    at = AppTest.from_file(APP_PATH, default_timeout=RUN_TIMEOUT)
+    at.session_state["password_correct"] = True
+    at.session_state["load_test_uploads"] = uploads
+    reruns, errors = [], []
+
+    def timed(step, action):
+        start = time.perf_counter()
+        action()
+        reruns.append({"step": step, "seconds": time.perf_counter() - start})
+        errors.extend(e.message for e in at.exception)
+
+    session_start = time.perf_counter()
+    timed("upload", at.run)
+    compare = [button for button in at.button if button.label == "🔍 Compare Data"]
+    if not compare:
+        errors.append("Compare Data button missing after upload")
+        return {"reruns": reruns, "errors": errors, "results_seconds": None, "exports": 0}
+    timed("compare", compare[0].click().run)
+    while _job_running(at) and not errors:
+        time.sleep(POLL_SECONDS)
+        timed("wait", at.run)
+    results_seconds = time.perf_counter() - session_start
+    lookup = [box for box in at.text_input if box.key == "record_lookup_value"]
+    if not lookup:
+        errors.append("No results after comparing: " + "; ".join(
+            element.value for element in [*at.error, *at.warning, *at.info][:3]))
+        return {"reruns": reruns, "errors": errors, "results_seconds": results_seconds, "exports": 0}
+    timed("drill-down", lookup[0].input(lookup_key).run)
+    at.session_state["load_test_clicks"] = EXPORT_KEYS
+    timed("export", at.run)
+    at.session_state["load_test_clicks"] = ()
+    exports = at.session_state["load_test_exports"] if "load_test_exports" in at.session_state else 0
+    return {"reruns": reruns, "errors": errors, "results_seconds": results_seconds, "exports": exports}
+
+def run_level(users, workloads):
+    """Run `users` sessions at once; latency, throughput and memory for this session count.
+
+    Cached files and results are cleared first, so every level computes its comparisons.
+    """
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    reset_peak_memory()
+    rss_before = memory_kb("VmRSS")
+    emails_before = OfflineSMTP.sent
+    start = time.perf_counter()
+    with ThreadPoolExecutor(users) as pool:
+        sessions = list(pool.map(lambda user: run_session(*workloads[user % len(workloads)]), range(users)))
+    wall = time.perf_counter() - start
+    rss_peak, rss_after = memory_kb("VmHWM"), memory_kb("VmRSS")
+
+    reruns = pd.DataFrame([r for s in sessions for r in s["reruns"]])
+    interactive = reruns[reruns["step"] != "wait"]["seconds"]
+    return {
+        "Users": users,
+        "Errors": sum(len(s["errors"]) for s in sessions),
+        "Reruns": len(reruns),
+        "p50 (s)": float(np.percentile(interactive, 50)),
+        "p95 (s)": float(np.percentile(interactive, 95)),
+        "Max (s)": float(interactive.max()),
+        "Time to Results p50 (s)": float(np.median([s["results_seconds"] or np.nan for s in sessions])),
+        "Reruns/s": len(reruns) / wall,
+        "Sessions/min": users / wall * 60,
+        "Peak RSS (MB)": rss_peak / 1024 if rss_peak else None,
+        "Added RSS/Session (MB)": (rss_peak - rss_before) / 1024 / users if rss_peak and rss_before else None,
+        "Retained RSS (MB)": (rss_after - rss_before) / 1024 if rss_after and rss_before else None,
+        "Exports": sum(s["exports"] for s in sessions),
+        "Emails Intercepted": OfflineSMTP.sent - emails_before,
+        "errors": [e for s in sessions for e in s["errors"]],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 2, 4], help="concurrent sessions per level")
+    parser.add_argument("--rows", type=int, default=5_000, help="NetSuite records per workbook")
+    parser.add_argument("--shared-files", action="store_true",
+                        help="every user uploads the same pair (shares cached results) instead of their own")
+    args = parser.parse_args()
+
+    # Ht.py writes .streamlit/ and its history files to the working directory: keep them out of the repo
+    folder = tempfile.mkdtemp(prefix="load_test_")
+    os.chdir(folder)
+    install_stubs()
+    workloads = prepare_workloads(folder, max(args.users), args.rows, args.shared_files)
+    levels = []
+    for users in args.users:
+        level = run_level(users, workloads)
+        for message in dict.fromkeys(level.pop("errors")):
+            print(f"[{users} users] error: {message[:300]}")
+        levels.append(level)
+        print(pd.DataFrame([level]).round(2).to_string(index=False), flush=True)
+    print("\nSummary:")
+    print(pd.DataFrame(levels).round(2).to_string(index=False))
+
+if __name__ == "__main__":
+    main()